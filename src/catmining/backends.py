@@ -0,0 +1,257 @@
+from openai import OpenAI, AzureOpenAI
+from botocore.config import Config
+import boto3
+import httpx
+import os
+
+# HTTP/2 lets many concurrent calls share one connection, but needs the optional h2 package
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+
+# the sampling parameters CatMiner was developed with; max_tokens can be raised per backend
+DEFAULT_PARAMS = {'temperature': 0.0, 'top_p': None, 'max_tokens': 100}
+
+
+class Backend:
+
+    ### one LLM endpoint behind a single complete() call
+    # messages are given in the format of the backend's model_type (see catmining.multiturn_helpers._append_context)
+    # and the answer comes back as a dictionary, so the cascade never touches the provider client itself.
+
+    ### inputs:
+    # model: the model or deployment that answers [str]
+    # params: sampling parameters that replace DEFAULT_PARAMS for every call [dict] (default None)
+
+    model_type = None
+
+    def __init__(self, model, params=None):
+
+        self.model = model
+        self.params = {**DEFAULT_PARAMS, **(params or {})}
+
+    def complete(self, messages, system=None, params=None):
+
+        ### send one request and wait for the answer
+
+        ### inputs:
+        # messages: the conversation to answer [list of dict]
+        # system: the system prompt [str] (default None)
+        # params: sampling parameters for this call only, plus 'cache_prefix' to mark the prompt prefix for
+        #         provider-side caching and 'json_schema' to constrain the answer to a JSON schema where the
+        #         provider supports it (otherwise the prompt has to ask for the format) [dict] (default None)
+
+        ### outputs:
+        # completion: the answer and token counts, with keys 'Text', 'Input Tokens', 'Output Tokens',
+        #             'Cached Tokens' (read from the provider cache) and 'Written Tokens' (written to it) [dict]
+
+        raise NotImplementedError
+
+    def _params(self, params):
+
+        return {**self.params, **(params or {})}
+
+
+class OpenAIBackend(Backend):
+
+    ### any OpenAI-compatible chat completions endpoint (OpenAI, Azure OpenAI, Fireworks, local servers)
+    # the system prompt travels as the first message, as in the rest of CatMiner's 'OpenAI' conversations
+
+    ### inputs:
+    # client: an OpenAI-style client
+    # model: the model or deployment name [str]
+    # params: see Backend [dict] (default None)
+
+    model_type = 'OpenAI'
+
+    def __init__(self, client, model, params=None):
+
+        super().__init__(model, params)
+        self.client = client
+
+    def _request(self, messages, system, params):
+
+        params = self._params(params)
+        if system is not None and (not messages or messages[0]['role'] != 'system'):
+            messages = [{"role": "system", "content": system}] + list(messages)
+
+        request = {'model': self.model, 'messages': messages, 'temperature': params['temperature'],
+                   'max_tokens': params['max_tokens'], 'frequency_penalty': 0, 'presence_penalty': 0}
+        if params['top_p'] is not None:
+            request['top_p'] = params['top_p']
+        if params.get('json_schema') is not None:
+            request['response_format'] = {'type': 'json_schema', 'json_schema': {'name': 'response', 'schema': params['json_schema'], 'strict': True}}
+
+        return request
+
+    @staticmethod
+    def _completion(response):
+
+        # prompt_tokens includes the prefix that OpenAI read from its cache
+        details = getattr(response.usage, 'prompt_tokens_details', None)
+
+        return {'Text': response.choices[0].message.content, 'Input Tokens': response.usage.prompt_tokens,
+                'Output Tokens': response.usage.completion_tokens,
+                'Cached Tokens': getattr(details, 'cached_tokens', None) or 0, 'Written Tokens': 0}
+
+    def complete(self, messages, system=None, params=None):
+
+        return self._completion(self.client.chat.completions.create(**self._request(messages, system, params)))
+
+
+class BedrockBackend(Backend):
+
+    ### Amazon Bedrock models through the Converse API
+
+    ### inputs:
+    # client: a boto3 'bedrock-runtime' client
+    # model: the Bedrock model id [str]
+    # params: see Backend [dict] (default None)
+
+    model_type = 'Meta'
+
+    def __init__(self, client, model, params=None):
+
+        super().__init__(model, params)
+        self.client = client
+
+    def complete(self, messages, system=None, params=None):
+
+        params = self._params(params)
+
+        system = [{"text": system if system is not None else ''}]
+        messages = list(messages)
+        if params.get('cache_prefix'):
+            # cache up to the end of the system prompt and of the history that the new prompt extends.
+            # the messages are shared with other conversations, so the marked one is copied instead of changed
+            system.append({"cachePoint": {"type": "default"}})
+            if len(messages) >= 2:
+                messages[-2] = {**messages[-2], "content": messages[-2]["content"] + [{"cachePoint": {"type": "default"}}]}
+
+        response = self.client.converse(
+            modelId=self.model,
+            messages=messages,
+            system=system,
+            inferenceConfig={"temperature": params['temperature'], "topP": params['top_p'] if params['top_p'] is not None else 0.0,
+                             "maxTokens": params['max_tokens']},
+            performanceConfig={"latency": "optimized"}
+        )
+
+        # Bedrock counts the tokens read from and written to its cache apart from inputTokens
+        usage = response['usage']
+        cached = usage.get('cacheReadInputTokens', 0)
+        written = usage.get('cacheWriteInputTokens', 0)
+
+        return {'Text': response['output']['message']['content'][0]['text'], 'Input Tokens': usage['inputTokens'] + cached + written,
+                'Output Tokens': usage['outputTokens'], 'Cached Tokens': cached, 'Written Tokens': written}
+
+
+def as_backend(client, model_type):
+
+    ### the Backend for an LLM client; clients that are not Backends are wrapped using the model in the environment
+
+    ### inputs:
+    # client: a Backend, or an OpenAI-style / boto3 'bedrock-runtime' style client
+    # model_type: type of LLM we are expecting (supported options are 'OpenAI' and 'Meta') [str]
+
+    if isinstance(client, Backend):
+        return client
+
+    # wrapping is cheap, but keep one wrapper per client so its settings are shared.
+    # a client may carry its own sampling parameters, as define_client sets for batch clients
+    backend = getattr(client, '_catmining_backend', None)
+    if backend is None or backend.model_type != model_type:
+        if model_type == 'OpenAI':
+            backend = OpenAIBackend(client, os.environ['model'], getattr(client, 'params', None))
+        elif model_type == 'Meta':
+            backend = BedrockBackend(client, os.environ['MODEL_ID'], getattr(client, 'params', None))
+        else:
+            raise ValueError(f"Unsupported model type {model_type}. Supported model types are 'OpenAI' and 'Meta'.")
+        try:
+            client._catmining_backend = backend
+        except AttributeError:
+            pass
+
+    return backend
+
+
+### backend registry: define_client(name, **kwargs) builds register_backend(name, factory)'s factory(**kwargs)
+
+_registry = {}
+
+
+def register_backend(name, factory):
+
+    ### make a new kind of endpoint available to define_client
+
+    ### inputs:
+    # name: the client type passed to define_client [str]
+    # factory: builds the Backend from the keyword arguments given to define_client [function]
+
+    _registry[name] = factory
+
+
+def create_backend(name, **kwargs):
+
+    ### build a registered backend
+
+    if name not in _registry:
+        raise ValueError(f'Unknown backend {name}. Registered backends are {", ".join(sorted(_registry))}.')
+
+    return _registry[name](**kwargs)
+
+
+def _http_client(pool_size=64, keepalive_expiry=30.0, timeout=60.0):
+
+    # one pooled HTTP client per backend, so calls reuse open (TLS) connections
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive_expiry)
+
+    return httpx.Client(http2=_HTTP2, limits=limits, timeout=timeout)
+
+
+def _azure_backend(model=None, params=None, pool_size=64, keepalive_expiry=30.0):
+
+    client = AzureOpenAI(api_key=os.environ['API_KEY'], api_version=os.environ['API_VERSION'],
+                         azure_endpoint=os.environ['AZURE_ENDPOINT'], organization=os.environ['ORGANIZATION_ID'],
+                         http_client=_http_client(pool_size, keepalive_expiry))
+
+    return OpenAIBackend(client, model or os.environ['model'], params)
+
+
+def _openai_compatible_backend(base_url, api_key, model, params=None, pool_size=64, keepalive_expiry=30.0):
+
+    client = OpenAI(base_url=base_url, api_key=api_key, http_client=_http_client(pool_size, keepalive_expiry))
+
+    return OpenAIBackend(client, model, params)
+
+
+def _fireworks_backend(model=None, params=None, pool_size=64, keepalive_expiry=30.0):
+
+    return _openai_compatible_backend('https://api.fireworks.ai/inference/v1', os.environ['FIREWORKS_API_KEY'],
+                                      model or os.environ['model'], params, pool_size, keepalive_expiry)
+
+
+def _local_backend(base_url=None, model=None, params=None, pool_size=64, keepalive_expiry=30.0):
+
+    # e.g. a vLLM, llama.cpp, or Ollama server; most ignore the API key
+    return _openai_compatible_backend(base_url or os.environ['LOCAL_BASE_URL'], os.environ.get('LOCAL_API_KEY', 'none'),
+                                      model or os.environ['model'], params, pool_size, keepalive_expiry)
+
+
+def _bedrock_backend(model=None, params=None, pool_size=64):
+
+    # botocore keeps up to pool_size connections alive per client and reuses them across threads; it has no setting
+    # for how long an idle connection is kept, so there is no keepalive_expiry here
+    config = Config(max_pool_connections=pool_size, tcp_keepalive=True)
+    client = boto3.client(service_name='bedrock-runtime', region_name=os.environ['AWS_REGION'], config=config)
+
+    return BedrockBackend(client, model or os.environ['MODEL_ID'], params)
+
+
+register_backend('Azure', _azure_backend)
+register_backend('Bedrock', _bedrock_backend)
+register_backend('Fireworks', _fireworks_backend)
+register_backend('Local', _local_backend)
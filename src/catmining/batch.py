@@ -0,0 +1,454 @@
+from catmining.backends import Backend, OpenAIBackend, BedrockBackend
+from types import SimpleNamespace
+import itertools
+import threading
+import uuid
+import time
+import json
+import os
+
+
+class BatchClient:
+
+    ### LLM client that sends requests through a provider batch-inference service instead of answering them one by one
+    # the cascades run unchanged, one sentence per worker thread. each LLM call blocks its worker, and once every
+    # running worker is waiting, the waiting requests are submitted as one batch. the cascades therefore advance
+    # together one level at a time (all Prompt 1s, then all Prompt 2s, ...).
+    # the client stands in for both AzureOpenAI (chat.completions.create) and bedrock-runtime (converse).
+
+    ### inputs:
+    # service: the batch service to submit to [OpenAIBatchService, BedrockBatchService, or LocalBatchService]
+    # poll_interval: seconds between status checks of a submitted batch [float] (default 60.0)
+    # max_workers: the largest number of sentences extracted at the same time, i.e. the largest batch [int] (default 4096)
+
+    def __init__(self, service, poll_interval=60.0, max_workers=4096):
+
+        self.service = service
+        self.poll_interval = poll_interval
+        self.max_workers = max(1, max_workers)
+        self.batches = 0
+        self.requests = 0
+
+        self._cond = threading.Condition()
+        self._ids = itertools.count()
+        self._active = 0
+        self._pending = {}
+        self._results = {}
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **body):
+
+        # answered like AzureOpenAI().chat.completions.create
+        return _namespace(self._request('chat', body))
+
+    def converse(self, **body):
+
+        # answered like boto3.client('bedrock-runtime').converse
+        return self._request('converse', body)
+
+    def _request(self, kind, body):
+
+        ### queue one request for the next batch and wait for its response
+
+        with self._cond:
+            if self._active == 0:
+                raise RuntimeError('BatchClient can only answer requests made inside BatchClient.run()')
+            custom_id = f'request-{next(self._ids)}'
+            self._pending[custom_id] = (kind, body)
+            self._cond.notify_all()
+            while custom_id not in self._results:
+                self._cond.wait()
+            result = self._results.pop(custom_id)
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def run(self, functions):
+
+        ### call each function in a worker thread and submit the LLM requests they make level by level
+
+        ### inputs:
+        # functions: functions without arguments, e.g. one cascade.run per sentence [list]
+
+        ### outputs:
+        # outputs: the return value of each function, in order [list]
+
+        functions = list(functions)
+        outputs = [None]*len(functions)
+        errors = []
+        queue = iter(enumerate(functions))
+        queue_lock = threading.Lock()
+
+        def work():
+            try:
+                while True:
+                    with queue_lock:
+                        k, function = next(queue, (None, None))
+                    if function is None:
+                        break
+                    try:
+                        outputs[k] = function()
+                    except Exception as e:
+                        errors.append(e)
+                        break
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(min(self.max_workers, len(functions)))]
+        with self._cond:
+            self._active += len(workers)
+        for worker in workers:
+            worker.start()
+
+        while True:
+            with self._cond:
+                # a level is complete once every running worker is waiting for a response
+                while self._active > 0 and len(self._pending) < self._active:
+                    self._cond.wait()
+                if self._active == 0:
+                    break
+                level = self._pending
+                self._pending = {}
+
+            try:
+                results = self._submit(level)
+            except Exception as e:
+                # the whole batch failed; fail every request in it so the workers can end
+                results = {custom_id: e for custom_id in level}
+                errors.append(e)
+
+            with self._cond:
+                self._results.update(results)
+                self._cond.notify_all()
+
+        for worker in workers:
+            worker.join()
+
+        if errors:
+            raise errors[0]
+
+        return outputs
+
+    def _submit(self, level):
+
+        ### submit one batch, wait for it to finish, and read back a response (or exception) per request
+
+        job_id = self.service.submit([(custom_id, kind, body) for custom_id, (kind, body) in level.items()])
+        self.batches += 1
+        self.requests += len(level)
+        print(f'Submitted batch {job_id} with {len(level)} requests.')
+
+        while True:
+            status = self.service.status(job_id)
+            if status == 'completed':
+                break
+            if status == 'failed':
+                raise RuntimeError(f'Batch {job_id} failed.')
+            time.sleep(self.poll_interval)
+
+        results = self.service.results(job_id)
+        print(f'Batch {job_id} completed.')
+
+        return {custom_id: results.get(custom_id, RuntimeError(f'Batch {job_id} returned no response for {custom_id}.'))
+                for custom_id in level}
+
+
+def _namespace(response):
+
+    # give a JSON chat completion the attribute access of an openai response object
+    return json.loads(json.dumps(response), object_hook=lambda fields: SimpleNamespace(**fields))
+
+
+class OpenAIBatchService:
+
+    ### the OpenAI / Azure OpenAI Batch API
+
+    ### inputs:
+    # client: an OpenAI or AzureOpenAI client
+    # endpoint: the chat completions route named in the batch file (Azure uses '/chat/completions') [str] (default '/v1/chat/completions')
+    # completion_window: how long the provider may take to finish a batch [str] (default '24h')
+
+    def __init__(self, client, endpoint='/v1/chat/completions', completion_window='24h'):
+
+        self.client = client
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+
+    def submit(self, requests):
+
+        lines = []
+        for custom_id, kind, body in requests:
+            if kind != 'chat':
+                raise ValueError(f'The OpenAI Batch API only answers chat requests, got {kind}.')
+            lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': self.endpoint, 'body': body}))
+
+        batch_file = self.client.files.create(file=('batch.jsonl', '\n'.join(lines).encode('utf8')), purpose='batch')
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint=self.endpoint,
+                                           completion_window=self.completion_window)
+
+        return batch.id
+
+    def status(self, job_id):
+
+        status = self.client.batches.retrieve(job_id).status
+        if status == 'completed':
+            return 'completed'
+        if status in ('failed', 'expired', 'cancelled'):
+            return 'failed'
+
+        return 'in_progress'
+
+    def results(self, job_id):
+
+        batch = self.client.batches.retrieve(job_id)
+
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get('response') or {}
+                if entry.get('error') is None and response.get('status_code') == 200:
+                    results[entry['custom_id']] = response['body']
+                else:
+                    results[entry['custom_id']] = RuntimeError(f"Batch request failed: {entry.get('error') or response}")
+
+        return results
+
+
+class BedrockBatchService:
+
+    ### Amazon Bedrock batch inference jobs for the Meta Llama models
+    # batch jobs take the native model request, so the converse messages are written out in the Llama 3 chat
+    # template. Bedrock rejects jobs below a minimum number of records, so short levels are padded with copies
+    # of their first record (the copies are billed, but their responses are dropped).
+
+    ### inputs:
+    # bedrock: a boto3 'bedrock' (control plane) client
+    # s3: a boto3 's3' client
+    # bucket: the S3 bucket that holds the batch input and output files [str]
+    # role_arn: the IAM role Bedrock assumes to read and write the bucket [str]
+    # prefix: the key prefix of the batch files in the bucket [str] (default 'catmining-batch')
+    # min_records: the smallest number of records Bedrock accepts in one job [int] (default 100)
+
+    def __init__(self, bedrock, s3, bucket, role_arn, prefix='catmining-batch', min_records=100):
+
+        self.bedrock = bedrock
+        self.s3 = s3
+        self.bucket = bucket
+        self.role_arn = role_arn
+        self.prefix = prefix
+        self.min_records = min_records
+        self._jobs = {}
+
+    def submit(self, requests):
+
+        records = []
+        model_ids = set()
+        for custom_id, kind, body in requests:
+            if kind != 'converse':
+                raise ValueError(f'Bedrock batch jobs only answer converse requests, got {kind}.')
+            model_ids.add(body['modelId'])
+            records.append({'recordId': custom_id, 'modelInput': _llama_body(body)})
+        if len(model_ids) != 1:
+            raise ValueError(f'A Bedrock batch job runs one model, got {sorted(model_ids)}.')
+
+        for n in range(self.min_records - len(records)):
+            records.append({'recordId': f'padding-{n}', 'modelInput': records[0]['modelInput']})
+
+        job_name = f'catmining-{uuid.uuid4().hex[:12]}'
+        input_key = f'{self.prefix}/{job_name}/input.jsonl'
+        self.s3.put_object(Bucket=self.bucket, Key=input_key,
+                           Body='\n'.join(json.dumps(record) for record in records).encode('utf8'))
+
+        job = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=model_ids.pop(),
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': f's3://{self.bucket}/{input_key}', 's3InputFormat': 'JSONL'}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': f's3://{self.bucket}/{self.prefix}/{job_name}/output/'}}
+        )
+        self._jobs[job['jobArn']] = job_name
+
+        return job['jobArn']
+
+    def status(self, job_id):
+
+        status = self.bedrock.get_model_invocation_job(jobIdentifier=job_id)['status']
+        if status in ('Completed', 'PartiallyCompleted'):
+            return 'completed'
+        if status in ('Failed', 'Stopping', 'Stopped', 'Expired'):
+            return 'failed'
+
+        return 'in_progress'
+
+    def results(self, job_id):
+
+        # Bedrock writes the output next to a folder named after the job id, i.e. the end of the job ARN
+        key = f"{self.prefix}/{self._jobs[job_id]}/output/{job_id.split('/')[-1]}/input.jsonl.out"
+        text = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read().decode('utf8')
+
+        results = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            output = record.get('modelOutput')
+            if output is None:
+                results[record['recordId']] = RuntimeError(f"Batch request failed: {record.get('error')}")
+            else:
+                results[record['recordId']] = {
+                    'output': {'message': {'role': 'assistant', 'content': [{'text': output['generation']}]}},
+                    'usage': {'inputTokens': output['prompt_token_count'], 'outputTokens': output['generation_token_count']}
+                }
+
+        return results
+
+
+def _llama_body(body):
+
+    ### write a converse request as a native Meta Llama 3 request
+
+    prompt = '<|begin_of_text|>'
+    # cachePoint blocks have no text and are dropped
+    system = ''.join(block.get('text', '') for block in body.get('system', []))
+    if system:
+        prompt += f'<|start_header_id|>system<|end_header_id|>\n\n{system}<|eot_id|>'
+    for message in body['messages']:
+        text = ''.join(block.get('text', '') for block in message['content'])
+        prompt += f"<|start_header_id|>{message['role']}<|end_header_id|>\n\n{text}<|eot_id|>"
+    prompt += '<|start_header_id|>assistant<|end_header_id|>\n\n'
+
+    config = body.get('inferenceConfig', {})
+
+    return {'prompt': prompt, 'temperature': config.get('temperature', 0.0), 'max_gen_len': config.get('maxTokens', 100)}
+
+
+class LocalBatchService:
+
+    ### directory-based stand-in for a provider batch service, for running batch mode offline
+    # each job is a folder under root holding input.jsonl. the job completes once output.jsonl is written, either
+    # by process() (called from any process that can reach the folder) or, if a backend client is given, by this
+    # service itself when the job is polled.
+
+    ### inputs:
+    # root: the folder that holds the jobs, created if it does not exist [str]
+    # backend: a regular (non-batch) LLM client that answers the jobs, or None to leave them to process() [default None]
+    # delay: seconds a job stays in progress before the backend answers it [float] (default 0.0)
+
+    def __init__(self, root, backend=None, delay=0.0):
+
+        self.root = root
+        self.backend = backend
+        self.delay = delay
+        os.makedirs(root, exist_ok=True)
+
+    def submit(self, requests):
+
+        job_id = f'batch-{uuid.uuid4().hex[:12]}'
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir)
+
+        with open(os.path.join(job_dir, 'input.jsonl.tmp'), 'w', encoding='utf8') as f:
+            for custom_id, kind, body in requests:
+                f.write(json.dumps({'custom_id': custom_id, 'kind': kind, 'body': body}, ensure_ascii=False) + '\n')
+        # the rename makes a job visible to process() only once it is complete
+        os.replace(os.path.join(job_dir, 'input.jsonl.tmp'), os.path.join(job_dir, 'input.jsonl'))
+
+        return job_id
+
+    def status(self, job_id):
+
+        job_dir = os.path.join(self.root, job_id)
+        if os.path.exists(os.path.join(job_dir, 'output.jsonl')):
+            return 'completed'
+        if os.path.exists(os.path.join(job_dir, 'error.txt')):
+            return 'failed'
+
+        if self.backend is not None and time.time() - os.path.getmtime(os.path.join(job_dir, 'input.jsonl')) >= self.delay:
+            self.process(job_id)
+            return self.status(job_id)
+
+        return 'in_progress'
+
+    def process(self, job_id, backend=None):
+
+        ### answer every request of a job with a regular LLM client and write output.jsonl
+
+        backend = backend or self.backend
+        job_dir = os.path.join(self.root, job_id)
+
+        try:
+            lines = []
+            with open(os.path.join(job_dir, 'input.jsonl'), encoding='utf8') as f:
+                for line in f:
+                    request = json.loads(line)
+                    try:
+                        response = _answer_locally(backend, request['kind'], request['body'])
+                        lines.append({'custom_id': request['custom_id'], 'response': response, 'error': None})
+                    except Exception as e:
+                        lines.append({'custom_id': request['custom_id'], 'response': None, 'error': str(e)})
+        except Exception as e:
+            with open(os.path.join(job_dir, 'error.txt'), 'w', encoding='utf8') as f:
+                f.write(str(e))
+            return
+
+        with open(os.path.join(job_dir, 'output.jsonl.tmp'), 'w', encoding='utf8') as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
+        os.replace(os.path.join(job_dir, 'output.jsonl.tmp'), os.path.join(job_dir, 'output.jsonl'))
+
+    def results(self, job_id):
+
+        results = {}
+        with open(os.path.join(self.root, job_id, 'output.jsonl'), encoding='utf8') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['error'] is None:
+                    results[entry['custom_id']] = entry['response']
+                else:
+                    results[entry['custom_id']] = RuntimeError(f"Batch request failed: {entry['error']}")
+
+        return results
+
+
+def _answer_locally(backend, kind, body):
+
+    ### send one batch request through a regular backend and return the response as JSON
+    # the request is read back into the messages, system prompt, and sampling parameters of Backend.complete, so any
+    # backend can answer it (e.g. catmining.mock.FakeBackend); a bare provider client is wrapped for the request's model
+
+    if kind == 'converse':
+        if not isinstance(backend, Backend):
+            backend = BedrockBackend(backend, body['modelId'])
+        config = body.get('inferenceConfig', {})
+        params = {'temperature': config.get('temperature', 0.0), 'top_p': config.get('topP'), 'max_tokens': config.get('maxTokens', 100)}
+        # cachePoint blocks have no text and are dropped
+        system = ''.join(block.get('text', '') for block in body.get('system', []))
+        completion = backend.complete(body['messages'], system, params)
+        return {'output': {'message': {'role': 'assistant', 'content': [{'text': completion['Text']}]}},
+                'usage': {'inputTokens': completion['Input Tokens'] - completion['Cached Tokens'] - completion['Written Tokens'],
+                          'outputTokens': completion['Output Tokens'], 'cacheReadInputTokens': completion['Cached Tokens'],
+                          'cacheWriteInputTokens': completion['Written Tokens']}}
+
+    if not isinstance(backend, Backend):
+        backend = OpenAIBackend(backend, body['model'])
+    params = {key: body[key] for key in ('temperature', 'top_p', 'max_tokens') if key in body}
+    if 'response_format' in body:
+        params['json_schema'] = body['response_format']['json_schema']['schema']
+    # the system prompt is already the first message
+    completion = backend.complete(body['messages'], None, params)
+
+    return {
+        'choices': [{'message': {'role': 'assistant', 'content': completion['Text']}}],
+        'usage': {'prompt_tokens': completion['Input Tokens'], 'completion_tokens': completion['Output Tokens'],
+                  'prompt_tokens_details': {'cached_tokens': completion['Cached Tokens']}}
+    }
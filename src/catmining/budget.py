@@ -0,0 +1,322 @@
+from catmining.prompts import prompt1, prompt2, prompt3, prompt4, prompt4_ips, promptf1, promptf2, promptf3, promptf3_nochat, promptf4, promptf4_nochat, prompt_ar1, prompt_ar2, prompt_json
+from catmining.cascade import _excerpt, _ips_excerpt
+from catmining.metrics import STAGES
+import threading
+import json
+
+
+# funnel ratios used when no earlier run is given (see ratios_from_report): the share of candidate sentences that
+# pass Prompt 1, the values per positive sentence, the materials per value, and, for each stage asked about a
+# material, its calls per material (P4, P4-IPS, and F4 per operating condition). 'Output Tokens' is per call.
+# 'Low Confidence' is the share of the records of the structured engine that are followed up on.
+DEFAULT_RATIOS = {'P1 Yes': 0.5, 'Values': 1.5, 'Materials': 1.3, 'Low Confidence': 0.3,
+                  'Calls per Material': {'AR1': 1.0, 'AR2': 0.3, 'P4': 1.0, 'P4-IPS': 0.3, 'F1': 1.0, 'F2': 0.9, 'F3': 0.8, 'F4': 0.7},
+                  'Output Tokens': {'JSON': 60, 'P1': 2, 'P2': 10, 'P3': 12, 'AR1': 2, 'AR2': 12, 'P4': 6, 'P4-IPS': 6, 'F1': 2, 'F2': 2, 'F3': 2, 'F4': 2}}
+
+
+def ratios_from_report(report):
+
+    ### funnel ratios measured by an earlier run, falling back on DEFAULT_RATIOS for anything it did not see
+
+    ### inputs:
+    # report: a metrics report (see catmining.metrics.Metrics.report), or the path of one saved as JSON [dict or str]
+
+    ### outputs:
+    # ratios: the ratios in the format of DEFAULT_RATIOS [dict]
+
+    if isinstance(report, str):
+        with open(report, encoding='utf8') as f:
+            report = json.load(f)
+
+    funnel = report['Funnel']
+    stages = report['Stages']
+    ratios = {'P1 Yes': DEFAULT_RATIOS['P1 Yes'], 'Values': DEFAULT_RATIOS['Values'], 'Materials': DEFAULT_RATIOS['Materials'],
+              'Low Confidence': DEFAULT_RATIOS['Low Confidence'],
+              'Calls per Material': dict(DEFAULT_RATIOS['Calls per Material']), 'Output Tokens': dict(DEFAULT_RATIOS['Output Tokens'])}
+
+    # the sentences sent to Prompt 1 are those that passed the pre-ranker, if one was used
+    asked = funnel.get('Pre-Ranked') or funnel.get('Phrase-Filtered')
+    if asked:
+        ratios['P1 Yes'] = funnel['P1 Yes']/asked
+    if funnel.get('P1 Yes'):
+        ratios['Values'] = funnel['Values']/funnel['P1 Yes']
+    if funnel.get('Values'):
+        ratios['Materials'] = funnel['Materials']/funnel['Values']
+    if funnel.get('Materials'):
+        # the structured engine asks the first follow-up of every record it is unsure about, and only of those
+        materials = funnel['Materials']
+        followed = [stages[stage]['Calls'] for stage in ['F1', 'F2', 'F3'] if stage in stages]
+        if 'JSON' in stages and followed and followed[0]:
+            ratios['Low Confidence'] = followed[0]/materials
+            materials = followed[0]
+        for stage in ratios['Calls per Material']:
+            if stage in stages:
+                ratios['Calls per Material'][stage] = stages[stage]['Calls']/materials
+
+    # replayed calls report no output tokens, so only live calls are averaged
+    for stage, counts in stages.items():
+        live = counts['Calls'] - counts['Replayed']
+        if stage in ratios['Output Tokens'] and live > 0:
+            ratios['Output Tokens'][stage] = counts['Output Tokens']/live
+
+    return ratios
+
+
+def _tokens(chars):
+
+    # about four characters per token, as in catmining.multiturn_helpers._estimate_tokens
+    return chars/4
+
+
+class Estimate:
+
+    ### pre-flight estimate of the calls and tokens of a run, built up one (paper, property) unit at a time
+    # the cascade is followed with the real sentences, excerpts, and system prompts; how many values, materials, and
+    # follow-ups each candidate sentence leads to comes from the funnel ratios.
+
+    ### inputs:
+    # mode: the name of the CatMiner implementation to run [str]
+    # mode_kwargs: the SYSPROMPT, FOLLOWUP, IPS, CHAT, and JOINT_P1 settings, and optionally CONFIDENCE [dict]
+    # ratios: the funnel ratios to assume [dict] (default None, DEFAULT_RATIOS)
+
+    def __init__(self, mode, mode_kwargs, ratios=None):
+
+        self.mode = mode
+        self.mode_kwargs = mode_kwargs
+        self.ratios = ratios or DEFAULT_RATIOS
+        self.papers = set()
+        self.candidates = 0
+        self.stages = {}
+
+        followups = mode_kwargs['FOLLOWUP']
+        if mode == 'test_mode':
+            followups = [1, 2, 3, 4] if followups == True else []
+        self.followups = followups
+
+    def _add(self, stage, calls, in_chars):
+
+        counts = self.stages.setdefault(stage, {'Calls': 0.0, 'Input Tokens': 0.0, 'Output Tokens': 0.0})
+        counts['Calls'] += calls
+        counts['Input Tokens'] += calls*_tokens(in_chars)
+        counts['Output Tokens'] += calls*self.ratios['Output Tokens'].get(stage, 0)
+
+    def add_paper(self, paper):
+
+        ### add the calls expected for one paper and property (see catmining.multiturn._read_paper)
+
+        ratios = self.ratios
+        per_material = ratios['Calls per Material']
+        chat = self.mode_kwargs['CHAT'] == True
+        property = paper['Property']
+        sentences = paper['Sentences']
+        target_dict = paper['Targets']
+        out_chars = {stage: 4*tokens for stage, tokens in ratios['Output Tokens'].items()}
+
+        self.papers.add(paper['Source'])
+        self.candidates += len(paper['Candidates'])
+
+        if self.mode == 'structured':
+            self._add_structured(paper)
+            return
+
+        for s in paper['Candidates']:
+            sentence = sentences[s]
+            excerpt_p3 = _excerpt(paper, s, target_dict['Properties'][0]['Context Params'])
+
+            # the conversation grows with every prompt and answer while chat-like memory is on
+            system = len(paper['System Prompt'])
+            p1 = system + len(prompt1.format(property=property)) + len(sentence)
+            p2 = (p1 + out_chars['P1'] if chat else system) + len(prompt2.format(property=property)) + len(sentence)
+            p3 = (p2 + out_chars['P2'] if chat else system) + len(prompt3.format(property=property, property_value='')) + len(excerpt_p3)
+            checkpoint = p3 + out_chars['P3'] if chat else system
+
+            positive = ratios['P1 Yes']
+            values = positive*ratios['Values']
+            materials = values*ratios['Materials']
+            self._add('P1', 1, p1)
+            self._add('P2', positive, p2)
+            self._add('P3', values, p3)
+
+            if self.mode == 'abbreviation_resolution':
+                ar1 = checkpoint + len(prompt_ar1.format(material=''))
+                self._add('AR1', materials*per_material['AR1'], ar1)
+                # AR2 passes the sentences that define the abbreviation, assumed to be about as long as this one
+                self._add('AR2', materials*per_material['AR2'], (ar1 + out_chars['AR1'] if chat else system) + len(prompt_ar2.format(material='')) + 3*len(sentence))
+
+            for i, condition in enumerate(paper['Operating Conditions']):
+                excerpt_p4 = _excerpt(paper, s, target_dict['Operating Conditions'][i]['Context Params'])
+                p4 = checkpoint + len(prompt4.format(operating_condition=condition, material='', property=property, property_value='')) + len(excerpt_p4)
+                self._add('P4', materials*per_material['P4'], p4)
+                if self.mode_kwargs['IPS'] == True:
+                    ips = checkpoint + len(prompt4_ips.format(operating_condition=condition, material='', property=property, property_value=''))
+                    self._add('P4-IPS', materials*per_material['P4-IPS'], ips + len(_ips_excerpt(paper, i, s)))
+                if 4 in self.followups:
+                    f4 = (promptf4 if chat else promptf4_nochat).format(material='', property=property, property_value='', operating_condition=condition, operating_condition_value='')
+                    self._add('F4', materials*per_material['F4'], (p4 + out_chars['P4'] if chat else system + len(excerpt_p4)) + len(f4))
+
+            for number, template in [(1, promptf1), (2, promptf2)]:
+                if number in self.followups:
+                    self._add(f'F{number}', materials*per_material[f'F{number}'], checkpoint + len(template.format(material='')))
+            if 3 in self.followups:
+                f3 = (promptf3 if chat else promptf3_nochat).format(material='', property=property, property_value='')
+                self._add('F3', materials*per_material['F3'], checkpoint + len(f3) + (0 if chat else len(excerpt_p3)))
+
+    def _add_structured(self, paper):
+
+        # one JSON call per candidate sentence over the widest excerpt; the records it returns are counted as the
+        # materials of the cascade, and the low-confidence share of them is followed up on
+        ratios = self.ratios
+        per_material = ratios['Calls per Material']
+        chat = self.mode_kwargs['CHAT'] == True
+        property = paper['Property']
+        targets = paper['Targets']['Properties'] + paper['Targets']['Operating Conditions']
+        window = {'Bounds': [max(target['Context Params']['Bounds'][0] for target in targets),
+                             max(target['Context Params']['Bounds'][1] for target in targets)],
+                  'Title': any(target['Context Params']['Title'] == True for target in targets)}
+        names = ', '.join(f'"{name}"' for name in paper['Operating Conditions'])
+
+        for s in paper['Candidates']:
+            excerpt = _excerpt(paper, s, window)
+            system = len(paper['System Prompt'])
+            call = system + len(prompt_json.format(property=property, operating_conditions=names)) + len(paper['Sentences'][s]) + len(excerpt)
+            checkpoint = call + 4*ratios['Output Tokens']['JSON'] if chat else system
+            self._add('JSON', 1, call)
+
+            followed = ratios['P1 Yes']*ratios['Values']*ratios['Materials']*ratios['Low Confidence']
+            for number, template in [(1, promptf1), (2, promptf2)]:
+                if number in self.followups:
+                    self._add(f'F{number}', followed*per_material[f'F{number}'], checkpoint + len(template.format(material='')))
+            if 3 in self.followups:
+                f3 = (promptf3 if chat else promptf3_nochat).format(material='', property=property, property_value='')
+                self._add('F3', followed*per_material['F3'], checkpoint + len(f3) + (0 if chat else len(excerpt)))
+            if 4 in self.followups:
+                f4 = (promptf4 if chat else promptf4_nochat).format(material='', property=property, property_value='', operating_condition='', operating_condition_value='')
+                self._add('F4', followed*per_material['F4']*len(paper['Operating Conditions']), checkpoint + len(f4))
+
+    def totals(self):
+
+        ### outputs:
+        # calls, input_tokens, output_tokens: the expected totals of the run [float]
+
+        return (sum(counts['Calls'] for counts in self.stages.values()),
+                sum(counts['Input Tokens'] for counts in self.stages.values()),
+                sum(counts['Output Tokens'] for counts in self.stages.values()))
+
+    def cost(self, price):
+
+        ### the expected cost of the run at a price of (input, output) dollars per million tokens
+
+        _, input_tokens, output_tokens = self.totals()
+
+        return (input_tokens*price[0] + output_tokens*price[1])/1e6
+
+    def summary(self, prices=None):
+
+        ### describe the estimate, with its cost for each named (input, output) price per million tokens
+
+        calls, input_tokens, output_tokens = self.totals()
+        lines = [f'Estimate for {len(self.papers)} papers and {self.candidates} candidate sentences: about {calls:.0f} calls, '
+                 f'{input_tokens:.0f} input and {output_tokens:.0f} output tokens.']
+        for stage in [stage for stage in STAGES if stage in self.stages]:
+            counts = self.stages[stage]
+            lines.append(f"  {stage}: {counts['Calls']:.0f} calls, {counts['Input Tokens']:.0f} input / {counts['Output Tokens']:.0f} output tokens")
+        for provider, price in (prices or {}).items():
+            lines.append(f'  Cost at {provider}: ${self.cost(price):.2f}')
+
+        return '\n'.join(lines)
+
+
+class Budget:
+
+    ### hard token and/or dollar budget of a run, degraded gracefully as it is spent
+    # once IPS_AT of the budget is spent, inter-paragraph search is no longer used; once FOLLOWUPS_AT is spent,
+    # follow-up prompts are no longer asked (so materials are kept unverified). a call that could overrun the budget,
+    # counting the tokens reserved for the calls in flight, raises catmining.multiturn_helpers.BudgetExceeded, which
+    # ends the run after the last completed unit, so it can be resumed later.
+
+    ### inputs:
+    # max_tokens: the input + output tokens the run may use, or None for no token limit [int] (default None)
+    # max_cost: the dollars the run may spend, or None for no cost limit [float] (default None)
+    # price: (input, output) dollars per million tokens, needed for max_cost [tuple] (default None)
+
+    IPS_AT = 0.8
+    FOLLOWUPS_AT = 0.9
+
+    def __init__(self, max_tokens=None, max_cost=None, price=None):
+
+        if max_cost is not None and price is None:
+            raise ValueError('A cost budget needs the (input, output) price per million tokens.')
+
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.price = price
+        self.in_tkns = 0
+        self.out_tkns = 0
+        # tokens estimated for the calls in flight
+        self.reserved = 0
+        self.degraded = []
+        self._lock = threading.Lock()
+
+    def share(self, in_tkns, out_tkns):
+
+        ### the largest share of any limit that the given tokens would use up
+        shares = [0.0]
+        if self.max_tokens is not None:
+            shares.append((in_tkns + out_tkns)/self.max_tokens if self.max_tokens else float('inf'))
+        if self.max_cost is not None:
+            cost = (in_tkns*self.price[0] + out_tkns*self.price[1])/1e6
+            shares.append(cost/self.max_cost if self.max_cost else float('inf'))
+
+        return max(shares)
+
+    @property
+    def spent(self):
+
+        ### the share of the budget used so far [float]
+
+        return self.share(self.in_tkns, self.out_tkns)
+
+    def exceeded_by(self, estimated_tokens):
+
+        ### whether a call of about this many input + output tokens could overrun the budget
+        # if it could not, the tokens are reserved until the call is settled with spend or release, so calls that are
+        # sent at the same time cannot overrun the budget together
+
+        with self._lock:
+            if self.share(self.in_tkns + self.reserved + estimated_tokens, self.out_tkns) > 1:
+                return True
+            self.reserved += estimated_tokens
+            return False
+
+    def release(self, reserved_tokens):
+
+        ### give back the tokens reserved for a call that was not completed
+
+        with self._lock:
+            self.reserved -= reserved_tokens
+
+    def spend(self, in_tkns, out_tkns, reserved_tokens=0):
+
+        ### count the tokens of a completed call, in place of the tokens reserved for it
+
+        with self._lock:
+            self.reserved -= reserved_tokens
+            self.in_tkns += in_tkns
+            self.out_tkns += out_tkns
+            spent = self.spent
+            for feature, threshold in [('IPS', self.IPS_AT), ('Follow-ups', self.FOLLOWUPS_AT)]:
+                if spent >= threshold and feature not in self.degraded:
+                    self.degraded.append(feature)
+                    print(f'{100*threshold:.0f}% of the budget is spent. {feature} will no longer be used.')
+
+    def allows(self, feature):
+
+        ### whether an optional part of the cascade ('IPS' or 'Follow-ups') is still affordable
+
+        return feature not in self.degraded
+
+    def summary(self):
+
+        degraded = f" Disabled to save budget: {', '.join(self.degraded)}." if self.degraded else ''
+
+        return f'Budget: {self.in_tkns} input and {self.out_tkns} output tokens used ({100*self.spent:.1f}% of the budget).{degraded}'
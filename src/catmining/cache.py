@@ -0,0 +1,334 @@
+from catmining.writers import _open_append
+import unicodedata
+import threading
+import hashlib
+import sqlite3
+import gzip
+import json
+import os
+
+
+class ResponseCache:
+
+    ### persistent on-disk cache of LLM responses, keyed by a hash of the full conversation
+    # all CatMiner calls are made at temperature 0, so re-sending the same conversation to the same model
+    # returns the same answer. the cache is a single SQLite file and evicts the least recently used entries
+    # once it grows past max_entries or max_bytes.
+
+    ### inputs:
+    # path: the path to the SQLite cache file, created if it does not exist [str]
+    # max_entries: the largest number of responses to keep, or None for no limit [int] (default None)
+    # max_bytes: the largest total size of stored keys and responses, or None for no limit [int] (default None)
+
+    def __init__(self, path, max_entries=None, max_bytes=None):
+
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # counters for the current run
+        self.hits = 0
+        self.misses = 0
+        self.saved_in_tkns = 0
+        self.saved_out_tkns = 0
+
+        # one connection shared by the extraction threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT NOT NULL, '
+                           'in_tkns INTEGER NOT NULL, out_tkns INTEGER NOT NULL, size INTEGER NOT NULL, '
+                           'last_used INTEGER NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._conn.commit()
+
+        # a monotonically increasing use counter gives an exact LRU order, even within one clock tick
+        self._clock = self._conn.execute('SELECT COALESCE(MAX(last_used), 0) FROM responses').fetchone()[0]
+
+        # apply the limits to a cache left behind by a run with larger ones
+        self._evict()
+        self._conn.commit()
+
+    @staticmethod
+    def key(model_id, sysprompt, context, params=None):
+
+        ### hash the model, system prompt, and the full message list of a call, plus any non-default sampling parameters
+
+        payload = {'model': model_id, 'system': sysprompt, 'messages': context}
+        if params:
+            payload['params'] = params
+        payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+        return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+    def get(self, key):
+
+        ### look up a response; returns (ans, in_tkns, out_tkns) as originally reported, or None on a miss
+
+        with self._lock:
+            row = self._conn.execute('SELECT answer, in_tkns, out_tkns FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._clock += 1
+            self._conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (self._clock, key))
+            self._conn.commit()
+            self.hits += 1
+            self.saved_in_tkns += row[1]
+            self.saved_out_tkns += row[2]
+
+        return row[0], row[1], row[2]
+
+    def put(self, key, ans, in_tkns, out_tkns):
+
+        ### store a response and evict the least recently used entries beyond the size limits
+
+        size = len(key) + len(ans.encode('utf8'))
+
+        with self._lock:
+            self._clock += 1
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, ans, in_tkns, out_tkns, size, self._clock))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+
+        # drop the least recently used entries until both limits are satisfied
+        if self.max_entries is not None:
+            count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                                   'ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+
+        if self.max_bytes is not None:
+            total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > self.max_bytes:
+                # walk from the oldest entry until enough bytes are freed
+                excess = total - self.max_bytes
+                stale = []
+                for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY last_used'):
+                    stale.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+
+    def summary(self):
+
+        ### describe the hit/miss counters for the current run
+
+        return (f'Cache hits: {self.hits}, misses: {self.misses}. '
+                f'Tokens saved: {self.saved_in_tkns} input, {self.saved_out_tkns} output.')
+
+    def close(self):
+
+        with self._lock:
+            self._conn.close()
+
+
+class Transcript:
+
+    ### append-only record of every LLM request/response pair of a run, replayed by later runs
+    # each conversation is stored compactly as the hash of its full request (see ResponseCache.key), its last
+    # prompt, and the answer, one JSON object per line. conversations already in the transcript are answered from
+    # it, and only new ones reach the model and are appended. unlike the cache it is never trimmed, so a transcript
+    # can be shared between the runs of an ablation sweep, which then only pay for the calls where they differ.
+
+    ### inputs:
+    # path: the transcript file ('.jsonl', or '.jsonl.gz' for a compressed one), created if it does not exist [str]
+
+    def __init__(self, path):
+
+        self.path = path
+
+        # counters for the current run
+        self.replayed = 0
+        self.recorded = 0
+        self.saved_in_tkns = 0
+        self.saved_out_tkns = 0
+
+        self._entries = {}
+        if os.path.exists(path):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, mode='rt', encoding='utf8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a run that was killed mid-write
+                        continue
+                    self._entries[entry['Key']] = (entry['Answer'], entry['Input Tokens'], entry['Output Tokens'])
+
+        self._lock = threading.Lock()
+        self._file = _open_append(path)
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def get(self, key):
+
+        ### look up a recorded response; returns (ans, in_tkns, out_tkns) as originally reported, or None if unseen
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.replayed += 1
+                self.saved_in_tkns += entry[1]
+                self.saved_out_tkns += entry[2]
+
+        return entry
+
+    def put(self, key, prompt, ans, in_tkns, out_tkns):
+
+        ### record a response that was not in the transcript
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (ans, in_tkns, out_tkns)
+            self._file.write(json.dumps({'Key': key, 'Prompt': prompt, 'Answer': ans, 'Input Tokens': in_tkns,
+                                         'Output Tokens': out_tkns}, ensure_ascii=False) + '\n')
+            self._file.flush()
+            self.recorded += 1
+
+    def summary(self):
+
+        ### describe the replayed and recorded calls of the current run
+
+        return (f'Transcript calls replayed: {self.replayed}, recorded: {self.recorded}. '
+                f'Tokens saved: {self.saved_in_tkns} input, {self.saved_out_tkns} output.')
+
+    def close(self):
+
+        with self._lock:
+            self._file.close()
+
+
+# what a material verdict may be reused for (see VerdictStore)
+VERDICT_POLICIES = ['context-free', 'paper', 'property', 'corpus']
+
+
+def normalize_material(name):
+
+    ### the form of a material name under which its verdicts are stored
+    # unicode variants (e.g., subscript digits) and spacing are unified, but case is kept, since Co and CO differ
+
+    name = unicodedata.normalize('NFKC', name)
+    name = ' '.join(name.split())
+
+    return name.strip(' "\'“”.')
+
+
+class VerdictStore:
+
+    ### corpus-wide store of the yes/no answers about a material name (AR1, F1, F2), which are mostly answered from
+    # the name alone and so repeat across sentences and papers. a verdict is reused according to the policy:
+    # 'context-free' only reuses verdicts asked without chat-like memory, whose conversations hold nothing but the
+    # system prompt and the question; 'paper' reuses them within a paper and property, 'property' across the papers
+    # of a property, and 'corpus' across everything, whatever the conversation said before the question.
+
+    ### inputs:
+    # path: a JSONL file ('.jsonl' or '.jsonl.gz') that keeps the verdicts across runs, or None to keep them for this
+    #       run only [str] (default None)
+    # policy: one of VERDICT_POLICIES [str] (default 'context-free')
+
+    def __init__(self, path=None, policy='context-free'):
+
+        if policy not in VERDICT_POLICIES:
+            raise ValueError(f"Unknown verdict policy {policy}. Supported policies are {', '.join(VERDICT_POLICIES)}.")
+
+        self.path = path
+        self.policy = policy
+
+        # hits and misses of the current run per stage
+        self.counts = {}
+
+        self._verdicts = {}
+        if path is not None and os.path.exists(path):
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, mode='rt', encoding='utf8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a run that was killed mid-write
+                        continue
+                    self._verdicts[entry['Key']] = entry['Answer']
+
+        self._lock = threading.Lock()
+        self._file = _open_append(path) if path is not None else None
+
+    def __len__(self):
+
+        return len(self._verdicts)
+
+    def key(self, stage, material, model_id, system_prompt, source, property, chat):
+
+        ### the key of a verdict under the policy, or None if the policy does not allow reusing it
+
+        ### inputs:
+        # stage: 'AR1', 'F1', or 'F2' [str]
+        # material: the material name asked about [str]
+        # model_id: the model that answers [str]
+        # system_prompt: the system prompt of the conversation [str]
+        # source: the paper the material comes from [str]
+        # property: the property the material is asked about for [str]
+        # chat: whether the question is asked with chat-like memory [Bool]
+
+        if self.policy == 'context-free' and chat == True:
+            return None
+
+        payload = {'stage': stage, 'material': normalize_material(material), 'model': model_id}
+        if self.policy in ('context-free', 'paper', 'property'):
+            payload['system'] = system_prompt
+        if self.policy in ('paper', 'property'):
+            payload['property'] = property
+        if self.policy == 'paper':
+            payload['source'] = source
+        payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+
+        return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+    def get(self, stage, key):
+
+        ### look up a verdict; returns the stored answer, or None if the name was not asked about yet
+
+        with self._lock:
+            verdict = self._verdicts.get(key)
+            counts = self.counts.setdefault(stage, {'Hits': 0, 'Misses': 0})
+            counts['Hits' if verdict is not None else 'Misses'] += 1
+
+        return verdict
+
+    def put(self, stage, key, material, ans):
+
+        ### store the answer to a question about a material name
+
+        with self._lock:
+            if key in self._verdicts:
+                return
+            self._verdicts[key] = ans
+            if self._file is not None:
+                self._file.write(json.dumps({'Key': key, 'Stage': stage, 'Material': normalize_material(material),
+                                             'Answer': ans}, ensure_ascii=False) + '\n')
+                self._file.flush()
+
+    def summary(self):
+
+        ### describe the hit rate of each stage in the current run
+
+        parts = []
+        for stage, counts in sorted(self.counts.items()):
+            asked = counts['Hits'] + counts['Misses']
+            parts.append(f"{stage} {counts['Hits']}/{asked} ({100*counts['Hits']/asked:.1f}%)")
+
+        return f"Verdict store ({self.policy}, {len(self._verdicts)} verdicts) hits: {', '.join(parts) if parts else 'none asked'}."
+
+    def close(self):
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
@@ -0,0 +1,996 @@
+from catmining.multiturn_helpers import getexcerpt, write_log, prompt, replay, count_funnel, count_replayed, budget_allows, verdict_store, BudgetExceeded, IPSIndex, Conversation
+from catmining.backends import as_backend
+from catmining.prompts import (
+    prompt1,
+    prompt1_multi,
+    prompt2,
+    prompt3,
+    prompt4,
+    prompt4_ips,
+    promptf1,
+    promptf2,
+    promptf3,
+    promptf3_nochat,
+    promptf4,
+    promptf4_nochat,
+    prompt_ar1,
+    prompt_ar2,
+    prompt_json
+)
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from abc import ABC, abstractmethod
+import json
+
+
+### The CatMiner prompt cascade, written once for every mode.
+# Prompts 1-3 (is there a value? which values? which materials?) are always run. Everything that happens to a
+# material after Prompt 3 is a list of stage objects: abbreviation resolution, operating conditions (with or
+# without inter-paragraph search), follow-up prompts, and finally a record stage. default, abbreviation_resolution
+# and test_mode in catmining.multiturn are just different stage lists (see build_stages). Every LLM call goes
+# through Cascade.ask, so the shared rate limiter and response cache apply to all modes alike.
+# Stages that start from the same checkpoint (F1-F3, and Prompt 4 for each operating condition) can be sent at the
+# same time; each then runs on a fork of the sentence state, which is merged back in stage order.
+
+
+class SentenceState:
+
+    ### the mutable state of the cascade while it works through one sentence
+    # context is the conversation currently being extended; stages load it from checkpoints as needed.
+    # conversations are immutable, so a checkpoint is just the conversation at that point
+
+    def __init__(self, s, sentence, context, excerpt_p3, excerpts_p4, extracted_records):
+
+        self.s = s
+        self.sentence = sentence
+        self.context = context
+        self.excerpt_p3 = excerpt_p3
+        self.excerpts_p4 = excerpts_p4
+        self.extracted_records = extracted_records
+        self.log = []
+        self.in_tkn = 0
+        self.out_tkn = 0
+        self.rcounts = 0
+
+    def fork(self):
+
+        ### a copy of the state to run one branch of the cascade on, with its own log and token counts
+
+        return SentenceState(self.s, self.sentence, self.context, self.excerpt_p3, self.excerpts_p4, self.extracted_records)
+
+    def merge(self, branch):
+
+        ### take over the log, token counts, and context of a finished branch
+
+        self.log.extend(branch.log)
+        self.in_tkn += branch.in_tkn
+        self.out_tkn += branch.out_tkn
+        self.context = branch.context
+
+
+class Cascade:
+
+    ### runs the CatMiner prompt cascade for one parent property of one paper
+
+    ### inputs:
+    # paper: the parsed paper and extraction targets returned by catmining.multiturn._read_paper [dict]
+    # client: the LLM client (Azure, Bedrock, or Fireworks)
+    # model_type: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # stages: the stages applied to every material named by Prompt 3, ending in a record stage [list]
+    # chat: whether chat-like memory is enabled [Bool] (default True)
+    # log_sink: called with (sentence index, log entries) whenever a stage completes, so the log of a sentence is
+    #           written out as it grows instead of being returned by run(); None keeps the whole log [function] (default None)
+    # record_sink: called with the records of each sentence once it is complete, instead of returning them from run();
+    #              None returns them [function] (default None)
+
+    def __init__(self, paper, client, model_type, stages, chat=True, log_sink=None, record_sink=None):
+
+        self.paper = paper
+        self.client = client
+        self.model_type = model_type
+        self.stages = stages
+        self.chat = chat
+        self.log_sink = log_sink
+        self.record_sink = record_sink
+
+    def new_records(self):
+
+        ### an empty dictionary of outputs with the columns written by the record stage
+
+        return self.stages[-1].new_records(self.paper)
+
+    def ask(self, state, name, user_message, append=True, error=None, params=None):
+
+        ### send one prompt from the current context of a sentence, updating its context, tokens and log
+
+        ### inputs:
+        # state: the sentence being extracted [SentenceState]
+        # name: the cascade step this prompt belongs to, e.g. 'P1' or 'F3' [str]
+        # user_message: the prompt given by the user [str]
+        # append: whether the model answer should be appended to the context [Bool] (default True)
+        # error: the log message if the call fails, formatted with the exception as {e} [str] (default None)
+        # params: sampling parameters for this call only (see catmining.multiturn_helpers.prompt) [dict] (default None)
+
+        ### outputs:
+        # ans: the LLM response, or None if the call failed [str]
+
+        try:
+            ans, state.context, state.in_tkn, state.out_tkn, state.log = prompt(
+                self.model_type, self.client, state.context, self.chat, self.paper['System Prompt'],
+                user_message, state.in_tkn, state.out_tkn, state.log, append=append, stage=name, params=params)
+        except BudgetExceeded:
+            # not a failed call: the whole run stops
+            raise
+        except Exception as e:
+            if error is None:
+                error = f'{name} encountered some error: {{e}}.'
+            state.log = write_log(state.context, state.log, message=error.format(e=e), verbose=True)
+            return None
+
+        return ans
+
+    def ask_verdict(self, state, name, material, user_message, append=True, error=None):
+
+        ### ask a yes/no question about a material name (AR1, F1, F2), reusing the verdict of the installed store
+        # if the name was already asked about; see ask for the inputs and outputs
+
+        store = verdict_store()
+        key = None
+        if store is not None:
+            key = store.key(name, material, as_backend(self.client, self.model_type).model, self.paper['System Prompt'],
+                            self.paper['Source'], self.paper['Property'], self.chat)
+        if key is not None:
+            ans = store.get(name, key)
+            if ans is not None:
+                # the conversation continues as if the question had been asked
+                state.context = replay(self.model_type, state.context, self.chat, self.paper['System Prompt'], user_message, ans, append=append)
+                self.note(state, f'{name} answer for "{material}" reused from the verdict store.')
+                count_replayed(name)
+                return ans
+
+        ans = self.ask(state, name, user_message, append=append, error=error)
+        if key is not None and ans is not None:
+            store.put(name, key, material, ans)
+
+        return ans
+
+    def note(self, state, message):
+
+        ### add the current context and a message to the log of a sentence
+
+        state.log = write_log(state.context, state.log, message=message)
+
+    def flush(self, state):
+
+        ### hand the log entries of a sentence collected so far to the log sink
+
+        if self.log_sink is not None and state.log:
+            self.log_sink(state.s, state.log)
+            state.log = []
+
+    def run(self, s):
+
+        ### run the cascade on one candidate sentence
+
+        ### inputs:
+        # s: the index of the target sentence in the paper [int]
+
+        ### outputs:
+        # extracted_records: all the records that were extracted from this sentence, unless taken by the record sink [dict]
+        # log: the conversation log for this sentence, unless taken by the log sink [list]
+        # in_tkn: the # of input tokens passed for this sentence [int]
+        # out_tkn: the # of output tokens produced for this sentence [int]
+        # rcounts: the # of materials considered for this sentence [int]
+
+        paper = self.paper
+        sentences = paper['Sentences']
+        target_dict = paper['Targets']
+        property = paper['Property']
+
+        # reset the context window with or without a system prompt
+        context = Conversation()
+        if self.model_type == 'OpenAI': # append system prompt to context if we're using OpenAI
+            context = context.append({"role": "system", "content": paper['System Prompt']})
+
+        # define excerpts for Prompts 3 and 4
+        excerpt_p3 = _excerpt(paper, s, target_dict['Properties'][0]['Context Params'])
+        excerpts_p4 = []
+        for i in range(len(target_dict['Operating Conditions'])):
+            excerpt_p4 = _excerpt(paper, s, target_dict['Operating Conditions'][i]['Context Params'])
+            excerpts_p4.append(excerpt_p4)
+
+        state = SentenceState(s, sentences[s], context, excerpt_p3, excerpts_p4, self.new_records())
+        self._run_sentence(state, property)
+        self.flush(state)
+        if self.record_sink is not None:
+            self.record_sink(state.extracted_records)
+            state.extracted_records = self.new_records()
+
+        return state.extracted_records, state.log, state.in_tkn, state.out_tkn, state.rcounts
+
+    def _run_sentence(self, state, property):
+
+        ### PROMPT 1
+        user_message = prompt1.format(property=property) + state.sentence
+        p1_ans = self.paper.get('P1 Answers', {}).get(state.s)
+        if p1_ans is not None:
+            # Prompt 1 was already answered for every property at once (see classify_sentence), so the
+            # conversation continues as if it had been asked for this property alone
+            state.context = replay(self.model_type, state.context, self.chat, self.paper['System Prompt'], user_message, p1_ans)
+        else:
+            p1_ans = self.ask(state, 'P1', user_message, error="Prompt 1 encountered some error: {e}. skipping to the next sentence.")
+            if p1_ans is None:
+                return
+
+        # skip if negatively classified
+        if 'no' in p1_ans.strip().lower():
+            self.note(state, "Moving to next sentence...")
+            state.log.append(" ")
+            return
+        count_funnel('P1 Yes')
+
+        ### PROMPT 2
+        user_message = prompt2.format(property=property) + state.sentence
+        p2_ans = self.ask(state, 'P2', user_message, error="Prompt 2 encountered some error: {e}. skipping to the next sentence.")
+        if p2_ans is None:
+            return
+
+        # if no property values are extracted, skip the sentence
+        if 'none' == p2_ans.strip().lower():
+            self.note(state, f'Skipping sentence {state.s} because no {property} was extracted')
+            state.log.append(" ")
+            return
+
+        # save checkpoint
+        context_p2 = state.context
+
+        # parse property values and remove duplicates
+        vals = list(dict.fromkeys(p2_ans.split(';')))
+        count_funnel('Values', len(vals))
+
+        # for each value...
+        for val in vals:
+
+            # screen out values that are named "None" or blank spaces
+            # this often happens with, e.g., GPT-3.5 Turbo
+            if val.strip().lower() == 'none':
+                self.note(state, 'Skipped an invalid property value')
+                state.log.append(" ")
+                continue
+
+            # load context from last checkpoint
+            state.context = context_p2
+
+            self._run_value(state, property, val)
+
+        state.log.append(f'Extracted sentence {state.s}')
+        state.log.append(" ")
+
+    def _run_value(self, state, property, val):
+
+        ### PROMPT 3
+        user_message = prompt3.format(property=property, property_value=val) + state.excerpt_p3
+        p3_ans = self.ask(state, 'P3', user_message, error="Prompt 3 encountered some error: {e}. skipping to the next property value.")
+        if p3_ans is None:
+            return
+
+        # save checkpoint
+        context_p3 = state.context
+        self.flush(state)
+
+        # if there are no materials associated with this value, go to the next one
+        if 'none' == p3_ans.strip().lower():
+            self.note(state, f'Skipped {val} because there are no materials.')
+            return
+
+        # for each material name...
+        for mat in p3_ans.split(';'):
+
+            # skip if the material name is not valid
+            if (mat.strip().lower() == 'none') or (mat.strip().lower() == ''):
+                self.note(state, f'Skipped {mat} because it is not a valid material name.')
+                continue
+
+            # count the number of materials extracted
+            state.rcounts += 1
+            count_funnel('Materials')
+
+            # the material and everything learned about it so far, handed from stage to stage
+            item = {'Value': val, 'Material': mat, 'Checkpoint': context_p3, 'Follow-ups': {},
+                    'Conditions': [_new_condition(name) for name in self.paper['Operating Conditions']]}
+
+            for stage in self.stages:
+                passed = stage.run(self, state, item)
+                self.flush(state)
+                if not passed:
+                    break
+
+
+class StructuredCascade(Cascade):
+
+    ### single-call alternative to Prompts 1-4: every record of a sentence is asked for at once, as JSON, over one
+    # excerpt wide enough for the property and every operating condition. records that the model is less confident
+    # about than confidence_threshold go through the follow-up stages; the others are recorded right away.
+    # the records have the same columns as those of the cascade, so both can be scored on the same test set.
+
+    ### inputs:
+    # see Cascade; stages are the follow-up stages, ending in a record stage (see build_stages)
+    # confidence_threshold: records below this self-reported confidence are checked with the follow-ups [float] (default 0.8)
+    # max_tokens: the longest answer allowed for the JSON call [int] (default 1000)
+
+    def __init__(self, paper, client, model_type, stages, chat=True, log_sink=None, record_sink=None,
+                 confidence_threshold=0.8, max_tokens=1000):
+
+        super().__init__(paper, client, model_type, stages, chat=chat, log_sink=log_sink, record_sink=record_sink)
+        self.confidence_threshold = confidence_threshold
+        self.max_tokens = max_tokens
+
+        targets = paper['Targets']['Properties'] + paper['Targets']['Operating Conditions']
+        self.window = {'Bounds': [max(target['Context Params']['Bounds'][0] for target in targets),
+                                  max(target['Context Params']['Bounds'][1] for target in targets)],
+                       'Title': any(target['Context Params']['Title'] == True for target in targets)}
+        self.schema = records_schema(paper['Operating Conditions'])
+
+    def _run_sentence(self, state, property):
+
+        conditions = self.paper['Operating Conditions']
+
+        # a sentence the joint Prompt 1 said "No" to has nothing to extract
+        p1_ans = self.paper.get('P1 Answers', {}).get(state.s)
+        if p1_ans is not None and 'no' in p1_ans.strip().lower():
+            self.note(state, "Moving to next sentence...")
+            state.log.append(" ")
+            return
+
+        ### STRUCTURED PROMPT
+        user_message = (prompt_json.format(property=property, operating_conditions=', '.join(f'"{name}"' for name in conditions))
+                        + f'Sentence: {state.sentence}\n\nPassage: {_excerpt(self.paper, state.s, self.window)}')
+        ans = self.ask(state, 'JSON', user_message, error="The structured prompt encountered some error: {e}. skipping to the next sentence.",
+                       params={'max_tokens': self.max_tokens, 'json_schema': self.schema})
+        if ans is None:
+            return
+
+        records = _parse_records(ans, conditions)
+        if records is None:
+            self.note(state, f'Skipping sentence {state.s} because the answer is not valid JSON')
+            state.log.append(" ")
+            return
+        if not records:
+            self.note(state, f'Skipping sentence {state.s} because no {property} was extracted')
+            state.log.append(" ")
+            return
+        count_funnel('P1 Yes')
+        count_funnel('Values', len({record['value'] for record in records}))
+
+        # save checkpoint
+        checkpoint = state.context
+        self.flush(state)
+
+        for record in records:
+
+            state.rcounts += 1
+            count_funnel('Materials')
+
+            item = {'Value': record['value'], 'Material': record['material'], 'Checkpoint': checkpoint, 'Follow-ups': {},
+                    'Conditions': [_new_condition(name) for name in conditions]}
+            for condition in item['Conditions']:
+                condition['Value'] = record['conditions'][condition['Name']]
+                condition['Context'] = checkpoint
+
+            # only the records the model is unsure about are followed up on
+            stages = self.stages if record['confidence'] < self.confidence_threshold else self.stages[-1:]
+            for stage in stages:
+                passed = stage.run(self, state, item)
+                self.flush(state)
+                if not passed:
+                    break
+
+        state.log.append(f'Extracted sentence {state.s}')
+        state.log.append(" ")
+
+
+def records_schema(conditions):
+
+    ### the JSON schema of the answer to the structured prompt, for the given operating conditions
+
+    record = {'type': 'object',
+              'properties': {'value': {'type': 'string'}, 'material': {'type': 'string'},
+                             'conditions': {'type': 'object', 'properties': {name: {'type': 'string'} for name in conditions},
+                                            'required': list(conditions), 'additionalProperties': False},
+                             'confidence': {'type': 'number'}},
+              'required': ['value', 'material', 'conditions', 'confidence'], 'additionalProperties': False}
+
+    return {'type': 'object', 'properties': {'records': {'type': 'array', 'items': record}},
+            'required': ['records'], 'additionalProperties': False}
+
+
+def _parse_records(ans, conditions):
+
+    ### read the records from the answer to the structured prompt, or None if it holds no JSON object
+    # records without a value or material are dropped; missing conditions are "None" and a missing confidence is 0,
+    # so that such a record is followed up on
+
+    start = ans.find('{')
+    end = ans.rfind('}')
+    if start == -1 or end < start:
+        return None
+    try:
+        answer = json.loads(ans[start:end+1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(answer, dict) or not isinstance(answer.get('records'), list):
+        return None
+
+    records = []
+    for record in answer['records']:
+        if not isinstance(record, dict):
+            continue
+        value = str(record.get('value') or '').strip()
+        material = str(record.get('material') or '').strip()
+        if value.lower() in ('', 'none') or material.lower() in ('', 'none'):
+            continue
+        found = record.get('conditions') if isinstance(record.get('conditions'), dict) else {}
+        try:
+            confidence = float(record.get('confidence', 0))
+        except (TypeError, ValueError):
+            confidence = 0.0
+        records.append({'value': value, 'material': material, 'confidence': confidence,
+                        'conditions': {name: str(found.get(name) or 'None').strip() or 'None' for name in conditions}})
+
+    return records
+
+
+def joint_candidates(papers):
+
+    ### find the sentences that pass the required-phrase filter of more than one property
+
+    ### inputs:
+    # papers: the parsed paper for each property being extracted from the same source, keyed by property index [dict]
+
+    ### outputs:
+    # candidates: the property indices to classify jointly, keyed by sentence index [dict]
+
+    candidates = {}
+    for i, paper in papers.items():
+        for s in paper['Candidates']:
+            candidates.setdefault(s, []).append(i)
+
+    return {s: indices for s, indices in sorted(candidates.items()) if len(indices) > 1}
+
+
+def classify_sentence(papers, s, indices, client, model_type):
+
+    ### ask Prompt 1 for several properties of one sentence in a single call
+
+    ### inputs:
+    # papers: the parsed paper for each property, keyed by property index [dict]
+    # s: the index of the target sentence in the paper [int]
+    # indices: the property indices to classify [list]
+    # client: the LLM client (Azure, Bedrock, or Fireworks)
+    # model_type: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+
+    ### outputs:
+    # answers: "Yes" or "No" for each property index that was answered; missing properties fall back on Prompt 1 [dict]
+    # log: the conversation log of the call [list]
+    # in_tkn: the # of input tokens passed [int]
+    # out_tkn: the # of output tokens produced [int]
+
+    properties = [papers[i]['Property'] for i in indices]
+    sentence = papers[indices[0]]['Sentences'][s]
+
+    # every property-specific system prompt applies, each included once
+    system_prompt = '\n\n'.join(dict.fromkeys(papers[i]['System Prompt'] for i in indices))
+
+    user_message = prompt1_multi.format(properties=json.dumps(properties, ensure_ascii=False)) + sentence
+    try:
+        ans, context, in_tkn, out_tkn, log = prompt(model_type, client, [], False, system_prompt, user_message, 0, 0, [], append=True, stage='P1')
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        log = write_log([], [], message=f"Joint Prompt 1 encountered some error: {e}. Asking Prompt 1 per property instead.", verbose=True)
+        return {}, log, 0, 0
+
+    verdicts = _parse_verdicts(ans)
+    answers = {}
+    for i, property in zip(indices, properties):
+        verdict = verdicts.get(property)
+        if isinstance(verdict, str) and verdict.strip().lower() in ('yes', 'no'):
+            answers[i] = verdict.strip().capitalize()
+
+    log = write_log(context, log, message=f'Joint Prompt 1 for sentence {s}: {answers}')
+
+    return answers, log, in_tkn, out_tkn
+
+
+def _parse_verdicts(ans):
+
+    # read the JSON object out of the answer, ignoring any text or code fences around it
+    start = ans.find('{')
+    end = ans.rfind('}')
+    if start == -1 or end < start:
+        return {}
+    try:
+        verdicts = json.loads(ans[start:end+1])
+    except json.JSONDecodeError:
+        return {}
+
+    return verdicts if isinstance(verdicts, dict) else {}
+
+
+def _excerpt(paper, s, params):
+
+    ### the excerpt of sentence s for a context window, from the excerpt index the properties of a paper share
+    # (see catmining.multiturn_helpers.ExcerptIndex)
+
+    excerpts = paper.get('Excerpts')
+    if excerpts is None:
+        return getexcerpt(paper['Title'], paper['Sentences'], s, params)
+
+    return excerpts.get(s, params)
+
+
+def _ips_excerpt(paper, i, s):
+
+    ### the IPS excerpt of operating condition i for sentence s
+    # the index of a condition is built the first time IPS is needed and then kept with the paper
+
+    phrases = paper['Required Condition Phrases'][i]
+    index = paper['IPS Index'].get(repr(phrases))
+    if index is None:
+        index = paper['IPS Index'].setdefault(repr(phrases), IPSIndex(paper['Sentences'], phrases, paper['Phrase Hits']))
+
+    return index.render(s)
+
+
+def _new_condition(name):
+
+    ### the operating condition fields of a material before Prompt 4 is asked
+
+    return {'Name': name, 'Value': 'None', 'Context': None, 'IPS Value': 'None', 'IPS Context': None,
+            'IPS Excerpt': 'None', 'F4 Response': 'None', 'F4-IPS Response': 'None'}
+
+
+class Stage(ABC):
+
+    ### one step of the cascade applied to each material named by Prompt 3
+    # run() returns True to pass the material on to the next stage and False to drop it
+
+    name = ''
+
+    @abstractmethod
+    def run(self, cascade, state, item):
+        pass
+
+
+def _run_branches(jobs, state, stop_early=False):
+
+    ### run branches of the cascade that do not depend on each other at the same time, each on a fork of the state
+
+    ### inputs:
+    # jobs: functions called with a fork of the state, returning whether the material passes [list of function]
+    # state: the sentence being extracted [SentenceState]
+    # stop_early: stop once any branch drops the material; branches that have not started are cancelled and the
+    #             answers still in flight are waited for, then discarded [Bool] (default False)
+
+    ### outputs:
+    # passed: whether every branch passed the material [Bool]
+
+    branches = [state.fork() for _ in jobs]
+    pool = ThreadPoolExecutor(max_workers=len(jobs))
+    futures = [pool.submit(job, branch) for job, branch in zip(jobs, branches)]
+    decided = set()
+    passed = True
+    try:
+        for future in as_completed(futures):
+            decided.add(future)
+            if not future.result():
+                passed = False
+                if stop_early:
+                    break
+    finally:
+        # no branch outlives the decision, so none of them spends tokens or touches the material afterwards
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    # the logs and tokens of the branches the decision was made on are kept in stage order, as if they had run one
+    # after another. a discarded answer still cost its tokens, but its conversation and log are dropped
+    for future, branch in zip(futures, branches):
+        if future in decided:
+            state.merge(branch)
+        elif not future.cancelled():
+            state.in_tkn += branch.in_tkn
+            state.out_tkn += branch.out_tkn
+
+    return passed
+
+
+class ParallelStages(Stage):
+
+    ### stages that all start from the material checkpoint and do not need each other's answers, sent at the same time
+    # as in the serial cascade, the material is dropped if any of them drops it; in that case, the stages that are
+    # still waiting to be sent are cancelled
+
+    ### inputs:
+    # stages: the stages to run, in the order they would run one after another [list]
+
+    def __init__(self, stages):
+
+        self.stages = stages
+        self.name = '+'.join(stage.name for stage in stages)
+
+    def run(self, cascade, state, item):
+
+        jobs = [lambda branch, stage=stage: stage.run(cascade, branch, item) for stage in self.stages]
+
+        return _run_branches(jobs, state, stop_early=True)
+
+
+class AbbreviationResolution(Stage):
+
+    ### ask whether the material name is an abbreviation (AR1) and, if so, resolve it from the paper (AR2)
+    # the conversation including AR1/AR2 becomes the checkpoint for all later stages
+
+    name = 'AR'
+
+    def run(self, cascade, state, item):
+
+        mat = item['Material']
+
+        # load context from last checkpoint
+        state.context = item['Checkpoint']
+
+        ### ABBREVIATION RESOLUTION
+        user_message = prompt_ar1.format(material=mat)
+        ar1_ans = cascade.ask_verdict(state, 'AR1', mat, user_message, error="Prompt AR1 encountered some error: {e}. skipping to the next property value.")
+        if ar1_ans is None:
+            return False
+
+        if 'yes' in ar1_ans.strip().lower(): # if it is an abbreviation...
+
+            abbreviations = cascade.paper['Abbreviations']
+            if mat in abbreviations.resolved:
+                # this name was already resolved earlier in the paper, so the conversation continues with that answer.
+                # the log is the same as if it had been asked: which sentence asks first depends on how the
+                # sentences and properties of the paper are scheduled, and the log should not
+                user_message, ar2_ans = abbreviations.resolved[mat]
+                state.context = replay(cascade.model_type, state.context, cascade.chat, cascade.paper['System Prompt'], user_message, ar2_ans)
+
+            else:
+                # obtain context to resolve acronym
+                excerpt_ar2 = abbreviations.defs(mat)
+
+                ### ABBREVIATION RESOLUTION
+                user_message = prompt_ar2.format(material=mat) + excerpt_ar2
+                ar2_ans = cascade.ask(state, 'AR2', user_message, error="Prompt AR2 encountered some error: {e}. skipping to the next property value.")
+                if ar2_ans is None:
+                    return False
+                abbreviations.resolved[mat] = (user_message, ar2_ans)
+
+            # if we resolve the abbreviation, then replace with ar2_ans
+            if not 'none' == ar2_ans.strip().lower():
+                item['Material'] = ar2_ans
+
+        # save checkpoint
+        item['Checkpoint'] = state.context
+
+        return True
+
+
+class OperatingConditions(Stage):
+
+    ### ask for each operating condition (Prompt 4), falling back on inter-paragraph search if none is found
+
+    ### inputs:
+    # ips: whether to retry with inter-paragraph search when Prompt 4 answers "None" [Bool] (default True)
+    # separate_ips: keep the IPS answer next to the Prompt 4 answer instead of replacing it, as test mode
+    #               does [Bool] (default False)
+    # parallel: ask about all operating conditions at the same time [Bool] (default False)
+
+    name = 'P4'
+
+    def __init__(self, ips=True, separate_ips=False, parallel=False):
+
+        self.ips = ips
+        self.separate_ips = separate_ips
+        self.parallel = parallel
+
+    def run(self, cascade, state, item):
+
+        # every condition starts from the same checkpoint and only changes its own fields and excerpt
+        if self.parallel and len(item['Conditions']) > 1:
+            jobs = [lambda branch, i=i: self._run_condition(cascade, branch, item, i) for i in range(len(item['Conditions']))]
+            return _run_branches(jobs, state)
+
+        # for each target operating condition...
+        for i in range(len(item['Conditions'])):
+            self._run_condition(cascade, state, item, i)
+
+        return True
+
+    def _run_condition(self, cascade, state, item, i):
+
+        ### ask Prompt 4 (and IPS, if needed) for operating condition i of a material
+
+        paper = cascade.paper
+        mat = item['Material']
+        val = item['Value']
+        condition = item['Conditions'][i]
+
+        # load context from last checkpoint
+        state.context = item['Checkpoint']
+
+        ### PROMPT 4 NO IPS
+        user_message = prompt4.format(operating_condition=condition['Name'], material=mat, property=paper['Property'], property_value=val) + state.excerpts_p4[i]
+        p4_ans = cascade.ask(state, 'P4', user_message, error="Prompt 4 encountered some error: {e}. skipping to the next operating condition.")
+        if p4_ans is None:
+            condition['Value'] = 'Error'
+            return True
+
+        if self.separate_ips:
+            # save checkpoint
+            condition['Value'] = p4_ans
+            condition['Context'] = state.context
+
+        # if we extracted nothing...
+        if self.ips and 'none' == p4_ans.strip().lower() and budget_allows('IPS'):
+
+            excerpt_ips = _ips_excerpt(paper, i, state.s)
+            if self.separate_ips:
+                condition['IPS Excerpt'] = excerpt_ips
+            else:
+                # replace excerpt 4 with the excerpt retrieved via IPS, for the rest of the sentence
+                state.excerpts_p4[i] = excerpt_ips
+
+            # load context from last checkpoint
+            state.context = item['Checkpoint']
+
+            ### PROMPT 4 IPS -- using a different prompt than the original Prompt 4
+            user_message = prompt4_ips.format(operating_condition=condition['Name'], material=mat, property=paper['Property'], property_value=val) + excerpt_ips
+            p4_ans = cascade.ask(state, 'P4-IPS', user_message, error="Prompt 4-IP encountered some error: {e}. skipping to the next material.")
+            if p4_ans is None:
+                condition['IPS Value' if self.separate_ips else 'Value'] = 'Error'
+                return True
+
+            if self.separate_ips:
+                # save checkpoint
+                condition['IPS Value'] = p4_ans
+                condition['IPS Context'] = state.context
+
+        # save p4_ans and the current chat state
+        if not self.separate_ips:
+            condition['Value'] = p4_ans
+            condition['Context'] = state.context
+
+        return True
+
+
+class FollowUp(Stage):
+
+    ### ask one of the material-level follow-up prompts (F1, F2 or F3) from the last checkpoint
+
+    ### inputs:
+    # number: which follow-up prompt to ask (1, 2 or 3) [int]
+    # strict: drop the material if the answer is "No"; test mode only records the answer [Bool] (default True)
+
+    def __init__(self, number, strict=True):
+
+        self.number = number
+        self.strict = strict
+        self.name = f'F{number}'
+
+    def run(self, cascade, state, item):
+
+        # materials are kept unverified once the budget no longer allows follow-ups
+        if not budget_allows('Follow-ups'):
+            return True
+
+        mat = item['Material']
+        val = item['Value']
+        property = cascade.paper['Property']
+
+        # load context from the checkpoint
+        state.context = item['Checkpoint']
+
+        if self.number == 1:
+            ### FOLLOW-UP PROMPT 1
+            user_message = promptf1.format(material=mat)
+            rejection = f'Skipped {mat} because it is incomplete.'
+        elif self.number == 2:
+            ### FOLLOW-UP PROMPT 2
+            user_message = promptf2.format(material=mat)
+            rejection = f'Skipped {mat} because it is not specific.'
+        else:
+            ### FOLLOW-UP PROMPT 3
+            if cascade.chat == True:
+                user_message = promptf3.format(material=mat, property=property, property_value=val)
+            else:
+                user_message = promptf3_nochat.format(material=mat, property=property, property_value=val) + state.excerpt_p3
+            rejection = f'Threw out {mat}, {val}.'
+
+        error = f"Follow-up {self.number} encountered some error: {{e}}. skipping to the next material."
+        if self.number in (1, 2):
+            # F1 and F2 only ask about the material name
+            ans = cascade.ask_verdict(state, self.name, mat, user_message, append=False, error=error)
+        else:
+            ans = cascade.ask(state, self.name, user_message, append=False, error=error)
+        if ans is None:
+            return False
+        item['Follow-ups'][self.number] = ans
+
+        if 'no' in ans.strip().lower():
+            cascade.note(state, rejection)
+            if self.strict:
+                return False
+
+        return True
+
+
+class ConditionFollowUp(Stage):
+
+    ### ask whether each extracted operating condition is correct (F4)
+
+    ### inputs:
+    # strict: replace a rejected condition with "None"; test mode only records the answers [Bool] (default True)
+
+    name = 'F4'
+
+    def __init__(self, strict=True):
+
+        self.strict = strict
+
+    def run(self, cascade, state, item):
+
+        if not budget_allows('Follow-ups'):
+            return True
+
+        for i, condition in enumerate(item['Conditions']):
+
+            if not 'none' == condition['Value'].strip().lower() and condition['Context'] is not None:
+
+                # load context from P4 checkpoint
+                state.context = condition['Context']
+
+                ### FOLLOW-UP PROMPT 4
+                pf4_ans = self._ask(cascade, state, item, condition, condition['Value'], state.excerpts_p4[i])
+                if not self.strict:
+                    condition['F4 Response'] = 'Error' if pf4_ans is None else pf4_ans
+                if pf4_ans is None:
+                    continue
+                if 'no' in pf4_ans.strip().lower(): # if the nested property doesn't match...
+                    cascade.note(state, f"Threw out {condition['Value']}.")
+                    if self.strict:
+                        condition['Value'] = 'None'
+
+            # test mode also checks the condition retrieved via IPS
+            if not self.strict and not 'none' == condition['IPS Value'].strip().lower() and condition['IPS Context'] is not None:
+
+                # load context from IPS checkpoint
+                state.context = condition['IPS Context']
+
+                ### FOLLOW-UP PROMPT 4 IPS
+                pf4_ips_ans = self._ask(cascade, state, item, condition, condition['IPS Value'], condition['IPS Excerpt'])
+                condition['F4-IPS Response'] = 'Error' if pf4_ips_ans is None else pf4_ips_ans
+
+        return True
+
+    def _ask(self, cascade, state, item, condition, condition_value, excerpt):
+
+        fields = {'material': item['Material'], 'property': cascade.paper['Property'], 'property_value': item['Value'],
+                  'operating_condition': condition['Name'], 'operating_condition_value': condition_value}
+        if cascade.chat == True:
+            user_message = promptf4.format(**fields)
+        else:
+            user_message = promptf4_nochat.format(**fields) + excerpt
+
+        return cascade.ask(state, self.name, user_message, append=False, error="Follow-up 4 encountered some error: {e}. skipping to the next material.")
+
+
+class Records(Stage):
+
+    ### add the material that passed every stage to the extracted records
+
+    name = 'Record'
+
+    def new_records(self, paper):
+
+        ### initialize an empty dictionary of outputs for a paper
+
+        extracted_records = {'Source': [], 'Sentence': [], 'Property': [],
+                             'Property Value': [], 'Material': []}
+
+        for i, _ in enumerate(paper['Operating Conditions']):
+            extracted_records[f'Operating Condition {i+1}'] = []
+            extracted_records[f'Operating Condition {i+1} Value'] = []
+
+        return extracted_records
+
+    def run(self, cascade, state, item):
+
+        # update the record list
+        records = state.extracted_records
+        records['Source'].append(cascade.paper['Source'])
+        records['Sentence'].append(state.sentence)
+        records['Property'].append(cascade.paper['Property'])
+        records['Property Value'].append(item['Value'].strip())
+        records['Material'].append(item['Material'].strip())
+
+        for i, condition in enumerate(item['Conditions']):
+            records[f'Operating Condition {i+1}'].append(condition['Name'])
+            records[f'Operating Condition {i+1} Value'].append(condition['Value'])
+
+        # update log
+        cascade.note(state, f"Extracted {item['Material']}, {item['Value']}.")
+        count_funnel('Records Kept')
+
+        return True
+
+
+class TestModeRecords(Records):
+
+    ### record a material along with every follow-up response and the separate IPS answers, as test mode does
+
+    def new_records(self, paper):
+
+        extracted_records = {'Source': [], 'Sentence': [], 'Property': [],
+                             'Property Value': [], 'Material': [], 'F1 Response': [],
+                             'F2 Response': [], 'F3 Response': []}
+
+        for i, _ in enumerate(paper['Operating Conditions']):
+            extracted_records[f'Operating Condition {i+1}'] = []
+            extracted_records[f'Operating Condition {i+1} Value'] = []
+            extracted_records[f'Operating Condition {i+1} Value (IPS)'] = []
+            extracted_records[f'Operating Condition {i+1} F4 Response'] = []
+            extracted_records[f'Operating Condition {i+1} F4-IPS Response'] = []
+
+        return extracted_records
+
+    def run(self, cascade, state, item):
+
+        records = state.extracted_records
+        for number in [1, 2, 3]:
+            records[f'F{number} Response'].append(item['Follow-ups'].get(number, 'None').strip())
+
+        for i, condition in enumerate(item['Conditions']):
+            records[f'Operating Condition {i+1} Value (IPS)'].append(condition['IPS Value'])
+            records[f'Operating Condition {i+1} F4 Response'].append(condition['F4 Response'])
+            records[f'Operating Condition {i+1} F4-IPS Response'].append(condition['F4-IPS Response'])
+
+        return super().run(cascade, state, item)
+
+
+def build_stages(mode='default', FOLLOWUP=[3], IPS=True, PARALLEL=False):
+
+    ### assemble the material-level stages of a CatMiner mode
+
+    ### inputs:
+    # mode: 'default', 'abbreviation_resolution', 'test_mode', or 'structured' [str] (default 'default')
+    # FOLLOWUP: the follow-up prompts to apply (any of 1-4); test mode applies all of them if FOLLOWUP is True [list]
+    # IPS: whether to use inter-paragraph search as a backup if operating conditions are not found [Bool] (default True)
+    # PARALLEL: whether to send follow-ups 1-3, and Prompt 4 for each operating condition, at the same time [Bool] (default False)
+
+    ### outputs:
+    # stages: the stages to pass to Cascade [list]
+
+    stages = []
+    if mode == 'abbreviation_resolution':
+        stages.append(AbbreviationResolution())
+
+    if mode == 'test_mode':
+        followups = [1, 2, 3, 4] if FOLLOWUP == True else []
+        strict = False
+    else:
+        followups = FOLLOWUP
+        strict = True
+
+    # the structured engine already has the operating conditions (see StructuredCascade)
+    if mode != 'structured':
+        stages.append(OperatingConditions(ips=IPS, separate_ips=not strict, parallel=PARALLEL))
+    material_followups = [FollowUp(number, strict=strict) for number in [1, 2, 3] if number in followups]
+    if PARALLEL and len(material_followups) > 1:
+        stages.append(ParallelStages(material_followups))
+    else:
+        stages.extend(material_followups)
+    if 4 in followups:
+        stages.append(ConditionFollowUp(strict=strict))
+
+    stages.append(Records() if strict else TestModeRecords())
+
+    return stages
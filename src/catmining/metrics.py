@@ -0,0 +1,159 @@
+import threading
+import math
+import time
+import json
+
+
+# the cascade steps, in the order they are asked ('JSON' is the single call of the structured engine); calls made
+# outside a named step are counted under 'Other'
+STAGES = ['JSON', 'P1', 'P2', 'P3', 'AR1', 'AR2', 'P4', 'P4-IPS', 'F1', 'F2', 'F3', 'F4']
+
+# how many sentences, values, and materials survive each step of the cascade; the sentences of a paper are scanned
+# once for all properties, and from 'Phrase-Filtered' on a sentence counts once for each property it is a candidate of
+FUNNEL = ['Sentences Scanned', 'Phrase-Filtered', 'Pre-Ranked', 'P1 Yes', 'Values', 'Materials', 'Records Kept']
+
+
+def _percentile(ordered, q):
+
+    # nearest-rank percentile of a sorted list
+    if not ordered:
+        return None
+
+    return ordered[max(0, math.ceil(q/100*len(ordered)) - 1)]
+
+
+class Metrics:
+
+    ### per-stage call counts, latencies, tokens, and errors of a run, plus the extraction funnel
+    # latencies are those of the model calls themselves, without the time spent waiting on the rate limiter,
+    # which is counted apart. calls answered from a transcript or the response cache count as replayed.
+
+    def __init__(self):
+
+        self.started = time.monotonic()
+        self.stages = {}
+        self.funnel = {step: 0 for step in FUNNEL}
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _stage(self, stage):
+
+        if stage not in self.stages:
+            self.stages[stage] = {'Calls': 0, 'Replayed': 0, 'Errors': 0, 'Input Tokens': 0, 'Output Tokens': 0, 'Latencies': []}
+
+        return self.stages[stage]
+
+    def observe(self, stage, seconds=None, in_tkns=0, out_tkns=0, error=False, replayed=False):
+
+        ### count one call of a cascade stage
+
+        ### inputs:
+        # stage: the cascade step, e.g. 'P1' or 'F3', or None [str]
+        # seconds: how long the model took to answer [float] (default None)
+        # in_tkns: the input tokens of the call [int] (default 0)
+        # out_tkns: the output tokens of the call [int] (default 0)
+        # error: whether the call failed [Bool] (default False)
+        # replayed: whether the call was answered without the model [Bool] (default False)
+
+        with self._lock:
+            counts = self._stage(stage or 'Other')
+            counts['Calls'] += 1
+            counts['Replayed'] += int(replayed)
+            counts['Errors'] += int(error)
+            counts['Input Tokens'] += in_tkns
+            counts['Output Tokens'] += out_tkns
+            if seconds is not None:
+                counts['Latencies'].append(seconds)
+
+    def wait(self, seconds):
+
+        ### count time spent waiting on the rate limiter
+
+        with self._lock:
+            self.wait_seconds += seconds
+
+    def count(self, step, n=1):
+
+        ### advance a step of the funnel
+
+        with self._lock:
+            self.funnel[step] = self.funnel.get(step, 0) + n
+
+    def report(self):
+
+        ### the metrics of the run so far
+
+        ### outputs:
+        # report: 'Stages' (counts, tokens, and p50/p95/p99 latencies in seconds of each stage asked), 'Funnel',
+        #         'Limiter Wait Seconds', and 'Wall Seconds' [dict]
+
+        with self._lock:
+            stages = {}
+            order = [stage for stage in STAGES if stage in self.stages] + sorted(set(self.stages) - set(STAGES))
+            for stage in order:
+                counts = self.stages[stage]
+                latencies = sorted(counts['Latencies'])
+                stages[stage] = {key: value for key, value in counts.items() if key != 'Latencies'}
+                stages[stage].update({'Latency p50': _percentile(latencies, 50), 'Latency p95': _percentile(latencies, 95),
+                                      'Latency p99': _percentile(latencies, 99), 'Latency Total': sum(latencies)})
+
+            return {'Stages': stages, 'Funnel': dict(self.funnel), 'Limiter Wait Seconds': self.wait_seconds,
+                    'Wall Seconds': time.monotonic() - self.started}
+
+    def write_json(self, path):
+
+        with open(path, mode='w', encoding='utf8') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def prometheus(self):
+
+        ### the report in the Prometheus text exposition format
+
+        report = self.report()
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append(f'# HELP catmining_{name} {description}')
+            lines.append(f'# TYPE catmining_{name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f'catmining_{name}{{{label_text}}} {value}' if label_text else f'catmining_{name} {value}')
+
+        stages = report['Stages']
+        family('calls_total', 'counter', 'LLM calls per cascade stage.', [({'stage': s}, c['Calls']) for s, c in stages.items()])
+        family('replayed_calls_total', 'counter', 'Calls answered from a transcript or the response cache.',
+               [({'stage': s}, c['Replayed']) for s, c in stages.items()])
+        family('errors_total', 'counter', 'Failed LLM calls per cascade stage.', [({'stage': s}, c['Errors']) for s, c in stages.items()])
+        family('tokens_total', 'counter', 'LLM tokens per cascade stage.',
+               [({'stage': s, 'direction': 'input'}, c['Input Tokens']) for s, c in stages.items()] +
+               [({'stage': s, 'direction': 'output'}, c['Output Tokens']) for s, c in stages.items()])
+        family('latency_seconds', 'summary', 'Model latency per cascade stage.',
+               [({'stage': s, 'quantile': q}, c[f'Latency p{p}']) for s, c in stages.items()
+                for q, p in [('0.5', 50), ('0.95', 95), ('0.99', 99)] if c[f'Latency p{p}'] is not None])
+        family('funnel_total', 'counter', 'Sentences, values, and materials surviving each step of the cascade.',
+               [({'step': step}, n) for step, n in report['Funnel'].items()])
+        family('limiter_wait_seconds_total', 'counter', 'Time spent waiting on the rate limiter.', [({}, report['Limiter Wait Seconds'])])
+        family('wall_seconds', 'gauge', 'Wall time of the run.', [({}, report['Wall Seconds'])])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+
+        with open(path, mode='w', encoding='utf8') as f:
+            f.write(self.prometheus())
+
+    def summary(self):
+
+        ### a few lines describing where the calls, tokens, and time of the run went
+
+        report = self.report()
+        lines = ['Funnel: ' + ' -> '.join(f'{step} {n}' for step, n in report['Funnel'].items())]
+        for stage, counts in report['Stages'].items():
+            line = (f"{stage}: {counts['Calls']} calls ({counts['Replayed']} replayed, {counts['Errors']} errors), "
+                    f"{counts['Input Tokens']} input / {counts['Output Tokens']} output tokens")
+            if counts['Latency p50'] is not None:
+                line += (f", latency p50 {counts['Latency p50']:.3f} s, p95 {counts['Latency p95']:.3f} s, "
+                         f"p99 {counts['Latency p99']:.3f} s")
+            lines.append(line + '.')
+
+        return '\n'.join(lines)
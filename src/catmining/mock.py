@@ -0,0 +1,394 @@
+from catmining.backends import Backend
+from catmining.multiturn_helpers import _message_text
+from catmining import prompts
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import random
+import gzip
+import json
+import time
+import re
+
+
+class MockError(Exception):
+
+    ### an error answered by the mock LLM; status_code 429 means throttled, like the provider errors (see catmining.retry.classify_error)
+
+    def __init__(self, status_code, message, retry_after=None):
+
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _fragment(template):
+
+    # the fixed text of a prompt before its first placeholder, which identifies the prompt in a request
+    return template.split('{', 1)[0]
+
+
+def _passage(text):
+
+    # the sentence, excerpt, or filtered article that CatMiner appends after the instructions
+    return text.split('\n\n', 1)[1] if '\n\n' in text else ''
+
+
+def _quoted(text):
+
+    # the first "quoted" name in a follow-up or abbreviation prompt
+    match = re.search(r'"([^"]*)"', text)
+
+    return match.group(1) if match else ''
+
+
+_VALUE = re.compile(r'[<>≈~—]?\s?\d+(?:\.\d+)?\s?(?:%|°C|K\b|bar\b|atm\b|MPa\b|kPa\b|h\b|min\b|s\b)?')
+_CONDITION = re.compile(r'\d+(?:\.\d+)?\s?(?:°C|K\b|bar\b|atm\b|MPa\b|kPa\b)')
+_MATERIAL = re.compile(r'\b[A-Z][A-Za-z0-9()\-–]*(?:[/@][A-Za-z0-9()\-–]+)+|\b(?:[A-Z][a-z]?\d*(?:\.\d+)?){2,}(?:\(\d\))?\b')
+
+
+def _list(matches):
+
+    matches = list(dict.fromkeys(match.strip() for match in matches))
+
+    return '; '.join(matches) if matches else 'None'
+
+
+def _default_answer(text):
+
+    ### a deterministic stand-in for the model's answer to each CatMiner prompt, from surface features of the passage
+    # properties are taken to be numbers, catalysts chemical-formula-like names, and conditions numbers with units
+
+    if _fragment(prompts.prompt1_multi) in text:
+        properties = json.loads(text.split('Properties: ', 1)[1].split('\n', 1)[0])
+        found = 'Yes' if re.search(r'\d', text.split('Text:', 1)[1]) else 'No'
+        return json.dumps({property: found for property in properties})
+
+    if text.startswith(_fragment(prompts.prompt_json)):
+        # the values and catalysts of the sentence, at the last condition of the passage; the mock is only sure of
+        # sentences that name one of each
+        names = json.loads('[' + text.split('operating conditions (', 1)[1].split(')', 1)[0] + ']')
+        sentence, passage = _passage(text).split('\n\nPassage: ', 1)
+        values = [match.strip() for match in _VALUE.findall(sentence) if '%' in match] or [match.strip() for match in _VALUE.findall(sentence)]
+        materials = list(dict.fromkeys(match.strip() for match in _MATERIAL.findall(sentence) or _MATERIAL.findall(passage)))
+        conditions = _CONDITION.findall(passage)
+        confidence = 0.9 if len(values) == 1 and len(materials) == 1 else 0.6
+        return json.dumps({'records': [{'value': value, 'material': material, 'confidence': confidence,
+                                        'conditions': {name: conditions[-1].strip() if conditions else 'None' for name in names}}
+                                       for value in dict.fromkeys(values) for material in materials]})
+
+    if _fragment(prompts.prompt1) in text:
+        return 'Yes' if re.search(r'\d', _passage(text)) else 'No'
+
+    if _fragment(prompts.prompt2) in text:
+        values = [match for match in _VALUE.findall(_passage(text)) if '%' in match] or _VALUE.findall(_passage(text))
+        return _list(values)
+
+    if _fragment(prompts.prompt3) in text:
+        return _list(_MATERIAL.findall(_passage(text)))
+
+    if text.startswith(_fragment(prompts.prompt4)):
+        conditions = _CONDITION.findall(_passage(text))
+        return conditions[-1].strip() if conditions else 'None'
+
+    if text.startswith(_fragment(prompts.prompt_ar1)) and 'abbreviation' in text:
+        return 'Yes' if re.search(r'[A-Z]{2,}', _quoted(text).replace('/', ' ')) and not re.search(r'\d', _quoted(text)) else 'No'
+
+    if text.startswith(_fragment(prompts.prompt_ar2)):
+        return 'None'
+
+    # F1-F4 verify earlier answers, which the mock always stands by
+    if 'Answer "Yes" or "No" only' in text:
+        return 'Yes'
+
+    return 'None'
+
+
+def load_transcript(path):
+
+    ### read recorded answers from a JSONL file with one {"Prompt": ..., "Answer": ...} object per line,
+    # such as the transcripts recorded by extract(transcript_path=...)
+
+    ### inputs:
+    # path: the transcript file [str]
+
+    ### outputs:
+    # transcript: the recorded answer of each prompt [dict]
+
+    transcript = {}
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, mode='rt', encoding='utf8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                transcript[entry['Prompt']] = entry['Answer']
+
+    return transcript
+
+
+class ScriptedResponder:
+
+    ### answers a prompt from scripted rules, then recorded transcripts, then the built-in CatMiner answers
+
+    ### inputs:
+    # rules: (pattern, answer) pairs tried in order; pattern is a regex searched in the prompt or a function of the
+    #        prompt, and answer is a string or a function of the prompt [list of tuple] (default None)
+    # transcript: recorded answers keyed by the exact prompt, e.g. from load_transcript [dict] (default None)
+    # default: answer other prompts with the built-in CatMiner answers, otherwise with "None" [bool] (default True)
+
+    def __init__(self, rules=None, transcript=None, default=True):
+
+        self.rules = [(re.compile(pattern) if isinstance(pattern, str) else pattern, answer) for pattern, answer in rules or []]
+        self.transcript = transcript or {}
+        self.default = default
+
+    def __call__(self, text):
+
+        for pattern, answer in self.rules:
+            matched = pattern.search(text) if isinstance(pattern, re.Pattern) else pattern(text)
+            if matched:
+                return answer(text) if callable(answer) else answer
+
+        if text in self.transcript:
+            return self.transcript[text]
+
+        return _default_answer(text) if self.default else 'None'
+
+
+class LoadProfile:
+
+    ### the latency, errors, and throttling of the mock LLM, reproducible from a seed
+
+    ### inputs:
+    # latency: mean seconds per call [float] (default 0.0)
+    # jitter: the latency varies uniformly by up to this many seconds either way [float] (default 0.0)
+    # error_rate: share of calls that fail with a 500 error [float] (default 0.0)
+    # throttle_rate: share of calls that are throttled with a 429 error [float] (default 0.0)
+    # requests_per_minute: calls over this quota are throttled like a provider would, or None for no quota [float] (default None)
+    # seed: seed of the random draws [int] (default 0)
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, requests_per_minute=None, seed=0):
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests_per_minute = requests_per_minute
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = requests_per_minute
+        self._refilled = time.monotonic()
+
+    def apply(self):
+
+        ### wait out the latency of one call, then raise the MockError it fails with, if any
+
+        with self._lock:
+            draw = self._random.random()
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+            over_quota = False
+            if self.requests_per_minute is not None:
+                now = time.monotonic()
+                self._tokens = min(self.requests_per_minute, self._tokens + (now - self._refilled)*self.requests_per_minute/60)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                else:
+                    over_quota = True
+
+        if over_quota:
+            raise MockError(429, 'Mock request quota exceeded.', retry_after=60/self.requests_per_minute)
+        if draw < self.throttle_rate:
+            raise MockError(429, 'Mock throttling.', retry_after=1.0)
+
+        time.sleep(delay)
+
+        if draw < self.throttle_rate + self.error_rate:
+            raise MockError(500, 'Mock server error.')
+
+
+def _count_tokens(text):
+
+    # about four characters per token, as in catmining.multiturn_helpers._estimate_tokens
+    return len(text)//4 + 1
+
+
+class FakeBackend(Backend):
+
+    ### in-process mock LLM; takes messages in either the 'OpenAI' or the 'Meta' format
+
+    ### inputs:
+    # responder: answers the last user prompt [ScriptedResponder or function] (default None, the built-in answers)
+    # profile: latency, errors, and throttling [LoadProfile] (default None, instant and error-free)
+    # model: the model name reported in the response cache keys [str] (default 'mock')
+    # params: see Backend [dict] (default None)
+
+    model_type = 'Mock'
+
+    def __init__(self, responder=None, profile=None, model='mock', params=None):
+
+        super().__init__(model, params)
+        self.responder = responder or ScriptedResponder()
+        self.profile = profile or LoadProfile()
+
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def complete(self, messages, system=None, params=None):
+
+        with self._lock:
+            self.calls += 1
+
+        try:
+            self.profile.apply()
+        except MockError as e:
+            with self._lock:
+                if e.status_code == 429:
+                    self.throttled += 1
+                else:
+                    self.errors += 1
+            raise
+
+        texts = [_message_text(message) for message in messages]
+        # like a model, the answer stops at max_tokens (about four characters per token)
+        text = self.responder(texts[-1])[:4*self._params(params)['max_tokens']]
+
+        return {'Text': text, 'Input Tokens': _count_tokens((system or '') + ''.join(texts)),
+                'Output Tokens': _count_tokens(text), 'Cached Tokens': 0, 'Written Tokens': 0}
+
+
+class MockServer:
+
+    ### local OpenAI-compatible chat completions server backed by a FakeBackend, for use with define_client('Local')
+    # it listens on a background thread; failed calls are answered with OpenAI-style error bodies and status codes.
+
+    ### inputs:
+    # backend: the mock that answers [FakeBackend] (default None, a FakeBackend with the built-in answers)
+    # host: the address to listen on [str] (default '127.0.0.1')
+    # port: the port to listen on, or 0 for any free port [int] (default 0)
+
+    def __init__(self, backend=None, host='127.0.0.1', port=0):
+
+        self.backend = backend or FakeBackend()
+        self._server = ThreadingHTTPServer((host, port), _handler(self.backend))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+
+        ### the base URL to give an OpenAI client
+
+        host, port = self._server.server_address[:2]
+
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exc):
+
+        self.stop()
+
+
+def _handler(backend):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        # keep-alive connections, as pooled clients expect. the headers and body of a reply are written apart, so
+        # without TCP_NODELAY the client's delayed ACK would hold every reply back by tens of milliseconds
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+
+            pass
+
+        def _reply(self, status, body, headers=None):
+
+            payload = json.dumps(body).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+
+            if self.path.rstrip('/').endswith('/models'):
+                self._reply(200, {'object': 'list', 'data': [{'id': backend.model, 'object': 'model', 'owned_by': 'catmining'}]})
+            else:
+                self._reply(404, {'error': {'message': f'Unknown path {self.path}.', 'type': 'invalid_request_error'}})
+
+        def do_POST(self):
+
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._reply(404, {'error': {'message': f'Unknown path {self.path}.', 'type': 'invalid_request_error'}})
+                return
+
+            params = {key: request[key] for key in ('temperature', 'top_p', 'max_tokens') if key in request}
+            try:
+                completion = backend.complete(request.get('messages', []), params=params)
+            except MockError as e:
+                headers = {'Retry-After': f'{e.retry_after:g}'} if e.retry_after is not None else None
+                kind = 'rate_limit_error' if e.status_code == 429 else 'server_error'
+                self._reply(e.status_code, {'error': {'message': str(e), 'type': kind}}, headers)
+                return
+
+            self._reply(200, {
+                'id': f'chatcmpl-mock-{backend.calls}', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': request.get('model', backend.model),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': completion['Text']}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': completion['Input Tokens'], 'completion_tokens': completion['Output Tokens'],
+                          'total_tokens': completion['Input Tokens'] + completion['Output Tokens']}
+            })
+
+    return Handler
+
+
+if __name__ == '__main__':
+
+    # python -m catmining.mock --port 8000 --latency 0.2 --throttle-rate 0.01
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a mock OpenAI-compatible LLM that answers CatMiner prompts.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--requests-per-minute', type=float, default=None)
+    parser.add_argument('--transcript', default=None, help='JSONL file of recorded {"Prompt": ..., "Answer": ...} pairs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    profile = LoadProfile(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.requests_per_minute, args.seed)
+    responder = ScriptedResponder(transcript=load_transcript(args.transcript) if args.transcript else None)
+    server = MockServer(FakeBackend(responder, profile), args.host, args.port)
+    print(f'Mock LLM serving at {server.url}')
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,34 +1,109 @@
-from catmining.multiturn_helpers import getexcerpt, write_log, prompt, read_sentences, filter_sentences, obtain_abbreviation_defs
-from catmining.prompts import (
-    prompt1,
-    prompt2,
-    prompt3,
-    prompt4,
-    prompt4_ips,
-    promptf1,
-    promptf2,
-    promptf3,
-    promptf3_nochat,
-    promptf4,
-    promptf4_nochat,
-    prompt_ar1,
-    prompt_ar2
-)
-import pandas as pd
+from catmining.multiturn_helpers import read_sentences, AbbreviationIndex, ExcerptIndex, RateLimiter, PromptCaching, set_rate_limiter, set_response_cache, set_prompt_caching, set_transcript, set_metrics, set_budget, set_retry_policy, set_verdict_store, set_preranker, prerank, count_funnel, BudgetExceeded
+from catmining.cascade import Cascade, StructuredCascade, build_stages, joint_candidates, classify_sentence
+from catmining.cache import ResponseCache, Transcript, VerdictStore
+from catmining.metrics import Metrics
+from catmining.budget import Budget, Estimate, ratios_from_report
+from catmining.retry import RetryPolicy
+from catmining.prerank import PreRanker
+from catmining.batch import BatchClient
+from catmining.phrases import PhraseMatcher, passes
+from catmining.writers import LogWriter, RecordWriter
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import copy
+import asyncio
+import json
 import os
 
 
 def extract(source_dir, client, target_properties, target_conditions, model_type, sp_paths, prop_bounds=[2,0],
             cond_bounds=[6,0], prop_title=True, cond_title=False, required_prop_phrases=None, 
             required_cond_phrases=None, abbr_resolution=False, test_mode=False, log_path=None, 
-            log_bool=False, record_path="records.csv", sysprompt=True, followup=[3], IPS=True, chat=True):
+            log_bool=False, record_path="records.csv", sysprompt=True, followup=[3], IPS=True, chat=True,
+            concurrency=None, requests_per_minute=None, tokens_per_minute=None, cache_path=None, 
+            cache_max_entries=None, cache_max_bytes=None, manifest_path=None, resume=False, joint_p1=False,
+            prompt_caching=False, transcript_path=None, metrics_path=None, prometheus_path=None, estimate_only=False,
+            history=None, prices=None, token_budget=None, cost_budget=None, price=None, max_retries=5, retry_deadline=300.0,
+            parallel_properties=False, parallel_followups=False, verdict_policy=None, verdict_path=None,
+            preranker=None, prerank_recall=None, structured=False, confidence_threshold=0.8):
 
     # Wrapper function for the CatMiner implementations below. Extracts a set of papers (or just one). 
+    # If concurrency is given, papers and the candidate sentences within them are extracted at the same
+    # time with at most that many sentences (and papers) in flight. Records and logs are written in the same order as
+    # the serial path. This also works where an event loop is already running, e.g. in Jupyter.
+    # requests_per_minute and tokens_per_minute are the provider quotas that all LLM calls are paced to; when
+    # throttled, the number of calls in flight is halved and then grown back one at a time. Without concurrency, the
+    # calls of parallel properties and follow-ups are held to at most 8 in flight. Neither the quotas nor
+    # concurrency apply to batch clients, whose service paces the requests itself.
+    # If cache_path is given, responses are stored in (and re-read from) an SQLite cache at that path, so
+    # re-running the same conversations costs no tokens. The cache is trimmed to cache_max_entries / cache_max_bytes.
+    # Every completed (paper, property) unit is recorded in a manifest (record_path + '.manifest.jsonl' unless
+    # manifest_path is given). With resume=True, units already in the manifest are skipped and any records
+    # written after the last completed unit (e.g., by a run that crashed mid-write) are discarded first.
+    # If joint_p1 is True, a sentence that passes the required-phrase filter of several properties is classified
+    # against all of them in one Prompt 1 call, and only the properties it is positive for continue to Prompt 2.
+    # If client is a BatchClient (e.g., define_client('AzureBatch')), all units are extracted together and their
+    # LLM calls are sent through the provider batch service one cascade level at a time. Records are written once
+    # every batch has come back, so pass cache_path to keep the responses of a run that is interrupted.
+    # The log and records are appended to their files as each cascade stage and sentence completes. log_path and
+    # record_path may end in '.csv' (the original format) or '.jsonl'; log_path may also end in '.jsonl.gz'.
+    # With concurrency or a batch client, a '.csv' log and the records are still written one unit at a time.
+    # If prompt_caching is True, requests mark their stable prefix for the provider prompt cache (Bedrock cachePoint
+    # blocks; OpenAI caches prefixes automatically), and the input tokens read from that cache are reported.
+    # If transcript_path is given, every request/response pair is recorded to that file ('.jsonl' or '.jsonl.gz')
+    # and conversations already recorded there are replayed instead of sent, e.g. the cascade stages that the runs
+    # of an ablation sweep share. Only conversations the transcript has not seen reach the model.
+    # Calls, latency percentiles, tokens, and errors are counted per cascade stage (P1-P4, P4-IPS, AR1, AR2, F1-F4)
+    # along with a funnel of the sentences, values, and materials surviving each step. A summary is printed at the
+    # end; metrics_path saves the full report as JSON and prometheus_path in the Prometheus text format.
+    # With estimate_only=True, or when a budget is given, the calls and tokens of the run are estimated up front from
+    # the candidate sentences, excerpt sizes, and funnel ratios, taken from the metrics JSON of an earlier run
+    # (history) if given. The cost is estimated for each {'provider': (input, output)} price in dollars per million
+    # tokens in prices, and for price. estimate_only returns the estimate without calling the model.
+    # token_budget (input + output tokens) and cost_budget (dollars at price) are hard limits: once 80% is spent IPS
+    # is no longer used, once 90% is spent follow-ups are skipped, and the run stops before any call that could go
+    # over, also with concurrency, since the calls in flight reserve their tokens. Completed units are in the
+    # manifest, so the run can be resumed with a larger budget.
+    # Calls that fail for a passing reason (throttling, server errors, timeouts, empty answers) are resent up to
+    # max_retries times with jittered exponential backoff, or after the wait the provider asks for, as long as
+    # retry_deadline seconds have not passed since the first attempt. Other errors (e.g., authentication or invalid
+    # requests) are not resent. Only a call that still fails skips its sentence, value, or material.
+    # Each paper is read, split, and scanned for required phrases once for all properties, and the system prompts
+    # once per run. With parallel_properties=True (and no concurrency or batch client), the property cascades of a
+    # paper run at the same time against that shared copy; records and logs are still written in property order.
+    # With parallel_followups=True, follow-ups 1-3 of a material are sent at the same time, as is Prompt 4 for each
+    # operating condition, since they all start from the same checkpoint. Once one follow-up rejects the material,
+    # those not yet sent are cancelled and any answer still in flight is waited for and discarded (its tokens are still
+    # counted). Records are unchanged. Batch clients already send each cascade level at once and ignore it.
+    # If verdict_policy or verdict_path is given, the answers to AR1, F1, and F2 (which ask about a material name) are
+    # stored by normalized name and reused for the same name in later sentences and papers, and across runs if
+    # verdict_path is given. verdict_policy ('context-free' by default, 'paper', 'property', or 'corpus') sets how far
+    # a verdict is shared despite the conversation before it; see catmining.cache.VerdictStore. Hit rates are printed.
+    # preranker (a catmining.prerank.PreRanker, or the path of a saved one) scores the sentences that pass the required
+    # phrases, and those below the cut-off of their property are not sent to Prompt 1. The cut-off keeps the recall
+    # the pre-ranker was trained for, or prerank_recall if given. The number of sentences it skipped is printed.
+    # With structured=True, Prompts 1-4 are replaced by one call per candidate sentence that asks for all of its
+    # records (value, material, operating conditions, and a confidence) as JSON over one excerpt wide enough for the
+    # property and the conditions (OpenAI clients constrain the answer to the schema; Meta models are only asked for
+    # it). Only records below confidence_threshold go through the follow-ups; IPS and abbreviation resolution are not
+    # used. The records are written in the same format as the cascade's, so the two engines can be compared directly.
 
     if required_prop_phrases == None:
         required_prop_phrases = ['']*len(target_properties)
     if required_cond_phrases == None:
         required_cond_phrases = ['']*len(target_conditions)
+    if manifest_path == None:
+        manifest_path = record_path + '.manifest.jsonl'
+
+    # select the CatMiner implementation
+    if structured:
+        mode = 'structured'
+    elif abbr_resolution:
+        mode = 'abbreviation_resolution'
+    elif test_mode:
+        mode = 'test_mode'
+    else:
+        mode = 'default'
 
     # initialize total token count
     total_in = 0
@@ -37,433 +112,658 @@ def extract(source_dir, client, target_properties, target_conditions, model_type
     # Define filenames of source text
     filenames = sorted(os.listdir(source_dir))
 
-    # begin extraction one paper at a time
-    print(f'Beginning extraction from {len(filenames)} papers.')
-    for p in range(len(filenames)):
+    # Compile target data, excerpt sizes, and required phrases for each parent property
+    target_dicts = []
+    for i in range(len(target_properties)):
+        properties = [{'Name': f'{target_properties[i]}', 'Context Params': {'Bounds': prop_bounds, 'Title': prop_title}, 'Required Phrases': required_prop_phrases[i]}]
+        conditions = [{'Name': f'{target_conditions[0]}', 'Context Params': {'Bounds': cond_bounds, 'Title': cond_title}, 'Required Phrases': required_cond_phrases}]
+        target_dicts.append({'Properties': properties, 'Operating Conditions': conditions})
+
+    # every paper is extracted with the same system prompts
+    system_prompts = [_read_system_prompt(sp_path, model_type, sysprompt) for sp_path in sp_paths[:len(target_properties)]]
+
+    # a batch client can only tell that a cascade level is complete if every call is made by one of its workers
+    parallel_followups = parallel_followups == True and not isinstance(client, BatchClient)
+
+    mode_kwargs = {'SYSPROMPT': sysprompt, 'FOLLOWUP': followup, 'IPS': IPS, 'CHAT': chat, 'JOINT_P1': joint_p1,
+                   'PARALLEL': parallel_followups, 'CONFIDENCE': confidence_threshold}
+
+    # skip the (paper, property) units that an earlier run already completed
+    completed = {}
+    if resume == True:
+        completed = _read_manifest(manifest_path, record_path)
+        prior_in = sum(entry['Input Tokens'] for entry in completed.values())
+        prior_out = sum(entry['Output Tokens'] for entry in completed.values())
+        print(f'Resuming: {len(completed)} units already complete (input tokens: {prior_in}, output tokens: {prior_out}).')
+    units = [(p, i) for p in range(len(filenames)) for i in range(len(target_properties)) 
+             if (filenames[p], target_properties[i]) not in completed]
+
+    # skip Prompt 1 on the sentences the pre-ranker scores below its cut-off
+    if isinstance(preranker, str):
+        preranker = PreRanker.load(preranker)
+    if preranker is not None and prerank_recall is not None:
+        preranker = copy.copy(preranker)
+        preranker.recall = prerank_recall
+    previous_preranker = set_preranker(preranker)
+
+    # estimate what the run will cost before making any call
+    if estimate_only == True or token_budget is not None or cost_budget is not None:
+        estimate = _estimate(source_dir, filenames, units, target_dicts, model_type, system_prompts, mode, mode_kwargs,
+                             ratios_from_report(history) if history is not None else None)
+        print(estimate.summary({**(prices or {}), **({'this model': price} if price is not None else {})}))
+        if estimate_only == True:
+            set_preranker(previous_preranker)
+            return estimate
+
+    budget = None
+    if token_budget is not None or cost_budget is not None:
+        budget = Budget(max_tokens=token_budget, max_cost=cost_budget, price=price)
+        _, estimated_in, estimated_out = estimate.totals()
+        if budget.share(estimated_in, estimated_out) > 1:
+            print(f'The estimate is {100*budget.share(estimated_in, estimated_out):.0f}% of the budget. IPS and follow-ups '
+                  f'will be dropped as the budget runs out, and the run will stop once it is spent.')
+
+    def open_unit(p, i, ordered):
+
+        # called when a unit starts; returns the functions that write its log entries and records as they are
+        # produced. either one is None if it can only be written in order and the unit may finish out of order
+        log_sink = _discard_log
+        if log_bool == True:
+            if ordered or not log_writer.ordered:
+                log_writer.begin()
+                log_sink = functools.partial(log_writer.write, filenames[p], target_properties[i])
+            else:
+                log_sink = None
+        record_sink = record_writer.write if ordered else None
+
+        return log_sink, record_sink
+
+    def write_unit(p, i, catminer_output, log, cm_in_tkn, cm_out_tkn):
+
+        # called once per unit, in (paper, property) order regardless of how the units were computed.
+        # catminer_output and log are None if they were already written through the sinks of open_unit
+        nonlocal total_in, total_out
+
+        print(f'Extracted {target_properties[i]} from {filenames[p]}. Input tokens: {cm_in_tkn}, Output tokens: {cm_out_tkn}')
+
+        # count tokens
+        total_in += cm_in_tkn
+        total_out += cm_out_tkn
+
+        # write chat to the log file
+        if log_bool == True and log is not None:
+            log_writer.begin()
+            log_writer.write(filenames[p], target_properties[i], None, log)
+
+        # write CatMiner output, with a header only at the top of the file
+        if catminer_output is not None:
+            record_writer.write(catminer_output)
+
+        # the unit only counts as complete once its records are on disk
+        records, records_size = record_writer.sync()
+        _append_manifest(manifest_path, {'Source': filenames[p], 'Property': target_properties[i], 
+                                         'Records': records, 'Input Tokens': cm_in_tkn, 
+                                         'Output Tokens': cm_out_tkn, 'Records Size': records_size})
+
+    # pace every LLM call made during this run through one shared limiter. a batch client sends a whole cascade level
+    # as one job once every worker is waiting on it, so a worker held back by a limiter would stall the level for good
+    limiter = None
+    if concurrency is not None or requests_per_minute is not None or tokens_per_minute is not None:
+        if isinstance(client, BatchClient):
+            print('Rate limits and concurrency do not apply to batch clients; the batch service paces the requests.')
+        elif concurrency is not None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute, max_concurrency=concurrency)
+        else:
+            # parallel properties and follow-ups still send several calls at once, up to the limiter's own ceiling
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    previous_limiter = set_rate_limiter(limiter)
+
+    # reuse responses to conversations that were already sent in earlier runs
+    cache = None
+    if cache_path is not None:
+        cache = ResponseCache(cache_path, max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+    previous_cache = set_response_cache(cache)
+
+    # replay the conversations recorded by earlier runs and record the new ones
+    transcript = Transcript(transcript_path) if transcript_path is not None else None
+    previous_transcript = set_transcript(transcript)
+
+    # reuse the verdicts about material names that were already asked
+    verdicts = None
+    if verdict_policy is not None or verdict_path is not None:
+        verdicts = VerdictStore(verdict_path, policy=verdict_policy or 'context-free')
+    previous_verdicts = set_verdict_store(verdicts)
+
+    # resend calls that fail for a passing reason
+    retry_policy = RetryPolicy(max_retries=max_retries, deadline=retry_deadline)
+    previous_policy = set_retry_policy(retry_policy)
+
+    # count where the calls, tokens, and time of this run go
+    metrics = Metrics()
+    previous_metrics = set_metrics(metrics)
+
+    # charge every call to the budget
+    previous_budget = set_budget(budget)
+
+    # let the provider cache the system prompt and conversation history shared by consecutive calls
+    caching = PromptCaching() if prompt_caching == True else None
+    previous_caching = set_prompt_caching(caching)
+
+    # the log and records files stay open for the whole run
+    log_writer = LogWriter(log_path) if log_bool == True else None
+    record_writer = RecordWriter(record_path)
+
+    try:
+        # begin extraction one paper at a time
+        print(f'Beginning extraction from {len(filenames)} papers.')
+        if isinstance(client, BatchClient):
+            _extract_batched(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, write_unit)
+        elif concurrency is None:
+            _extract_serial(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, write_unit, parallel_properties)
+        else:
+            _extract_concurrent(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, write_unit, concurrency)
+
+    except BudgetExceeded as e:
+        print(f'Stopping the run. {e} Rerun with resume=True and a larger budget to continue.')
+
+    finally:
+        record_writer.close()
+        if log_writer is not None:
+            log_writer.close()
+        set_rate_limiter(previous_limiter)
+        set_response_cache(previous_cache)
+        set_prompt_caching(previous_caching)
+        set_transcript(previous_transcript)
+        set_metrics(previous_metrics)
+        set_budget(previous_budget)
+        set_retry_policy(previous_policy)
+        set_verdict_store(previous_verdicts)
+        set_preranker(previous_preranker)
+        if cache is not None:
+            cache.close()
+        if transcript is not None:
+            transcript.close()
+        if verdicts is not None:
+            verdicts.close()
+
+    print(f'Total input tokens so far: {total_in}. Total output tokens: {total_out}.')
+    if cache is not None:
+        print(cache.summary())
+    if transcript is not None:
+        print(transcript.summary())
+    if caching is not None:
+        print(caching.summary())
+    if verdicts is not None:
+        print(verdicts.summary())
+    if preranker is not None:
+        skipped = metrics.funnel['Phrase-Filtered'] - metrics.funnel['Pre-Ranked']
+        print(f"Pre-ranker skipped Prompt 1 for {skipped} of {metrics.funnel['Phrase-Filtered']} candidate sentences.")
+    if limiter is not None:
+        print(f'Throttled {limiter.throttled} times. Final concurrency limit: {int(limiter.concurrency)}.')
+    if retry_policy.retries > 0:
+        print(f'Resent {retry_policy.retries} failed calls.')
+    print(metrics.summary())
+    if budget is not None:
+        print(budget.summary())
+    if metrics_path is not None:
+        metrics.write_json(metrics_path)
+    if prometheus_path is not None:
+        metrics.write_prometheus(prometheus_path)
+
+
+def _extract_serial(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, on_unit,
+                    parallel_properties=False):
+
+    ### extract each (paper, property) unit one after another, or the properties of each paper at the same time
+
+    ### inputs
+    # source_dir: directory containing the preprocessed papers [str]
+    # filenames: sorted names of the papers in source_dir [list]
+    # units: the (paper index, property index) pairs to extract, in order [list of tuple]
+    # client: LLM client defined using our environmental variables
+    # target_dicts: one target dictionary per parent property [list of dict]
+    # model_type: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # system_prompts: the system prompt of each parent property, read once per run [list of str]
+    # mode: the name of the CatMiner implementation to run [str]
+    # mode_kwargs: the SYSPROMPT, FOLLOWUP, IPS, CHAT, JOINT_P1, and PARALLEL settings [dict]
+    # open_unit: called with (paper index, property index, whether units start and end in order) when a unit starts;
+    #            returns the log and record sinks of the unit, or None for each that has to be handed to on_unit [function]
+    # on_unit: called with (paper index, property index, extracted records, log, input tokens, output tokens)
+    #          as soon as each unit is complete; records and log are None if they went to the sinks [function]
+    # parallel_properties: whether the property cascades of a paper run at the same time [Bool] (default False)
+
+    matcher = _phrase_matcher(target_dicts)
+
+    for p, indices in _group_units(units):
 
         file_path = source_dir + filenames[p]
 
         print(f'Extracting no. {p}, {filenames[p]}...')
 
-        # for each parent property...
-        for i in range(len(target_properties)):
-            print(i)
-            print(target_properties[i])
-            print(required_prop_phrases[i])
-
-            # Compile target data, excerpt sizes, and required phrases 
-            properties = [{'Name': f'{target_properties[i]}', 'Context Params': {'Bounds': prop_bounds, 'Title': prop_title}, 'Required Phrases': required_prop_phrases[i]}]
-            conditions = [{'Name': f'{target_conditions[0]}', 'Context Params': {'Bounds': cond_bounds, 'Title': cond_title}, 'Required Phrases': required_cond_phrases}]
-            target_dict = {'Properties': properties, 'Operating Conditions': conditions}
-            print(f"Property to extract: {target_dict['Properties'][0]['Name']}.")
-
-            # iterate through the input files
-            sp_path = sp_paths[i]
-            
-            # call CatMiner
-            if abbr_resolution:
-                catminer_output, cm_in_tkn, cm_out_tkn = abbreviation_resolution(file_path, client, target_dict, model_type, 
-                                                                sp_path=sp_path, log_path=log_path, log_bool=log_bool, 
-                                                                SYSPROMPT=sysprompt, FOLLOWUP=followup, IPS=IPS, CHAT=chat)
-            elif test_mode:
-                catminer_output, cm_in_tkn, cm_out_tkn = test_mode(file_path, client, target_dict, model_type, 
-                                                        sp_path=sp_path, log_path=log_path, log_bool=log_bool, 
-                                                        SYSPROMPT=sysprompt, FOLLOWUP=followup, IPS=IPS, CHAT=chat)
-            else:
-                catminer_output, cm_in_tkn, cm_out_tkn = default(file_path, client, target_dict, model_type, 
-                                                        sp_path=sp_path, log_path=log_path, log_bool=log_bool, 
-                                                        SYSPROMPT=sysprompt, FOLLOWUP=followup, IPS=IPS, CHAT=chat)
+        papers = _read_papers(file_path, indices, target_dicts, model_type, system_prompts, matcher)
 
-            print(f'Extracted {target_properties[i]} from {filenames[p]}. Input tokens: {cm_in_tkn}, Output tokens: {cm_out_tkn}')
+        # classify sentences shared between properties with one Prompt 1 each
+        shared = ([], 0, 0)
+        if mode_kwargs['JOINT_P1'] == True:
+            joint = joint_candidates(papers)
+            shared = _merge_joint_answers(papers, joint, [classify_sentence(papers, s, joint[s], client, model_type) for s in joint])
 
-            # count tokens
-            total_in += cm_in_tkn
-            total_out += cm_out_tkn
+        if parallel_properties == True and len(indices) > 1:
+            _extract_properties(p, indices, papers, shared, client, model_type, mode, mode_kwargs, open_unit, on_unit)
+            continue
 
-            # write CatMiner output to a CSV
-            records_df = pd.DataFrame(data=catminer_output)
-            if p == 0:
-                records_df.to_csv(record_path, mode='a', index=False)
-            else:
-                records_df.to_csv(record_path, mode='a', header=False, index=False)
+        for i in indices:
+            print(f"Property to extract: {target_dicts[i]['Properties'][0]['Name']}.")
 
-    print(f'Total input tokens so far: {total_in}. Total output tokens: {total_out}.')
+            # the log and records of each sentence are written as soon as they are produced
+            log_sink, record_sink = open_unit(p, i, True)
 
+            # the joint Prompt 1 calls are counted with the first property of the paper
+            if i == indices[0]:
+                log_sink(None, shared[0])
 
-def abbreviation_resolution(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
-                            log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], IPS=True, CHAT=True):
+            cascade = _new_cascade(papers[i], client, model_type, mode, mode_kwargs, log_sink, record_sink)
+            sentence_outputs = [cascade.run(s) for s in papers[i]['Candidates']]
+            _, _, cm_in_tkn, cm_out_tkn = _merge_sentence_outputs(sentence_outputs, cascade.new_records())
+
+            if i == indices[0]:
+                cm_in_tkn += shared[1]
+                cm_out_tkn += shared[2]
+
+            on_unit(p, i, None, None, cm_in_tkn, cm_out_tkn)
+
+
+def _extract_properties(p, indices, papers, shared, client, model_type, mode, mode_kwargs, open_unit, on_unit):
+
+    ### run the property cascades of one paper at the same time, each in its own thread, against the shared paper
 
-    # TODO: read all the hyperparameters in from an input file
-    
     ### inputs
-    # file_path: the path to a text file that obeys CatMiner input format (i.e., title in the first line, each following line is a new sentence) [str]
-    # client: LLM client defined using our environmental variables
-    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
-    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
-    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
-    # log_path: the path to a csv file that the log should be written to [str] (default None)
-    # write_log: True if we should write the LLM conversation to a CSV file, False if not [Bool] (default True)
-    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
-    # FOLLOWUP: True if we should apply follow-up questions to interrogate material-property pairs, False if not [Bool] (default True)
-    # IPS: True if we should use inter-paragraph search as a backup if nested properties are not found [Bool] (default True)
+    # p: the index of the paper [int]
+    # indices: the indices of the properties to extract from the paper [list]
+    # papers: the parsed paper for each property, from _read_papers [dict]
+    # shared: the log and tokens of the joint Prompt 1 calls of the paper, from _merge_joint_answers [tuple]
+    # see _extract_serial for the others
 
-    ### outputs
-    # extracted_records: all the records that were extracted from the provided sentences [dict]
-    # in_tkn: the total # of input tokens passed [int]
-    # out_tkn: the total # of output tokens produced [int]
+    # the units may finish out of order, so anything that has to be written in order goes through on_unit
+    sinks = {i: open_unit(p, i, False) for i in indices}
+    if sinks[indices[0]][0] is not None:
+        sinks[indices[0]][0](None, shared[0])
 
-    # read title and list of sentences from input text file
-    sentences, title = read_sentences(file_path) # assumes first line is the title of the source
+    def run_unit(i):
+        cascade = _new_cascade(papers[i], client, model_type, mode, mode_kwargs, *sinks[i])
+        sentence_outputs = [cascade.run(s) for s in papers[i]['Candidates']]
+        return _merge_sentence_outputs(sentence_outputs, cascade.new_records())
 
-    # read system prompt
-    if SYSPROMPT == True: 
-        f = open(sp_path, mode="r", encoding="utf8")
-        system_prompt = f.read()
-    else: 
-        if MODEL_TYPE == 'OpenAI':
-            system_prompt = ' '
-        if MODEL_TYPE == 'Meta':
-            system_prompt = 'You are a helpful assistant.'
+    print(f"Properties to extract: {', '.join(papers[i]['Property'] for i in indices)}.")
+    with ThreadPoolExecutor(max_workers=len(indices)) as pool:
+        unit_outputs = list(pool.map(run_unit, indices))
 
-    # read target parent properties and optional required phrases to aid in extraction
-    property = target_dict['Properties'][0]['Name']
-    required_property_phrases = target_dict['Properties'][0]['Required Phrases'] 
-    
-    operating_conditions = []
-    required_cond_phrases = []
-    for i in range(len(target_dict['Operating Conditions'])):
-        operating_conditions.append(target_dict['Operating Conditions'][i]['Name'])
-        required_cond_phrases.append(target_dict['Operating Conditions'][i]['Required Phrases'])
+    for i, unit_output in zip(indices, unit_outputs):
+        on_unit(p, i, *_unit_output(unit_output, shared if i == indices[0] else None, *sinks[i]))
 
-    # initialize dictionary of outputs and log
-    extracted_records = {'Source': [], 'Sentence': [], 'Property': [], 
-                         'Property Value': [], 'Material': []}
-    
-    for i, operating_condition in enumerate(operating_conditions):
-        extracted_records[f'Operating Condition {i+1}'] = []
-        extracted_records[f'Operating Condition {i+1} Value'] = []
 
-    log = []
+def _extract_concurrent(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, on_unit, concurrency):
 
-    # initialize token and record counters
-    in_tkn = 0
-    out_tkn = 0
-    rcounts = 0
+    ### extract all (paper, property) units at once with a bounded number of sentences in flight
 
-    print(f'Beginning extraction from {len(sentences)} sentences...')
+    ### inputs
+    # see _extract_serial; on_unit is still called in the order of units, as soon as each unit and all before it are complete
+    # concurrency: the maximum number of sentences being extracted at the same time [int]
 
-    for s in range(len(sentences)):
+    if concurrency < 1:
+        raise ValueError(f'concurrency must be at least 1, got {concurrency}')
 
-        sentence = sentences[s]
+    # the LLM clients are blocking, so each LLM-bound step runs in a worker thread of this run's own pool
+    pool = ThreadPoolExecutor(max_workers=concurrency)
 
-        # if we don't have any of the required phrases, continue to the next sentence
-        if not any(phrase in sentence for phrase in required_property_phrases):
-            continue
+    async def run_limited(semaphore, function, *args):
+        async with semaphore:
+            return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(function, *args))
 
-        # reset the context window with or without a system prompt
-        context = []
-        if MODEL_TYPE == 'OpenAI': # append system prompt to context if we're using OpenAI
-            context.append({"role": "system", "content": system_prompt})
+    async def run_unit(semaphore, cascade):
+        sentence_outputs = await asyncio.gather(*[run_limited(semaphore, cascade.run, s) for s in cascade.paper['Candidates']])
+        return _merge_sentence_outputs(sentence_outputs, cascade.new_records())
 
-        # define excerpts for Prompts 3 and 4 
-        excerpt_p3 = getexcerpt(title, sentences, s, target_dict['Properties'][0]['Context Params'])
-        excerpts_p4 = []
-        for i in range(len(target_dict['Operating Conditions'])):
-            excerpt_p4 = getexcerpt(title, sentences, s, target_dict['Operating Conditions'][i]['Context Params'])
-            excerpts_p4.append(excerpt_p4)
+    async def run_paper(semaphore, slots, p, indices):
+        # a paper is only read once it has a slot, which it keeps until its units are handed over
+        await slots.acquire()
+        papers = _read_papers(source_dir + filenames[p], indices, target_dicts, model_type, system_prompts, matcher)
 
-        ### PROMPT 1
-        user_message = prompt1.format(property=property) + sentence
-        try:
-            p1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 1 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
+        # the per-property cascades of a paper can only start once the joint Prompt 1 answers are in
+        shared = ([], 0, 0)
+        if mode_kwargs['JOINT_P1'] == True:
+            joint = joint_candidates(papers)
+            classified = await asyncio.gather(*[run_limited(semaphore, classify_sentence, papers, s, joint[s], client, model_type) for s in joint])
+            shared = _merge_joint_answers(papers, joint, classified)
 
-        # skip if negatively classified
-        if 'no' in p1_ans.strip().lower(): 
-            log = write_log(context,log,message="Moving to next sentence...")
-            log.append(" ")
-            continue
+        sinks = {i: open_unit(p, i, False) for i in indices}
+        if sinks[indices[0]][0] is not None:
+            sinks[indices[0]][0](None, shared[0])
+
+        cascades = [_new_cascade(papers[i], client, model_type, mode, mode_kwargs, *sinks[i]) for i in indices]
+        unit_outputs = await asyncio.gather(*[run_unit(semaphore, cascade) for cascade in cascades])
+
+        return [(p, i, *_unit_output(unit_output, shared if i == indices[0] else None, *sinks[i]))
+                for i, unit_output in zip(indices, unit_outputs)]
+
+    matcher = _phrase_matcher(target_dicts)
 
-        ### PROMPT 2
-        user_message = prompt2.format(property=property) + sentence
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        # every paper in flight has at least one sentence to extract, so no more than concurrency papers are needed
+        # to keep the sentence slots busy; the others wait unread
+        slots = asyncio.Semaphore(concurrency)
+        tasks = [asyncio.ensure_future(run_paper(semaphore, slots, p, indices)) for p, indices in _group_units(units)]
         try:
-            p2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 2 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
+            # hand units over in order so that a crash never leaves a gap behind a completed unit
+            for task in tasks:
+                for output in await task:
+                    on_unit(*output)
+                slots.release()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        running = False
+    else:
+        running = True
+
+    try:
+        if running:
+            # e.g. in Jupyter, whose event loop already runs in this thread, the run gets a loop of its own in another
+            with ThreadPoolExecutor(max_workers=1) as runner:
+                runner.submit(asyncio.run, run_all()).result()
+        else:
+            asyncio.run(run_all())
+    finally:
+        pool.shutdown(wait=True)
+
+
+def _extract_batched(source_dir, filenames, units, client, target_dicts, model_type, system_prompts, mode, mode_kwargs, open_unit, on_unit):
+
+    ### extract all (paper, property) units together through a batch-inference client
 
-        # if no property values are extracted, skip the sentence
-        if 'none' == p2_ans.strip().lower(): 
-            log = write_log(context,log,message=f'Skipping sentence {s} because no {property} was extracted')
-            log.append(" ")
-            continue
+    ### inputs
+    # see _extract_serial; client must be a BatchClient
+
+    matcher = _phrase_matcher(target_dicts)
+    groups = _group_units(units)
+    papers = {}
+    for p, indices in groups:
+        print(f'Reading no. {p}, {filenames[p]}...')
+        papers[p] = _read_papers(source_dir + filenames[p], indices, target_dicts, model_type, system_prompts, matcher)
+
+    # the joint Prompt 1 calls of every paper go out as the first batch
+    shared = {p: ([], 0, 0) for p, indices in groups}
+    if mode_kwargs['JOINT_P1'] == True:
+        joints = {p: joint_candidates(papers[p]) for p, indices in groups}
+        jobs = [(p, s, indices) for p, joint in joints.items() for s, indices in joint.items()]
+        classified = {p: [] for p in joints}
+        for (p, _, _), output in zip(jobs, client.run([functools.partial(classify_sentence, papers[p], s, indices, client, model_type) for p, s, indices in jobs])):
+            classified[p].append(output)
+        for p in joints:
+            shared[p] = _merge_joint_answers(papers[p], joints[p], classified[p])
+
+    # every candidate sentence of every unit is one worker of the batch client
+    cascades = []
+    for p, indices in groups:
+        for i in indices:
+            sinks = open_unit(p, i, False)
+            if i == indices[0] and sinks[0] is not None:
+                sinks[0](None, shared[p][0])
+            cascades.append((p, i, sinks, _new_cascade(papers[p][i], client, model_type, mode, mode_kwargs, *sinks)))
+    sentences = [(cascade, s) for p, i, sinks, cascade in cascades for s in cascade.paper['Candidates']]
+    sentence_outputs = iter(client.run([functools.partial(cascade.run, s) for cascade, s in sentences]))
+    print(f'Sent {client.requests} requests in {client.batches} batches.')
+
+    for p, i, sinks, cascade in cascades:
+        print(f"Property to extract: {target_dicts[i]['Properties'][0]['Name']}.")
+        outputs = [next(sentence_outputs) for s in cascade.paper['Candidates']]
+        unit_output = _merge_sentence_outputs(outputs, cascade.new_records())
+        on_unit(p, i, *_unit_output(unit_output, shared[p] if i == next(iter(papers[p])) else None, *sinks))
+
+
+def _unit_output(unit_output, shared, log_sink, record_sink):
+
+    ### the records, log, and tokens of a unit to hand to on_unit
 
-        # save checkpoint
-        context_p2 = context.copy() # context checkpoint
+    ### inputs
+    # unit_output: the merged sentence outputs of the unit, from _merge_sentence_outputs [tuple]
+    # shared: the log and tokens of the joint Prompt 1 calls if they are counted with this unit, else None [tuple]
+    # log_sink, record_sink: the sinks the unit was run with, from open_unit [function]
 
-        # parse property values
-        vals = p2_ans.split(';')
+    catminer_output, log, cm_in_tkn, cm_out_tkn = unit_output
 
-        # process the list of values to remove duplicates
-        for val in vals:
-            val = val.strip()
-        vals = list(set(vals)) 
+    # the joint Prompt 1 calls are counted with the first property of the paper
+    if shared is not None:
+        if log_sink is None:
+            log = shared[0] + log
+        cm_in_tkn += shared[1]
+        cm_out_tkn += shared[2]
 
-        # for each value...
-        for val in vals:
+    return (None if record_sink is not None else catminer_output), (None if log_sink is not None else log), cm_in_tkn, cm_out_tkn
 
-            # screen out values that are named "None" or blank spaces
-            # this often happens with, e.g., GPT-3.5 Turbo
-            if val.strip().lower() == 'none' or '': 
-                log = write_log(context,log,message=f'Skipped an invalid property value')
-                log.append(" ")
-                continue
 
-            # load context from last checkpoint
-            context = context_p2.copy() 
+def _discard_log(s, entries):
 
-            ### PROMPT 3
-            user_message = prompt3.format(property=property, property_value=val) + excerpt_p3
+    # log sink used when no log is kept
+    pass
+
+
+def _group_units(units):
+
+    ### group consecutive (paper index, property index) units by paper, keeping their order
+
+    groups = []
+    for p, i in units:
+        if groups and groups[-1][0] == p:
+            groups[-1][1].append(i)
+        else:
+            groups.append((p, [i]))
+
+    return groups
+
+
+def _merge_joint_answers(papers, joint, classified):
+
+    ### hand the joint Prompt 1 answers to the paper of each property
+
+    ### inputs
+    # papers: the parsed paper for each property, keyed by property index [dict]
+    # joint: the property indices classified for each sentence, keyed by sentence index [dict]
+    # classified: the output of classify_sentence for each sentence in joint, in the same order [list of tuple]
+
+    ### outputs
+    # log: the conversation log of the joint calls [list]
+    # in_tkn: the total # of input tokens passed [int]
+    # out_tkn: the total # of output tokens produced [int]
+
+    log = []
+    in_tkn = 0
+    out_tkn = 0
+    for s, (answers, sentence_log, sentence_in, sentence_out) in zip(joint, classified):
+        for i, ans in answers.items():
+            papers[i].setdefault('P1 Answers', {})[s] = ans
+        log.extend(sentence_log)
+        in_tkn += sentence_in
+        out_tkn += sentence_out
+
+    print(f'Classified {len(joint)} sentences against several properties at once.')
+
+    return log, in_tkn, out_tkn
+
+
+def _read_manifest(manifest_path, record_path):
+
+    ### read the units completed by earlier runs and drop any records written after the last of them
+
+    ### inputs
+    # manifest_path: the path to the JSONL manifest of completed units [str]
+    # record_path: the path to the records CSV that the manifest describes [str]
+
+    ### outputs
+    # completed: the manifest entry of each completed unit, keyed by (source filename, property) [dict]
+
+    completed = {}
+    if not os.path.exists(manifest_path):
+        return completed
+
+    records_size = 0
+    with open(manifest_path, mode='r', encoding='utf8') as f:
+        for line in f:
+            # a crash while appending can leave a partial last line, whose unit is then simply redone
             try:
-                p3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-            except Exception as e: 
-                log = write_log(context, log, message=f"Prompt 3 encountered some error: {e}. skipping to the next property value.", verbose=True)
+                entry = json.loads(line)
+            except json.JSONDecodeError:
                 continue
+            completed[(entry['Source'], entry['Property'])] = entry
+            records_size = entry['Records Size']
 
-            # save checkpoint
-            context_p3 = context.copy() 
+    # rows past the last completed unit belong to a unit that did not finish
+    if os.path.exists(record_path) and os.path.getsize(record_path) > records_size:
+        with open(record_path, mode='r+b') as f:
+            f.truncate(records_size)
 
-            # parse material names
-            mats = p3_ans.split(';') 
+    return completed
 
-            # if there are no materials associated with this value, go to the next one
-            if 'none' == p3_ans.strip().lower():
-                log = write_log(context,log,message=f'Skipped {val} because there are no materials.')
-                continue
 
-            # for each material name...
-            for mat in mats:
-
-                # skip if the material name is not valid
-                if (mat.strip().lower() == 'none') or (mat.strip().lower() == ''): 
-                    log = write_log(context,log,message=f'Skipped {mat} because it is not a valid material name.')
-                    continue
-
-                # count the number of materials extracted
-                rcounts += 1
-                print('# record:', rcounts)
-
-                # load context from last checkpoint
-                context = context_p3.copy()
-
-                ### ABBREVIATION RESOLUTION
-                user_message = prompt_ar1.format(material=mat)
-                try:
-                    ar1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                except Exception as e:
-                    log = write_log(context, log, message=f"Prompt AR1 encountered some error: {e}. skipping to the next property value.", verbose=True)
-                    continue
-
-                if 'yes' in ar1_ans.strip().lower(): # if it is an abbreviation...
-
-                    # obtain context to resolve acronym
-                    excerpt_ar2 = obtain_abbreviation_defs(sentences, mat)
-
-                    ### ABBREVIATION RESOLUTION
-                    user_message = prompt_ar2.format(material=mat) + excerpt_ar2
-                    try:
-                        ar2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Prompt AR2 encountered some error: {e}. skipping to the next property value.", verbose=True)
-                        continue
-
-                    # if we resolve the abbreviation, then replace with ar2_ans
-                    if not 'none' == ar2_ans.strip().lower():
-                        mat = ar2_ans
-
-                # save checkpoint
-                context_ar2 = context.copy()
-
-                # initiate lists of extracted operating condition values, contexts, and excerpts
-                p4_responses = []
-                p4_contexts = []
-
-                # for each target operating condition...
-                for i, operating_condition in enumerate(operating_conditions):
-
-                    # load context from last checkpoint
-                    context = context_ar2.copy() 
-        
-                    ### PROMPT 4 NO IPS 
-                    user_message = prompt4.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + excerpts_p4[i]
-                    try:
-                        p4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Prompt 4 encountered some error: {e}. skipping to the next operating condition.", verbose=True)
-                        p4_responses.append('Error')
-                        continue
-
-                    # if we extracted nothing...
-                    if IPS == True:
-                        if 'none' == p4_ans.strip().lower():
-                            
-                            # replace excerpt 4 with the excerpt retrieved via IPS
-                            excerpts_p4[i] = filter_sentences(sentences, s, required_cond_phrases[i])
-
-                            # load context from last checkpoint
-                            context = context_ar2.copy()
-
-                            ### PROMPT 4 IPS -- using a different prompt than the original Prompt 4
-                            user_message = prompt4_ips.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + excerpts_p4[i]
-                            try:
-                                p4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                            except Exception as e:
-                                log = write_log(context, log, message=f"Prompt 4-IP encountered some error: {e}. skipping to the next material.", verbose=True)
-                                p4_responses.append('Error')
-                                continue
-
-                    # save p4_ans and the current chat state
-                    p4_responses.append(p4_ans)
-                    p4_context = context.copy()
-                    p4_contexts.append(p4_context)
-
-                if 1 in FOLLOWUP:
-                    # load context from AR2 checkpoint
-                    context = context_ar2.copy() 
-
-                    ### FOLLOW-UP PROMPT 1
-                    user_message = promptf1.format(material=mat)
-                    try:
-                        pf1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Follow-up 1 encountered some error: {e}. skipping to the next material.", verbose=True)
-                        continue
-                    if 'no' in pf1_ans.strip().lower(): 
-                        log = write_log(context,log,message=f'Skipped {mat} because it is incomplete.')
-                        continue
-
-                if 2 in FOLLOWUP:
-                    # load context from AR2 checkpoint
-                    context = context_ar2.copy() 
-
-                    ### FOLLOW-UP PROMPT 2
-                    user_message = promptf2.format(material=mat)
-                    try:
-                        pf2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 2 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf2_ans.strip().lower(): 
-                        log = write_log(context,log,message=f'Skipped {mat} because it is not specific.')
-                        continue
-
-                if 3 in FOLLOWUP:
-                    # load context from AR2 checkpoint
-                    context = context_ar2.copy() 
-
-                    # FOLLOW-UP PROMPT 3
-                    if CHAT == True: 
-                        user_message = promptf3.format(material=mat, property=property, property_value=val)
-                    if CHAT == False:
-                        user_message = promptf3_nochat.format(material=mat, property=property, property_value=val) + excerpt_p3
-                    
-                    try:
-                        pf3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)  
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 3 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf3_ans.strip().lower(): # if the pair doesn't match... 
-                        log = write_log(context,log,message=f'Threw out {mat}, {val}.')
-                        continue
-
-                if 4 in FOLLOWUP:
-                    # for each target operating condition...
-                    for i, operating_condition in enumerate(operating_conditions):
-                        if not 'none' == p4_responses[i].strip().lower(): 
-
-                            # load context from P4 checkpoint
-                            context = p4_contexts[i].copy()
-
-                            ### FOLLOW-UP PROMPT 4
-                            if CHAT == True:
-                                user_message = promptf4.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i])
-                            if CHAT == False:
-                                user_message = promptf4_nochat.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i]) + excerpts_p4[i]
-                            
-                            try:
-                                pf4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False) 
-                            except Exception as e:
-                                log = write_log(context, log, message=f'Follow-up 4 encountered some error: {e}. skipping to the next material.', verbose=True)
-                                continue
-                            if 'no' in pf4_ans.strip().lower(): # if the nested property doesn't match...
-                                log = write_log(context,log,message=f'Threw out {p4_responses[i]}.')
-                                p4_responses[i] = 'None'
-     
-                # update the record list and counter
-                extracted_records['Source'].append(file_path)
-                extracted_records['Sentence'].append(sentence)
-                extracted_records['Property'].append(property)
-                extracted_records['Property Value'].append(val.strip())
-                extracted_records['Material'].append(mat.strip())
-
-                for i, operating_condition in enumerate(operating_conditions):
-                    extracted_records[f'Operating Condition {i+1}'].append(target_dict['Operating Conditions'][i]['Name'])
-                    extracted_records[f'Operating Condition {i+1} Value'].append(p4_responses[i])
-
-                # update log 
-                log = write_log(context,log,message=f'Extracted {mat}, {val}.')        
-
-        log.append(f'Extracted sentence {s}')
-        log.append(" ")
+def _append_manifest(manifest_path, entry):
 
-    print(f'Completed extraction of {rcounts} records')
-    
-    # write chat to CSV log file
-    if log_bool == True:
-        logfile_dict = {'Chats': log}
-        logfile_df = pd.DataFrame(data=logfile_dict)
-        logfile_df.to_csv(log_path, mode='a', index=False)
+    ### durably record a completed unit in the manifest
 
-    return extracted_records, in_tkn, out_tkn
+    with open(manifest_path, mode='a', encoding='utf8') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
 
 
-def default(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
-            log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], IPS=True, CHAT=True):
+def _estimate(source_dir, filenames, units, target_dicts, model_type, system_prompts, mode, mode_kwargs, ratios=None):
+
+    ### estimate the calls and tokens of the units to extract, reading each paper once without calling the model
 
-    # TODO: read all the hyperparameters in from an input file
-    
     ### inputs
-    # file_path: the path to a text file that obeys CatMiner input format (i.e., title in the first line, each following line is a new sentence) [str]
-    # client: LLM client defined using our environmental variables
-    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
+    # see _extract_serial
+    # ratios: the funnel ratios to assume, see catmining.budget.ratios_from_report [dict] (default None)
+
+    ### outputs
+    # estimate: the estimated calls and tokens [catmining.budget.Estimate]
+
+    estimate = Estimate(mode, mode_kwargs, ratios)
+    matcher = _phrase_matcher(target_dicts)
+    for p, indices in _group_units(units):
+        papers = _read_papers(source_dir + filenames[p], indices, target_dicts, model_type, system_prompts, matcher, verbose=False)
+        for i in indices:
+            estimate.add_paper(papers[i])
+
+    return estimate
+
+
+def _phrase_matcher(target_dicts):
+
+    ### compile the required phrases of every property and operating condition into one PhraseMatcher
+
+    phrase_lists = []
+    for target_dict in target_dicts:
+        for target in target_dict['Properties'] + target_dict['Operating Conditions']:
+            phrase_lists.append(target['Required Phrases'])
+
+    return PhraseMatcher(phrase_lists)
+
+
+def _read_papers(file_path, indices, target_dicts, MODEL_TYPE, system_prompts, matcher=None, verbose=True):
+
+    ### read and scan a paper once and prepare it for each property to extract
+
+    ### inputs
+    # file_path: the path to a text file that obeys CatMiner input format [str]
+    # indices: the indices of the properties to extract from the paper [list]
+    # target_dicts: one target dictionary per parent property [list of dict]
     # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
-    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
-    # log_path: the path to a csv file that the log should be written to [str] (default None)
-    # write_log: True if we should write the LLM conversation to a CSV file, False if not [Bool] (default True)
-    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
-    # FOLLOWUP: True if we should apply follow-up questions to interrogate material-property pairs, False if not [Bool] (default True)
-    # IPS: True if we should use inter-paragraph search as a backup if nested properties are not found [Bool] (default True)
+    # system_prompts: the system prompt of each parent property, from _read_system_prompt [list of str]
+    # matcher: the PhraseMatcher of the run; compiled from target_dicts if None [PhraseMatcher] (default None)
+    # verbose: whether to announce the extraction of each paper [Bool] (default True)
 
     ### outputs
-    # extracted_records: all the records that were extracted from the provided sentences [dict]
-    # in_tkn: the total # of input tokens passed [int]
-    # out_tkn: the total # of output tokens produced [int]
+    # papers: the parsed paper for each property, keyed by property index [dict]
 
-    # read title and list of sentences from input text file
-    sentences, title = read_sentences(file_path) # assumes first line is the title of the source
+    if matcher is None:
+        matcher = _phrase_matcher(target_dicts)
+
+    text = _read_text(file_path, matcher)
+
+    return {i: _read_paper(file_path, target_dicts[i], MODEL_TYPE, text=text, verbose=verbose, system_prompt=system_prompts[i]) for i in indices}
+
+
+def _read_system_prompt(sp_path, MODEL_TYPE, SYSPROMPT=True):
+
+    ### read the extraction system prompt, or the generic one of the model type if SYSPROMPT is False
+
+    ### inputs
+    # sp_path: the path to a text file that contains the user's desired system prompt [str]
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
+
+    ### outputs
+    # system_prompt: the system prompt [str]
 
-    # read system prompt
     if SYSPROMPT == True: 
-        f = open(sp_path, mode="r", encoding="utf8")
-        system_prompt = f.read()
+        with open(sp_path, mode="r", encoding="utf8") as f:
+            system_prompt = f.read()
     else: 
         if MODEL_TYPE == 'OpenAI':
             system_prompt = ' '
         if MODEL_TYPE == 'Meta':
             system_prompt = 'You are a helpful assistant.'
 
+    return system_prompt
+
+
+def _read_text(file_path, matcher):
+
+    ### read a paper and scan it for required phrases, preparing the parts that every property shares
+
+    ### outputs
+    # text: the sentences, title, phrase hits, IPS indices and excerpts (built when first needed), and abbreviation index of the paper [dict]
+
+    # read title and list of sentences from input text file
+    sentences, title = read_sentences(file_path) # assumes first line is the title of the source
+    count_funnel('Sentences Scanned', len(sentences))
+
+    text = {'Sentences': sentences, 'Title': title, 'Phrase Hits': matcher.scan(sentences), 'IPS Index': {},
+            'Abbreviations': AbbreviationIndex(sentences), 'Excerpts': ExcerptIndex(title, sentences)}
+
+    return text
+
+
+def _read_paper(file_path, target_dict, MODEL_TYPE, sp_path=None, SYSPROMPT=True, text=None, verbose=True, system_prompt=None):
+
+    ### read a paper and its system prompt and select the sentences that pass the required-phrase filter
+
+    ### inputs
+    # file_path: the path to a text file that obeys CatMiner input format [str]
+    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
+    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
+    # text: the paper as read by _read_text, shared between properties; read here if None [dict] (default None)
+    # verbose: whether to announce the extraction [Bool] (default True)
+    # system_prompt: the system prompt, if already read; replaces sp_path and SYSPROMPT [str] (default None)
+
+    ### outputs
+    # paper: the text of the paper with its system prompt, targets, and candidate sentence indices [dict]
+
+    if text is None:
+        text = _read_text(file_path, _phrase_matcher([target_dict]))
+    sentences = text['Sentences']
+
+    # read system prompt
+    if system_prompt is None:
+        system_prompt = _read_system_prompt(sp_path, MODEL_TYPE, SYSPROMPT)
+
     # read target parent properties and optional required phrases to aid in extraction
     property = target_dict['Properties'][0]['Name']
     required_property_phrases = target_dict['Properties'][0]['Required Phrases'] 
@@ -474,269 +774,110 @@ def default(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=N
         operating_conditions.append(target_dict['Operating Conditions'][i]['Name'])
         required_cond_phrases.append(target_dict['Operating Conditions'][i]['Required Phrases'])
 
-    # initialize dictionary of outputs and log
-    extracted_records = {'Source': [], 'Sentence': [], 'Property': [], 
-                         'Property Value': [], 'Material': []}
-    
-    for i, operating_condition in enumerate(operating_conditions):
-        extracted_records[f'Operating Condition {i+1}'] = []
-        extracted_records[f'Operating Condition {i+1} Value'] = []
+    # only sentences with at least one of the required phrases are sent to the LLM
+    candidates = [s for s in range(len(sentences)) if passes(text['Phrase Hits'][s], required_property_phrases)]
+    count_funnel('Phrase-Filtered', len(candidates))
 
-    log = []
+    # and, if a pre-ranker is installed, only those it scores as likely to hold a value
+    candidates = prerank(property, sentences, candidates)
+    count_funnel('Pre-Ranked', len(candidates))
 
-    # initialize token and record counters
-    in_tkn = 0
-    out_tkn = 0
-    rcounts = 0
+    if verbose == True:
+        print(f'Beginning extraction from {len(sentences)} sentences...')
 
-    print(f'Beginning extraction from {len(sentences)} sentences...')
+    paper = {'Source': file_path, **text, 'System Prompt': system_prompt, 
+             'Targets': target_dict, 'Property': property, 'Operating Conditions': operating_conditions, 
+             'Required Condition Phrases': required_cond_phrases, 'Candidates': candidates}
 
-    for s in range(len(sentences)):
+    return paper
 
-        sentence = sentences[s]
 
-        # if we don't have any of the required phrases, continue to the next sentence
-        if not any(phrase in sentence for phrase in required_property_phrases):
-            continue
+def _new_cascade(paper, client, MODEL_TYPE, mode, mode_kwargs, log_sink=None, record_sink=None):
 
-        # reset the context window with or without a system prompt
-        context = []
-        if MODEL_TYPE == 'OpenAI': # append system prompt to context if we're using OpenAI
-            context.append({"role": "system", "content": system_prompt})
+    ### build the prompt cascade of a CatMiner mode for one paper
 
-        # define excerpts for Prompts 3 and 4 
-        excerpt_p3 = getexcerpt(title, sentences, s, target_dict['Properties'][0]['Context Params'])
-        excerpts_p4 = []
-        for i in range(len(target_dict['Operating Conditions'])):
-            excerpt_p4 = getexcerpt(title, sentences, s, target_dict['Operating Conditions'][i]['Context Params'])
-            excerpts_p4.append(excerpt_p4)
+    ### inputs
+    # paper: the parsed paper and extraction targets returned by _read_paper [dict]
+    # client: LLM client defined using our environmental variables
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # mode: the name of the CatMiner implementation to run [str]
+    # mode_kwargs: the FOLLOWUP, IPS, and CHAT settings, and optionally PARALLEL and CONFIDENCE [dict]
+    # log_sink, record_sink: see catmining.cascade.Cascade [function] (default None)
 
-        ### PROMPT 1
-        user_message = prompt1.format(property=property) + sentence
-        try:
-            p1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 1 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
+    ### outputs
+    # cascade: runs the cascade on one sentence at a time with cascade.run(s) [catmining.cascade.Cascade]
 
-        # skip if negatively classified
-        if 'no' in p1_ans.strip().lower(): 
-            log = write_log(context,log,message="Moving to next sentence...")
-            log.append(" ")
-            continue
+    stages = build_stages(mode, FOLLOWUP=mode_kwargs['FOLLOWUP'], IPS=mode_kwargs['IPS'], PARALLEL=mode_kwargs.get('PARALLEL', False))
 
-        ### PROMPT 2
-        user_message = prompt2.format(property=property) + sentence
-        try:
-            p2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 2 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
+    if mode == 'structured':
+        return StructuredCascade(paper, client, MODEL_TYPE, stages, chat=mode_kwargs['CHAT'], log_sink=log_sink, record_sink=record_sink,
+                                 confidence_threshold=mode_kwargs.get('CONFIDENCE', 0.8))
 
-        # if no property values are extracted, skip the sentence
-        if 'none' == p2_ans.strip().lower(): 
-            log = write_log(context,log,message=f'Skipping sentence {s} because no {property} was extracted')
-            log.append(" ")
-            continue
+    return Cascade(paper, client, MODEL_TYPE, stages, chat=mode_kwargs['CHAT'], log_sink=log_sink, record_sink=record_sink)
 
-        # save checkpoint
-        context_p2 = context.copy() # context checkpoint
 
-        # parse property values
-        vals = p2_ans.split(';')
+def _merge_sentence_outputs(sentence_outputs, extracted_records):
 
-        # process the list of values to remove duplicates
-        for val in vals:
-            val = val.strip()
-        vals = list(set(vals)) 
+    ### combine the outputs of the per-sentence cascades of one paper, in sentence order
 
-        # for each value...
-        for val in vals:
+    ### inputs
+    # sentence_outputs: (extracted_records, log, in_tkn, out_tkn, rcounts) for each candidate sentence [list of tuple]
+    # extracted_records: the empty dictionary of outputs to fill, from Cascade.new_records [dict]
 
-            # screen out values that are named "None" or blank spaces
-            # this often happens with, e.g., GPT-3.5 Turbo
-            if val.strip().lower() == 'none' or '': 
-                log = write_log(context,log,message=f'Skipped an invalid property value')
-                log.append(" ")
-                continue
+    ### outputs
+    # extracted_records: all the records that were extracted from the paper [dict]
+    # log: the conversation log for the paper [list]
+    # in_tkn: the total # of input tokens passed [int]
+    # out_tkn: the total # of output tokens produced [int]
 
-            # load context from last checkpoint
-            context = context_p2.copy() 
+    log = []
+    in_tkn = 0
+    out_tkn = 0
+    rcounts = 0
 
-            ### PROMPT 3
-            user_message = prompt3.format(property=property, property_value=val) + excerpt_p3
-            try:
-                p3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-            except Exception as e: 
-                log = write_log(context, log, message=f"Prompt 3 encountered some error: {e}. skipping to the next property value.", verbose=True)
-                continue
+    for sentence_records, sentence_log, sentence_in, sentence_out, sentence_rcounts in sentence_outputs:
+        for key, values in sentence_records.items():
+            extracted_records[key].extend(values)
+        log.extend(sentence_log)
+        in_tkn += sentence_in
+        out_tkn += sentence_out
+        rcounts += sentence_rcounts
 
-            # save checkpoint
-            context_p3 = context.copy() 
+    print(f'Completed extraction of {rcounts} records')
 
-            # parse material names
-            mats = p3_ans.split(';') 
+    return extracted_records, log, in_tkn, out_tkn
 
-            # if there are no materials associated with this value, go to the next one
-            if 'none' == p3_ans.strip().lower():
-                log = write_log(context,log,message=f'Skipped {val} because there are no materials.')
-                continue
 
-            # for each material name...
-            for mat in mats:
-
-                # count the number of materials extracted
-                rcounts += 1
-                print('# record:', rcounts)
-
-                # initiate lists of extracted operating condition values, contexts, and excerpts
-                p4_responses = []
-                p4_contexts = []
-
-                # for each target operating condition...
-                for i, operating_condition in enumerate(operating_conditions):
-
-                    # load context from last checkpoint
-                    context = context_p3.copy() 
-        
-                    ### PROMPT 4 NO IPS 
-                    user_message = prompt4.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + excerpts_p4[i]
-                    try:
-                        p4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Prompt 4 encountered some error: {e}. skipping to the next operating condition.", verbose=True)
-                        p4_responses.append('Error')
-                        continue
-
-                    # if we extracted nothing...
-                    if IPS == True:
-                        if 'none' == p4_ans.strip().lower():
-                            
-                            # replace excerpt 4 with the excerpt retrieved via IPS
-                            excerpts_p4[i] = filter_sentences(sentences, s, required_cond_phrases[i])
-
-                            # load context from last checkpoint
-                            context = context_p3.copy()
-
-                            ### PROMPT 4 IPS -- using a different prompt than the original Prompt 4
-                            user_message = prompt4_ips.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + excerpts_p4[i]
-                            try:
-                                p4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                            except Exception as e:
-                                log = write_log(context, log, message=f"Prompt 4-IP encountered some error: {e}. skipping to the next material.", verbose=True)
-                                p4_responses.append('Error')
-                                continue
-
-                    # save p4_ans and the current chat state
-                    p4_responses.append(p4_ans)
-                    p4_context = context.copy()
-                    p4_contexts.append(p4_context)
-
-                if 1 in FOLLOWUP:
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    ### FOLLOW-UP PROMPT 1
-                    user_message = promptf1.format(material=mat)
-                    try:
-                        pf1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Follow-up 1 encountered some error: {e}. skipping to the next material.", verbose=True)
-                        continue
-                    if 'no' in pf1_ans.strip().lower(): 
-                        log = write_log(context,log,message=f'Skipped {mat} because it is incomplete.')
-                        continue
-
-                if 2 in FOLLOWUP:
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    ### FOLLOW-UP PROMPT 2
-                    user_message = promptf2.format(material=mat)
-                    try:
-                        pf2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 2 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf2_ans.strip().lower(): 
-                        log = write_log(context,log,message=f'Skipped {mat} because it is not specific.')
-                        continue
-
-                if 3 in FOLLOWUP:
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    # FOLLOW-UP PROMPT 3
-                    if CHAT == True: 
-                        user_message = promptf3.format(material=mat, property=property, property_value=val)
-                    if CHAT == False:
-                        user_message = promptf3_nochat.format(material=mat, property=property, property_value=val) + excerpt_p3
-                    
-                    try:
-                        pf3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)  
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 3 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf3_ans.strip().lower(): # if the pair doesn't match... 
-                        log = write_log(context,log,message=f'Threw out {mat}, {val}.')
-                        continue
-
-                if 4 in FOLLOWUP:
-                    # for each target operating condition...
-                    for i, operating_condition in enumerate(operating_conditions):
-                        if not 'none' == p4_responses[i].strip().lower(): 
-
-                            # load context from P4 checkpoint
-                            context = p4_contexts[i].copy()
-
-                            ### FOLLOW-UP PROMPT 4
-                            if CHAT == True:
-                                user_message = promptf4.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i])
-                            if CHAT == False:
-                                user_message = promptf4_nochat.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i]) + excerpts_p4[i]
-                            
-                            try:
-                                pf4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False) 
-                            except Exception as e:
-                                log = write_log(context, log, message=f'Follow-up 4 encountered some error: {e}. skipping to the next material.', verbose=True)
-                                continue
-                            if 'no' in pf4_ans.strip().lower(): # if the nested property doesn't match...
-                                log = write_log(context,log,message=f'Threw out {p4_responses[i]}.')
-                                p4_responses[i] = 'None'
-     
-                # update the record list and counter
-                extracted_records['Source'].append(file_path)
-                extracted_records['Sentence'].append(sentence)
-                extracted_records['Property'].append(property)
-                extracted_records['Property Value'].append(val.strip())
-                extracted_records['Material'].append(mat.strip())
-
-                for i, operating_condition in enumerate(operating_conditions):
-                    extracted_records[f'Operating Condition {i+1}'].append(target_dict['Operating Conditions'][i]['Name'])
-                    extracted_records[f'Operating Condition {i+1} Value'].append(p4_responses[i])
-
-                # update log 
-                log = write_log(context,log,message=f'Extracted {mat}, {val}.')        
-
-        log.append(f'Extracted sentence {s}')
-        log.append(" ")
+def _extract_paper(file_path, client, target_dict, MODEL_TYPE, mode, sp_path=None, log_path=None, 
+                   log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], IPS=True, CHAT=True, CONFIDENCE=0.8):
 
-    print(f'Completed extraction of {rcounts} records')
-    
-    # write chat to CSV log file
+    ### run one CatMiner mode on every candidate sentence of a paper; see default() for the inputs and outputs
+
+    paper = _read_paper(file_path, target_dict, MODEL_TYPE, sp_path, SYSPROMPT)
+
+    # write chat to the log file as the cascade goes
+    log_sink = _discard_log
     if log_bool == True:
-        logfile_dict = {'Chats': log}
-        logfile_df = pd.DataFrame(data=logfile_dict)
-        logfile_df.to_csv(log_path, mode='a', index=False)
+        log_writer = LogWriter(log_path)
+        log_writer.begin()
+        log_sink = functools.partial(log_writer.write, file_path, paper['Property'])
+
+    try:
+        cascade = _new_cascade(paper, client, MODEL_TYPE, mode, {'FOLLOWUP': FOLLOWUP, 'IPS': IPS, 'CHAT': CHAT, 'CONFIDENCE': CONFIDENCE}, log_sink)
+
+        # run the cascade on every sentence that passed the required-phrase filter
+        sentence_outputs = [cascade.run(s) for s in paper['Candidates']]
+        extracted_records, _, in_tkn, out_tkn = _merge_sentence_outputs(sentence_outputs, cascade.new_records())
+
+    finally:
+        if log_bool == True:
+            log_writer.close()
 
     return extracted_records, in_tkn, out_tkn
 
 
-def test_mode(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
-              log_bool=True, SYSPROMPT=True, FOLLOWUP=True, IPS=True, CHAT=True):
-    
-    ### this is a test mode of CatMiner that applies and records the results of all follow-up prompts without throwing out any records
-    # this enables us to see the performance of any arbitrary combination of follow-up prompts
+def abbreviation_resolution(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
+                            log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], IPS=True, CHAT=True):
 
     # TODO: read all the hyperparameters in from an input file
     
@@ -753,335 +894,91 @@ def test_mode(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path
     # IPS: True if we should use inter-paragraph search as a backup if nested properties are not found [Bool] (default True)
 
     ### outputs
-    # extracted_records: all the pairs/triplets that were extracted from the provided sentences [dict]
+    # extracted_records: all the records that were extracted from the provided sentences [dict]
     # in_tkn: the total # of input tokens passed [int]
     # out_tkn: the total # of output tokens produced [int]
 
-    # read title and list of sentences from input text file
-    sentences, title = read_sentences(file_path) # assumes first line is the title of the source
+    return _extract_paper(file_path, client, target_dict, MODEL_TYPE, 'abbreviation_resolution', sp_path=sp_path, log_path=log_path, 
+                          log_bool=log_bool, SYSPROMPT=SYSPROMPT, FOLLOWUP=FOLLOWUP, IPS=IPS, CHAT=CHAT)
 
-    # read system prompt
-    if SYSPROMPT == True: 
-        f = open(sp_path, mode="r", encoding="utf8")
-        system_prompt = f.read()
-    else: 
-        if MODEL_TYPE == 'OpenAI':
-            system_prompt = ' '
-        if MODEL_TYPE == 'Meta':
-            system_prompt = 'You are a helpful assistant.'
 
-    # read target parent properties and optional required phrases to aid in extraction
-    property = target_dict['Properties'][0]['Name']
-    required_property_phrases = target_dict['Properties'][0]['Required Phrases'] 
-    
-    operating_conditions = [] 
-    required_cond_phrases = []
-    for i in range(len(target_dict['Operating Conditions'])):
-        operating_conditions.append(target_dict['Operating Conditions'][i]['Name'])
-        required_cond_phrases.append(target_dict['Operating Conditions'][i]['Required Phrases'])
+def default(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
+            log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], IPS=True, CHAT=True):
 
-    # initialize dictionary of outputs and log
-    extracted_records = {'Source': [], 'Sentence': [], 'Property': [], 
-                         'Property Value': [], 'Material': [], 'F1 Response': [], 
-                         'F2 Response': [], 'F3 Response': []}
+    # TODO: read all the hyperparameters in from an input file
     
-    for i, operating_condition in enumerate(operating_conditions):
-        extracted_records[f'Operating Condition {i+1}'] = []
-        extracted_records[f'Operating Condition {i+1} Value'] = []
-        extracted_records[f'Operating Condition {i+1} Value (IPS)'] = []
-        extracted_records[f'Operating Condition {i+1} F4 Response'] = []
-        extracted_records[f'Operating Condition {i+1} F4-IPS Response'] = []
-
-    log = []
-
-    # initialize token and record counters
-    in_tkn = 0
-    out_tkn = 0
-    rcounts = 0
-
-    print(f'Beginning extraction from {len(sentences)} sentences...')
-
-    for s in range(len(sentences)):
-
-        sentence = sentences[s]
-
-        # if we don't have any of the required phrases, continue to the next sentence
-        if not any(phrase in sentence for phrase in required_property_phrases):
-            continue
-
-        # reset the context window with or without a system prompt
-        context = []
-        if MODEL_TYPE == 'OpenAI': # append system prompt to context if we're using OpenAI
-            context.append({"role": "system", "content": system_prompt})
-
-        # define excerpts for Prompts 3 and 4 
-        excerpt_p3 = getexcerpt(title, sentences, s, target_dict['Properties'][0]['Context Params'])
-        excerpts_p4 = []
-        for i in range(len(target_dict['Operating Conditions'])):
-            excerpt_p4 = getexcerpt(title, sentences, s, target_dict['Operating Conditions'][i]['Context Params'])
-            excerpts_p4.append(excerpt_p4)
-
-        ### PROMPT 1
-        user_message = prompt1.format(property=property) + sentence
-        try:
-            p1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 1 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
-
-        # skip if negatively classified
-        if 'no' in p1_ans.strip().lower(): 
-            log = write_log(context,log,message="Moving to next sentence...")
-            log.append(" ")
-            continue
-
-        ### PROMPT 2
-        user_message = prompt2.format(property=property) + sentence
-        try:
-            p2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-        except Exception as e:
-            log = write_log(context, log, message=f"Prompt 2 encountered some error: {e}. skipping to the next sentence.", verbose=True)
-            continue
-
-        # if no property values are extracted, skip the sentence
-        if 'none' == p2_ans.strip().lower(): 
-            log = write_log(context,log,message=f'Skipping sentence {s} because no {property} was extracted')
-            log.append(" ")
-            continue
+    ### inputs
+    # file_path: the path to a text file that obeys CatMiner input format (i.e., title in the first line, each following line is a new sentence) [str]
+    # client: LLM client defined using our environmental variables
+    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
+    # log_path: the path to a csv file that the log should be written to [str] (default None)
+    # write_log: True if we should write the LLM conversation to a CSV file, False if not [Bool] (default True)
+    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
+    # FOLLOWUP: True if we should apply follow-up questions to interrogate material-property pairs, False if not [Bool] (default True)
+    # IPS: True if we should use inter-paragraph search as a backup if nested properties are not found [Bool] (default True)
 
-        # save checkpoint
-        context_p2 = context.copy() # context checkpoint
+    ### outputs
+    # extracted_records: all the records that were extracted from the provided sentences [dict]
+    # in_tkn: the total # of input tokens passed [int]
+    # out_tkn: the total # of output tokens produced [int]
 
-        # parse property values
-        vals = p2_ans.split(';')
+    return _extract_paper(file_path, client, target_dict, MODEL_TYPE, 'default', sp_path=sp_path, log_path=log_path, 
+                          log_bool=log_bool, SYSPROMPT=SYSPROMPT, FOLLOWUP=FOLLOWUP, IPS=IPS, CHAT=CHAT)
 
-        # process the list of values to remove duplicates
-        for val in vals:
-            val = val.strip()
-        vals = list(set(vals)) 
 
-        # for each value...
-        for val in vals:
+def test_mode(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
+              log_bool=True, SYSPROMPT=True, FOLLOWUP=True, IPS=True, CHAT=True):
+    
+    ### this is a test mode of CatMiner that applies and records the results of all follow-up prompts without throwing out any records
+    # this enables us to see the performance of any arbitrary combination of follow-up prompts
 
-            # screen out values that are named "None" or blank spaces
-            # this often happens with, e.g., GPT-3.5 Turbo
-            if val.strip().lower() == 'none' or '': 
-                log = write_log(context,log,message=f'Skipped an invalid property value')
-                log.append(" ")
-                continue
+    # TODO: read all the hyperparameters in from an input file
+    
+    ### inputs
+    # file_path: the path to a text file that obeys CatMiner input format (i.e., title in the first line, each following line is a new sentence) [str]
+    # client: LLM client defined using our environmental variables
+    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
+    # log_path: the path to a csv file that the log should be written to [str] (default None)
+    # write_log: True if we should write the LLM conversation to a CSV file, False if not [Bool] (default True)
+    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
+    # FOLLOWUP: True if we should apply follow-up questions to interrogate material-property pairs, False if not [Bool] (default True)
+    # IPS: True if we should use inter-paragraph search as a backup if nested properties are not found [Bool] (default True)
 
-            # load context from last checkpoint
-            context = context_p2.copy() 
+    ### outputs
+    # extracted_records: all the pairs/triplets that were extracted from the provided sentences [dict]
+    # in_tkn: the total # of input tokens passed [int]
+    # out_tkn: the total # of output tokens produced [int]
 
-            ### PROMPT 3
-            user_message = prompt3.format(property=property, property_value=val) + excerpt_p3
-            try:
-                p3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-            except Exception as e: 
-                log = write_log(context, log, message=f"Prompt 3 encountered some error: {e}. skipping to the next property value.", verbose=True)
-                continue
+    return _extract_paper(file_path, client, target_dict, MODEL_TYPE, 'test_mode', sp_path=sp_path, log_path=log_path, 
+                          log_bool=log_bool, SYSPROMPT=SYSPROMPT, FOLLOWUP=FOLLOWUP, IPS=IPS, CHAT=CHAT)
 
-            # save checkpoint
-            context_p3 = context.copy() 
 
-            # parse material names
-            mats = p3_ans.split(';') 
+def structured(file_path, client, target_dict, MODEL_TYPE, sp_path=None, log_path=None, 
+               log_bool=True, SYSPROMPT=True, FOLLOWUP=[3], CHAT=True, CONFIDENCE=0.8):
 
-            # if there are no materials associated with this value, go to the next one
-            if 'none' == p3_ans.strip().lower():
-                log = write_log(context,log,message=f'Skipped {val} because there are no materials.')
-                continue
+    ### this is a single-call alternative to the cascade: each candidate sentence is asked for all of its records at once,
+    # as JSON, and only the records the model is less confident about than CONFIDENCE are checked with the follow-ups
 
-            # for each material name...
-            for mat in mats:
-
-                # count the number of materials extracted
-                rcounts += 1
-                print('# record:', rcounts)
-
-                # initiate lists of extracted operating condition values, contexts, and excerpts
-                p4_responses = []
-                p4_ips_responses = []
-                p4_contexts = []
-                p4_ips_contexts = []
-                pf4_responses = []
-                pf4_ips_responses = []
-                ips_excerpts = []
-
-                # for each target operating condition...
-                for i, operating_condition in enumerate(operating_conditions):
-
-                    # load context from last checkpoint
-                    context = context_p3.copy() 
-        
-                    ### PROMPT 4 NO IPS 
-                    user_message = prompt4.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + excerpts_p4[i]
-                    try:
-                        p4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                        p4_responses.append(p4_ans)
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Prompt 4 encountered some error: {e}. skipping to the next operating condition.", verbose=True)
-                        p4_responses.append('Error')
-                        continue
-
-                    # save checkpoint
-                    p4_context = context.copy()
-                    p4_contexts.append(p4_context)
-
-                    # if we extracted nothing...
-                    if IPS == True:
-                        if 'none' == p4_ans.strip().lower():
-
-                            excerpt_ips = filter_sentences(sentences, s, required_cond_phrases[i])
-                            ips_excerpts.append(excerpt_ips)
-
-                            # load context from last checkpoint
-                            context = context_p3.copy()
-
-                            ### PROMPT 4 IPS -- using a different prompt than the original Prompt 4
-                            user_message = prompt4_ips.format(operating_condition=operating_condition, material=mat, property=property, property_value=val) + ips_excerpts[i]
-                            try:
-                                p4_ips_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=True)
-                                p4_ips_responses.append(p4_ips_ans)
-                            except Exception as e:
-                                log = write_log(context, log, message=f"Prompt 4-IP encountered some error: {e}. skipping to the next material.", verbose=True)
-                                p4_ips_responses.append('Error')
-                                continue
-
-                            # save checkpoint
-                            p4_ips_context = context.copy()
-                            p4_ips_contexts.append(p4_ips_context)
-
-                        else:
-                            p4_ips_responses.append('None')
-                            pf4_ips_responses.append('None')
-                            ips_excerpts.append('None')
-
-                # apply follow-up prompts TODO support multiple operating conditions here; I *think* I've got it working above but need to do some testing
-                if FOLLOWUP == True:
-
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    ### FOLLOW-UP PROMPT 1
-                    user_message = promptf1.format(material=mat)
-                    try:
-                        pf1_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f"Follow-up 1 encountered some error: {e}. skipping to the next material.", verbose=True)
-                        continue
-                    if 'no' in pf1_ans.strip().lower(): # if we are...
-                        log = write_log(context,log,message=f'Skipped {mat} because it is incomplete.')
-
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    ### FOLLOW-UP PROMPT 2
-                    user_message = promptf2.format(material=mat)
-                    try:
-                        pf2_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)                        
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 2 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf2_ans.strip().lower(): # if we are...
-                        log = write_log(context,log,message=f'Skipped {mat} because it is not specific.')
-
-                    # load context from P3 checkpoint
-                    context = context_p3.copy() 
-
-                    # FOLLOW-UP PROMPT 3
-                    if CHAT == True: 
-                        user_message = promptf3.format(material=mat, property=property, property_value=val)
-                    if CHAT == False:
-                        user_message = promptf3_nochat.format(material=mat, property=property, property_value=val) + excerpt_p3
-                    
-                    try:
-                        pf3_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)  
-                    except Exception as e:
-                        log = write_log(context, log, message=f'Follow-up 3 encountered some error: {e}. skipping to the next material.', verbose=True)
-                        continue
-                    if 'no' in pf3_ans.strip().lower(): # if the pair doesn't match... 
-                        log = write_log(context,log,message=f'Threw out {mat}, {val}.')
-
-                    # try the last follow-up if we had any operating conditions extracted with or without IPS...
-                    # for each target operating condition...
-                    for i, operating_condition in enumerate(operating_conditions):
-                        if not 'none' == p4_responses[i].strip().lower(): 
-
-                            # load context from P4 checkpoint
-                            context = p4_contexts[i].copy()
-
-                            ### FOLLOW-UP PROMPT 4 NO IPS
-                            if CHAT == True:
-                                user_message = promptf4.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i])
-                            if CHAT == False:
-                                user_message = promptf4_nochat.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_responses[i]) + excerpts_p4[i]
-                            
-                            try:
-                                pf4_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False) 
-                                pf4_responses.append(pf4_ans)
-                            except Exception as e:
-                                log = write_log(context, log, message=f'Follow-up 4 encountered some error: {e}. skipping to the next material.', verbose=True)
-                                pf4_responses.append('Error')
-                                continue
-                            if 'no' in pf4_ans.strip().lower(): # if the nested property doesn't match...
-                                log = write_log(context,log,message=f'Threw out {p4_ans}.')
-
-                        else:
-                            pf4_responses.append('None')
-
-                        # if IPS retrieved an operating condition...
-                        if not 'none' == p4_ips_responses[i].strip().lower():
-
-                            # load context from IPS checkpoint 
-                            context = p4_ips_contexts[i].copy()
-                            
-                            ### FOLLOW-UP PROMPT 4 IPS
-                            if CHAT == True:
-                                user_message = promptf4.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_ips_responses[i])
-                            if CHAT == False:
-                                user_message=promptf4_nochat.format(material=mat, property=property, property_value=val, operating_condition=operating_condition, operating_condition_value=p4_ips_responses[i]) + ips_excerpts[i]
-
-                            try:
-                                pf4_ips_ans, context, in_tkn, out_tkn, log = prompt(MODEL_TYPE, client, context, CHAT, system_prompt, user_message, in_tkn, out_tkn, log, append=False)  
-                                pf4_ips_responses.append(pf4_ips_ans)
-                            except Exception as e:
-                                log = write_log(context, log, message=f'Follow-up 4 encountered some error: {e}. skipping to the next material.', verbose=True)
-                                pf4_ips_responses.append('Error')
-                                continue
-
-                        else:
-                            pf4_ips_responses.append('None')
-     
-                # update the record list and counter
-                extracted_records['Source'].append(file_path)
-                extracted_records['Sentence'].append(sentence)
-                extracted_records['Property'].append(property)
-                extracted_records['Property Value'].append(val.strip())
-                extracted_records['Material'].append(mat.strip())
-                extracted_records['F1 Response'].append(pf1_ans.strip())
-                extracted_records['F2 Response'].append(pf2_ans.strip())
-                extracted_records['F3 Response'].append(pf3_ans.strip())
-
-                for i, operating_condition in enumerate(operating_conditions):
-                    extracted_records[f'Operating Condition {i+1}'].append(target_dict['Operating Conditions'][i]['Name'])
-                    extracted_records[f'Operating Condition {i+1} Value'].append(p4_responses[i])
-                    extracted_records[f'Operating Condition {i+1} Value (IPS)'].append(p4_ips_responses[i])
-                    extracted_records[f'Operating Condition {i+1} F4 Response'].append(pf4_responses[i])
-                    extracted_records[f'Operating Condition {i+1} F4-IPS Response'].append(pf4_ips_responses[i])
-
-                # update log 
-                log = write_log(context,log,message=f'Extracted {mat}, {val}.')        
-
-        log.append(f'Extracted sentence {s}')
-        log.append(" ")
+    ### inputs
+    # file_path: the path to a text file that obeys CatMiner input format (i.e., title in the first line, each following line is a new sentence) [str]
+    # client: LLM client defined using our environmental variables
+    # target_dict: a dictionary that defines all target variables and the context windows associated with each one [dict]
+    # MODEL_TYPE: type of LLM we are expecting (supported values are 'OpenAI' and 'Meta') [str]
+    # sp_path: the path to a text file that contains the user's desired system prompt [str] (default None)
+    # log_path: the path to a csv file that the log should be written to [str] (default None)
+    # write_log: True if we should write the LLM conversation to a CSV file, False if not [Bool] (default True)
+    # SYSPROMPT: True if we should use the extraction system prompt, False if not [Bool] (default True)
+    # FOLLOWUP: the follow-up prompts to apply to low-confidence records [list] (default [3])
+    # CONFIDENCE: the self-reported confidence below which a record is followed up on [float] (default 0.8)
 
-    print(f'Completed extraction of {rcounts} records')
-    
-    # write chat to CSV log file
-    if log_bool == True:
-        logfile_dict = {'Chats': log}
-        logfile_df = pd.DataFrame(data=logfile_dict)
-        logfile_df.to_csv(log_path, mode='a', index=False)
+    ### outputs
+    # extracted_records: all the records that were extracted from the provided sentences [dict]
+    # in_tkn: the total # of input tokens passed [int]
+    # out_tkn: the total # of output tokens produced [int]
 
-    return extracted_records, in_tkn, out_tkn
+    return _extract_paper(file_path, client, target_dict, MODEL_TYPE, 'structured', sp_path=sp_path, log_path=log_path, 
+                          log_bool=log_bool, SYSPROMPT=SYSPROMPT, FOLLOWUP=FOLLOWUP, IPS=False, CHAT=CHAT, CONFIDENCE=CONFIDENCE)
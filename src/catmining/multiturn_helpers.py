@@ -1,46 +1,453 @@
-from fireworks.client import Fireworks
-from openai import AzureOpenAI
+from catmining.phrases import passes
+from catmining.backends import DEFAULT_PARAMS, as_backend, create_backend
+from catmining.cache import ResponseCache
+from catmining.retry import EmptyResponse, classify_error
+from catmining.batch import BatchClient, OpenAIBatchService, BedrockBatchService, LocalBatchService
 import itertools
+import bisect
+import threading
 import boto3
 import time
 import os
 
 
-def define_client(client_type):
+# rate limiter shared by every prompt() call that does not pass its own (see set_rate_limiter)
+_rate_limiter = None
+
+# response cache consulted by every prompt() call (see set_response_cache)
+_response_cache = None
+
+# provider-side prompt caching used by every prompt() call (see set_prompt_caching)
+_prompt_caching = None
+
+# transcript replayed and recorded by every prompt() call (see set_transcript)
+_transcript = None
+
+# per-stage metrics and funnel counts of the current run (see set_metrics)
+_metrics = None
+
+# token or dollar budget that every prompt() call is charged to (see set_budget)
+_budget = None
+
+# when failed prompt() calls are resent (see set_retry_policy)
+_retry_policy = None
+
+# answers about material names shared across sentences and papers (see set_verdict_store)
+_verdicts = None
+
+# relevance model that screens candidate sentences before Prompt 1 (see set_preranker)
+_preranker = None
+
+
+def define_client(client_type, backend=None, **kwargs):
 
     ### define the client variable based on the model type
 
     ### inputs:
-    # client_type: the service we are using to host the model (supported options: Azure, Bedrock, Fireworks) [str]
+    # client_type: the service we are using to host the model (supported options: Azure, Bedrock, Fireworks, Local
+    #              (an OpenAI-compatible server at LOCAL_BASE_URL), any type added with catmining.backends.register_backend,
+    #              and the batch-inference services AzureBatch, BedrockBatch, LocalBatch) [str]
+    # backend: (LocalBatch only) the regular client that answers the local batch jobs; if None, the jobs wait
+    #          for LocalBatchService.process() to be run on them [default None]
+    # kwargs: settings of the backend, e.g. model, params={'max_tokens': 400}, pool_size, and keepalive_expiry
+    #         (not for Bedrock). batch clients only take params
 
     ### outputs:
-    # client: the LLM client 
-
-    if client_type == 'Azure':
-        
-        client = AzureOpenAI(
-            api_key=os.environ['API_KEY'],  
-            api_version=os.environ['API_VERSION'],
-            azure_endpoint = os.environ['AZURE_ENDPOINT'],
-            organization = os.environ['ORGANIZATION_ID']
-            )
-        
-    elif client_type == 'Bedrock':
-
-        client = boto3.client(service_name='bedrock-runtime', 
-            region_name=os.environ['AWS_REGION']
-            )
-        
-    elif client_type == 'Fireworks':
-
-        client = Fireworks(api_key=os.environ['FIREWORKS_API_KEY'])
+    # client: the LLM client [catmining.backends.Backend or catmining.batch.BatchClient]
+
+    if client_type == 'AzureBatch':
+
+        client = BatchClient(OpenAIBatchService(define_client('Azure').client, endpoint='/chat/completions'))
+
+    elif client_type == 'BedrockBatch':
+
+        client = BatchClient(BedrockBatchService(
+            boto3.client(service_name='bedrock', region_name=os.environ['AWS_REGION']),
+            boto3.client(service_name='s3', region_name=os.environ['AWS_REGION']),
+            bucket=os.environ['BATCH_BUCKET'],
+            role_arn=os.environ['BATCH_ROLE_ARN']
+            ))
+
+    elif client_type == 'LocalBatch':
+
+        client = BatchClient(LocalBatchService(os.environ['BATCH_DIR'], backend=backend), poll_interval=1.0)
 
     else:
-        print('Provided client type is not supported. Supported client types are Azure, Bedrock, and Fireworks.')
+
+        return create_backend(client_type, **kwargs)
+
+    # read by as_backend when the batch requests are built
+    client.params = kwargs.get('params')
 
     return client
 
 
+class RateLimiter:
+
+    ### token-bucket limiter on requests and tokens per minute with AIMD control of in-flight LLM calls
+    # every call waits for a request token, an estimate of its input + output tokens, and a concurrency slot.
+    # the concurrency limit grows by ~1 per round of successful calls and halves whenever the provider throttles us;
+    # calls that fail for any other reason leave it as it is.
+
+    ### inputs:
+    # requests_per_minute: the provider request quota, or None for no request limit [float] (default None)
+    # tokens_per_minute: the provider token quota (input + output), or None for no token limit [float] (default None)
+    # max_concurrency: the largest number of calls allowed in flight at once [int] (default 8)
+    # min_concurrency: the concurrency limit is never decreased below this [int] (default 1)
+    # cooldown: seconds during which no new calls start after a throttling response [float] (default 1.0)
+    # max_retries: how many times a throttled call is resent before the error is raised, unless a RetryPolicy is
+    #              installed (see set_retry_policy) [int] (default 5)
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=8, min_concurrency=1,
+                 cooldown=1.0, max_retries=5):
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+
+        # start at the ceiling and let throttling responses bring us down
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+
+        # buckets start full so the first minute of quota is usable immediately
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._resume_at = 0.0
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+
+        # top up both buckets in proportion to the time elapsed since the last refill
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed*self.requests_per_minute/60)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed*self.tokens_per_minute/60)
+
+    def _wait_time(self, now, tokens):
+
+        # seconds until a call needing this many tokens may start, ignoring the concurrency limit
+        wait = max(0.0, self._resume_at - now)
+        if self.requests_per_minute is not None and self._requests < 1:
+            wait = max(wait, (1 - self._requests)*60/self.requests_per_minute)
+        if self.tokens_per_minute is not None and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens)*60/self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens=0):
+
+        ### block until a call estimated to use this many tokens may be sent
+
+        # a single call larger than the whole bucket would otherwise wait forever
+        if self.tokens_per_minute is not None:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, tokens)
+                if wait == 0 and self.in_flight < int(self.concurrency):
+                    break
+                # wake up when quota has refilled, or when a call in flight finishes
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+            if self.requests_per_minute is not None:
+                self._requests -= 1
+            if self.tokens_per_minute is not None:
+                self._tokens -= tokens
+            self.in_flight += 1
+
+    def release(self, estimated_tokens=0, used_tokens=None, outcome='success'):
+
+        ### return a concurrency slot, settle the token estimate against actual usage, and adapt the concurrency limit
+
+        ### inputs:
+        # estimated_tokens: the tokens the call was acquired with [int] (default 0)
+        # used_tokens: the input + output tokens the call reported, or None if it failed [int] (default None)
+        # outcome: 'success', 'throttled', or 'failed' (any other error) [str] (default 'success')
+
+        with self._condition:
+            self.in_flight -= 1
+            if self.tokens_per_minute is not None and used_tokens is not None:
+                self._tokens -= used_tokens - min(estimated_tokens, self.tokens_per_minute)
+
+            if outcome == 'throttled':
+                # multiplicative decrease, and pause new calls while the provider recovers
+                self.throttled += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency/2)
+                self._resume_at = time.monotonic() + self.cooldown
+            elif outcome == 'success':
+                # additive increase of one slot per full round of successful calls
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1/self.concurrency)
+
+            self._condition.notify_all()
+
+
+def set_rate_limiter(limiter):
+
+    ### install the rate limiter shared by all prompt() calls
+
+    ### inputs:
+    # limiter: the shared limiter, or None to disable rate limiting [RateLimiter]
+
+    ### outputs:
+    # previous: the limiter that was installed before this call [RateLimiter]
+
+    global _rate_limiter
+    previous = _rate_limiter
+    _rate_limiter = limiter
+
+    return previous
+
+
+def set_response_cache(cache):
+
+    ### install the response cache consulted by all prompt() calls
+
+    ### inputs:
+    # cache: the shared cache, or None to disable caching [catmining.cache.ResponseCache]
+
+    ### outputs:
+    # previous: the cache that was installed before this call [catmining.cache.ResponseCache]
+
+    global _response_cache
+    previous = _response_cache
+    _response_cache = cache
+
+    return previous
+
+
+def set_transcript(transcript):
+
+    ### install the transcript replayed and recorded by all prompt() calls
+
+    ### inputs:
+    # transcript: the shared transcript, or None to neither replay nor record [catmining.cache.Transcript]
+
+    ### outputs:
+    # previous: the transcript that was installed before this call [catmining.cache.Transcript]
+
+    global _transcript
+    previous = _transcript
+    _transcript = transcript
+
+    return previous
+
+
+def set_metrics(metrics):
+
+    ### install the metrics that all prompt() calls and the cascade funnel are counted in
+
+    ### inputs:
+    # metrics: the shared metrics, or None to count nothing [catmining.metrics.Metrics]
+
+    ### outputs:
+    # previous: the metrics that were installed before this call [catmining.metrics.Metrics]
+
+    global _metrics
+    previous = _metrics
+    _metrics = metrics
+
+    return previous
+
+
+def set_retry_policy(policy):
+
+    ### install the retry policy of all prompt() calls
+
+    ### inputs:
+    # policy: the shared policy, or None to only resend throttled calls, as paced by the rate limiter [catmining.retry.RetryPolicy]
+
+    ### outputs:
+    # previous: the policy that was installed before this call [catmining.retry.RetryPolicy]
+
+    global _retry_policy
+    previous = _retry_policy
+    _retry_policy = policy
+
+    return previous
+
+
+def set_verdict_store(store):
+
+    ### install the store that the cascade reuses material verdicts (AR1, F1, F2) from
+
+    ### inputs:
+    # store: the shared store, or None to ask every question [catmining.cache.VerdictStore]
+
+    ### outputs:
+    # previous: the store that was installed before this call [catmining.cache.VerdictStore]
+
+    global _verdicts
+    previous = _verdicts
+    _verdicts = store
+
+    return previous
+
+
+def set_preranker(ranker):
+
+    ### install the pre-ranker that screens the candidate sentences of every paper before Prompt 1
+
+    ### inputs:
+    # ranker: the trained pre-ranker, or None to send every candidate sentence [catmining.prerank.PreRanker]
+
+    ### outputs:
+    # previous: the pre-ranker that was installed before this call [catmining.prerank.PreRanker]
+
+    global _preranker
+    previous = _preranker
+    _preranker = ranker
+
+    return previous
+
+
+def prerank(property, sentences, candidates):
+
+    ### the candidate sentence indices that the installed pre-ranker (if any) lets through to Prompt 1
+
+    if _preranker is None:
+        return candidates
+
+    return _preranker.keep(property, sentences, candidates)
+
+
+def verdict_store():
+
+    ### the installed verdict store, or None
+
+    return _verdicts
+
+
+def set_budget(budget):
+
+    ### install the budget that all prompt() calls are charged to
+
+    ### inputs:
+    # budget: the shared budget, or None for no limit [catmining.budget.Budget]
+
+    ### outputs:
+    # previous: the budget that was installed before this call [catmining.budget.Budget]
+
+    global _budget
+    previous = _budget
+    _budget = budget
+
+    return previous
+
+
+def budget_allows(feature):
+
+    ### whether an optional part of the cascade ('IPS' or 'Follow-ups') is still within the installed budget
+
+    return _budget is None or _budget.allows(feature)
+
+
+class BudgetExceeded(Exception):
+
+    ### raised instead of sending a call that could overrun the installed budget; the run stops and can be resumed
+
+    pass
+
+
+def count_replayed(stage):
+
+    ### count a call of a cascade stage that was answered without the model, e.g. from the verdict store
+
+    if _metrics is not None:
+        _metrics.observe(stage, replayed=True)
+
+
+def count_funnel(step, n=1):
+
+    ### advance a step of the extraction funnel (see catmining.metrics.FUNNEL) in the installed metrics
+
+    if _metrics is not None:
+        _metrics.count(step, n)
+
+
+class PromptCaching:
+
+    ### provider-side prompt caching: marks the stable prefix of each request and counts the input tokens read from
+    # the provider cache. OpenAI caches prompt prefixes automatically, so only the usage is read. Bedrock caches up to
+    # a cachePoint block, so one is placed after the system prompt and one after the conversation history that the new
+    # prompt extends. within a sentence the cascade only ever appends to (or branches from) earlier conversations,
+    # so the system prompt, the sentence, and the excerpts already form byte-identical prefixes.
+
+    def __init__(self):
+
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.written_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, input_tokens, cached_tokens=0, written_tokens=0):
+
+        ### count the input tokens of one call, of which cached_tokens were read from and written_tokens written to the cache
+
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.cached_tokens += cached_tokens
+            self.written_tokens += written_tokens
+
+    def summary(self):
+
+        ### one line summary of the provider cache use in this run
+
+        share = 100*self.cached_tokens/self.input_tokens if self.input_tokens else 0.0
+
+        return (f'Provider prompt cache: {self.cached_tokens} of {self.input_tokens} input tokens read from the cache '
+                f'({share:.1f}%), {self.input_tokens - self.cached_tokens} uncached, {self.written_tokens} written to the cache.')
+
+
+def set_prompt_caching(caching):
+
+    ### install the provider-side prompt caching used by all prompt() calls
+
+    ### inputs:
+    # caching: the shared prompt caching, or None to send requests unmarked and not count cached tokens [PromptCaching]
+
+    ### outputs:
+    # previous: the prompt caching that was installed before this call [PromptCaching]
+
+    global _prompt_caching
+    previous = _prompt_caching
+    _prompt_caching = caching
+
+    return previous
+
+
+def _estimate_tokens(context, sysprompt=None, max_tokens=DEFAULT_PARAMS['max_tokens']):
+
+    ### estimate the input + output tokens of a call (about four characters per token) before sending it
+
+    chars = len(sysprompt) if sysprompt else 0
+    for message in context:
+        chars += len(_message_text(message))
+
+    return chars//4 + max_tokens
+
+
+def _message_text(message):
+
+    ### the text of a message in either the 'OpenAI' or the 'Meta' format
+
+    content = message['content']
+    if isinstance(content, str):
+        return content
+
+    return ''.join(block.get('text', '') for block in content)
+
+
 def read_sentences(file_path):
 
     ### parse title and sentences from a preprocessed article text file
@@ -62,89 +469,254 @@ def read_sentences(file_path):
     return sentences, title
 
 
+class Conversation:
+
+    ### immutable conversation in which every message points back at the conversation it extends
+    # appending returns a new conversation that shares all earlier messages, so a checkpoint is just a reference and
+    # branching from it costs O(1). the message list sent to the provider is only built when the conversation is
+    # iterated, i.e. when it is sent or logged. Conversation() is the empty conversation.
+
+    __slots__ = ('parent', 'message', 'length')
+
+    def __init__(self):
+
+        self.parent = None
+        self.message = None
+        self.length = 0
+
+    def append(self, message):
+
+        ### the conversation extended by one message in the provider format [dict]
+
+        conversation = Conversation.__new__(Conversation)
+        conversation.parent = self
+        conversation.message = message
+        conversation.length = self.length + 1
+
+        return conversation
+
+    def copy(self):
+
+        # conversations never change, so a copy is the conversation itself
+        return self
+
+    def __len__(self):
+
+        return self.length
+
+    def __iter__(self):
+
+        messages = []
+        conversation = self
+        while conversation.parent is not None:
+            messages.append(conversation.message)
+            conversation = conversation.parent
+
+        return reversed(messages)
+
+    def __repr__(self):
+
+        return repr(list(self))
+
+
+def _as_conversation(context):
+
+    # conversations given as a list of messages are rebuilt as a Conversation
+    if isinstance(context, Conversation):
+        return context
+
+    conversation = Conversation()
+    for message in context:
+        conversation = conversation.append(message)
+
+    return conversation
+
+
 def _append_context(context, model_type, role, message):
 
     ### append a user prompt or LLM response to the context dictionary
 
     ### inputs:
-    # context: all previous messages in the conversation [list of dict]
+    # context: all previous messages in the conversation [Conversation or list of dict]
     # model_type: type of LLM we are expecting (supported options are 'OpenAI' and 'Meta') [str]
     # role: who delivered the message (supported options are "assistant" or "user") [str]
     # message: the message to append [str]
 
     ### outputs:
-    # context: the conversation with the newest message appended [list of dict]
+    # context: the conversation with the newest message appended; the given context is left as it was [Conversation]
+
+    context = _as_conversation(context)
 
     if model_type == 'OpenAI':
-        context.append({"role": role, "content": message})
+        context = context.append({"role": role, "content": message})
 
     if model_type == 'Meta':
-        context.append({"role": role, "content": [{"text": message}]})
+        context = context.append({"role": role, "content": [{"text": message}]})
 
     return context
 
 
-def _get_ans(model_type, client, context, sysprompt=None, sleep_time=0.0):
+def _get_ans(model_type, client, context, sysprompt=None, sleep_time=0.0, limiter=None, cache=None, caching=None,
+             transcript=None, stage=None, params=None):
 
     ### get the LLM response and token counts
 
     ### inputs: 
     # model_type: type of LLM we are expecting (supported options are 'OpenAI' and 'Meta') [str]
-    # client: the LLM client (Azure, Bedrock, or Fireworks)
-    # context: the query along with all previous messages in the conversation [list of dict]
+    # client: the LLM client, a catmining.backends.Backend or a client it can wrap (see as_backend)
+    # context: the query along with all previous messages in the conversation [Conversation or list of dict]
     # sysprompt: (if using Meta) the system prompt [str] (default None)
     # sleep_time: delay in seconds imposed after a model call. Can be used to obey API rate limits [float] (default 0.0)
+    # limiter: the rate limiter to obey; the shared limiter is used if None [RateLimiter] (default None)
+    # cache: the response cache to consult; the shared cache is used if None [ResponseCache] (default None)
+    # caching: the provider-side prompt caching; the shared one is used if None [PromptCaching] (default None)
+    # transcript: the transcript to replay and record; the shared one is used if None [Transcript] (default None)
+    # stage: the cascade step the call is counted under in the installed metrics, e.g. 'P1' [str] (default None)
+    # params: sampling parameters for this call only, e.g. a larger 'max_tokens' or a 'json_schema' for the answer,
+    #         see catmining.backends.Backend.complete [dict] (default None)
 
     ### outputs:
     # ans: the LLM response [str]
-    # new_in_tkns: the amount of input tokens passed by this prompt [int]
-    # new_out_tkns: the amount of output tokens produced by this prompt [int]
+    # new_in_tkns: the amount of input tokens passed by this prompt, 0 if answered from a transcript or the cache [int]
+    # new_out_tkns: the amount of output tokens produced by this prompt, 0 if answered from a transcript or the cache [int]
+
+    if cache is None:
+        cache = _response_cache
+    if limiter is None:
+        limiter = _rate_limiter
+    if caching is None:
+        caching = _prompt_caching
+    if transcript is None:
+        transcript = _transcript
+    metrics = _metrics
+    budget = _budget
+
+    # the message list is only built here, when the conversation is sent
+    context = list(context)
+    backend = as_backend(client, model_type)
+
+    call_params = {**backend.params, **(params or {})}
+    if cache is not None or transcript is not None:
+        # default sampling parameters are left out of the key, so caches from before they were configurable still hit
+        key = ResponseCache.key(backend.model, sysprompt, context, call_params if call_params != DEFAULT_PARAMS else None)
+
+    # a recorded or cached conversation costs no tokens and does not count against the rate limits
+    if transcript is not None:
+        replayed = transcript.get(key)
+        if replayed is not None:
+            if metrics is not None:
+                metrics.observe(stage, replayed=True)
+            return replayed[0], 0, 0
+
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            if transcript is not None:
+                transcript.put(key, _message_text(context[-1]), *cached)
+            if metrics is not None:
+                metrics.observe(stage, replayed=True)
+            return cached[0], 0, 0
+
+    estimated_tokens = _estimate_tokens(context, sysprompt, call_params['max_tokens'])
+    if budget is not None and budget.exceeded_by(estimated_tokens):
+        raise BudgetExceeded(budget.summary())
+
+    # resend calls that failed for a passing reason; anything else goes back to the caller
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        if limiter is not None:
+            waited = time.monotonic()
+            limiter.acquire(estimated_tokens)
+            if metrics is not None:
+                metrics.wait(time.monotonic() - waited)
+        try:
+            ans, new_in_tkns, new_out_tkns = _call_model(backend, context, sysprompt, caching, metrics, stage, params)
+        except Exception as e:
+            kind = classify_error(e)
+            if limiter is not None:
+                limiter.release(estimated_tokens, outcome='throttled' if kind == 'throttled' else 'failed')
+            delay = _retry_delay(_retry_policy, limiter, kind, e, attempt, started)
+            if delay is None:
+                if budget is not None:
+                    budget.release(estimated_tokens)
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if limiter is not None:
+            limiter.release(estimated_tokens, new_in_tkns + new_out_tkns)
+        break
 
-    if model_type == 'OpenAI':
-    
-        response = client.chat.completions.create(
-            model=os.environ['model'],
-            messages=context,
-            temperature=0,
-            max_tokens=100, 
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-
-        ans = response.choices[0].message.content
-        new_in_tkns = response.usage.prompt_tokens
-        new_out_tkns = response.usage.completion_tokens
+    if budget is not None:
+        budget.spend(new_in_tkns, new_out_tkns, estimated_tokens)
+    if cache is not None and isinstance(ans, str):
+        cache.put(key, ans, new_in_tkns, new_out_tkns)
+    if transcript is not None and isinstance(ans, str):
+        transcript.put(key, _message_text(context[-1]), ans, new_in_tkns, new_out_tkns)
 
-    if model_type == 'Meta':
+    time.sleep(sleep_time)
 
-        # save response 
-        response = client.converse(
-            modelId=os.environ['MODEL_ID'],
-            messages=context,
-            system=[{"text": sysprompt}],
-            inferenceConfig={"temperature": 0.0, "topP": 0.0, "maxTokens": 100},
-            performanceConfig={"latency": "optimized"}
-        )
+    return ans, new_in_tkns, new_out_tkns
 
-        ans = response['output']['message']['content'][0]['text']
-        new_in_tkns = response['usage']['inputTokens']
-        new_out_tkns = response['usage']['outputTokens']
 
-    ans = ans.strip()
+def _retry_delay(policy, limiter, kind, e, attempt, started):
 
-    time.sleep(sleep_time)
+    ### seconds to wait before resending a failed call, or None to raise its error (see catmining.retry.RetryPolicy.delay)
+
+    # without a policy, only throttled calls are resent, as soon as the rate limiter lets them through
+    if policy is None:
+        if limiter is not None and kind == 'throttled' and attempt < limiter.max_retries:
+            return 0.0
+        return None
+
+    return policy.delay(e, attempt, started)
+
+
+def _call_model(backend, context, sysprompt=None, caching=None, metrics=None, stage=None, params=None):
+
+    ### send one request to the LLM backend and read the response and token counts
+
+    ### inputs:
+    # backend: the backend that answers [catmining.backends.Backend]
+    # metrics: the metrics to count the call in, or None [catmining.metrics.Metrics] (default None)
+    # see _get_ans for the others
+
+    ### outputs:
+    # see _get_ans
+
+    started = time.monotonic()
+    try:
+        completion = backend.complete(context, sysprompt, {**(params or {}), 'cache_prefix': caching is not None})
+        # sometimes, the API outputs a NoneType object instead of a response string as expected
+        if not isinstance(completion['Text'], str):
+            raise EmptyResponse(f"Expected a string, but got {type(completion['Text']).__name__}")
+    except Exception:
+        if metrics is not None:
+            metrics.observe(stage, time.monotonic() - started, error=True)
+        raise
+    if metrics is not None:
+        metrics.observe(stage, time.monotonic() - started, completion['Input Tokens'], completion['Output Tokens'])
+
+    ans = completion['Text']
+    new_in_tkns = completion['Input Tokens']
+    new_out_tkns = completion['Output Tokens']
+    if caching is not None:
+        caching.record(new_in_tkns, completion['Cached Tokens'], completion['Written Tokens'])
+
+    ans = ans.strip()
 
     return ans, new_in_tkns, new_out_tkns
 
 
-def prompt(model_type, client, context, chat, sysprompt, user_message, in_tkn, out_tkn, log, append):
+def prompt(model_type, client, context, chat, sysprompt, user_message, in_tkn, out_tkn, log, append, stage=None, params=None):
     
     ### prompt the LLM and update the conversation log and the token count
    
     ### inputs:
     # model_type: type of LLM we are expecting (supported options are 'OpenAI' and 'Meta') [str]
     # client: the LLM client (Azure, Bedrock, or Fireworks)
-    # context: the query along with all previous messages in the conversation [list of dict]
+    # context: the query along with all previous messages in the conversation [Conversation or list of dict]
     # chat: whether chat-like memory is enabled [Bool]
     # sysprompt: the system prompt [str]
     # user_message: the prompt given by the user [str]
@@ -152,23 +724,20 @@ def prompt(model_type, client, context, chat, sysprompt, user_message, in_tkn, o
     # out_tkn: the number of output tokens produced thus far [int]
     # log: the current log of all relevant outputs [list of dicts]
     # append: whether we should append the model answer to our conversation [Bool]
+    # stage: the cascade step this prompt belongs to, counted in the installed metrics [str] (default None)
+    # params: sampling parameters for this prompt only (see _get_ans) [dict] (default None)
 
     ### outputs:
     # ans: the LLM response [str]
+    # context: the conversation including the prompt (and the answer if append is True) [Conversation]
     # in_tkn: the number of input tokens passed thus far [int]
     # out_tkn: the number of output tokens produced thus far [int]
 
     # update context as needed
-    if chat == True:
-        context = _append_context(context, model_type, "user", user_message)
-    if chat == False:
-        context = [] # tabula rasa
-        if model_type == 'OpenAI': # append system prompt to context if we're using OpenAI
-            context.append({"role": "system", "content": sysprompt})
-        context = _append_context(context, model_type, "user", user_message)
+    context = _prepare_context(model_type, context, chat, sysprompt, user_message)
 
     # query model and count tokens
-    ans, new_in_tkns, new_out_tkns = _get_ans(model_type, client, context, sysprompt)
+    ans, new_in_tkns, new_out_tkns = _get_ans(model_type, client, context, sysprompt, stage=stage, params=params)
 
     # update total token counts
     in_tkn = in_tkn + new_in_tkns
@@ -184,6 +753,38 @@ def prompt(model_type, client, context, chat, sysprompt, user_message, in_tkn, o
     return ans, context, in_tkn, out_tkn, log
 
 
+def _prepare_context(model_type, context, chat, sysprompt, user_message):
+
+    ### add a user prompt to the conversation, or start a new conversation with it if chat-like memory is disabled
+
+    if chat == True:
+        context = _append_context(context, model_type, "user", user_message)
+    if chat == False:
+        context = Conversation() # tabula rasa
+        if model_type == 'OpenAI': # append system prompt to context if we're using OpenAI
+            context = context.append({"role": "system", "content": sysprompt})
+        context = _append_context(context, model_type, "user", user_message)
+
+    return context
+
+
+def replay(model_type, context, chat, sysprompt, user_message, ans, append=True):
+
+    ### add a prompt and an answer obtained elsewhere to the conversation, exactly as prompt() would have
+
+    ### inputs:
+    # see prompt; ans is the already known LLM response [str]
+
+    ### outputs:
+    # context: the conversation with the prompt (and the answer if append is True) appended [Conversation]
+
+    context = _prepare_context(model_type, context, chat, sysprompt, user_message)
+    if append == True:
+        context = _append_context(context, model_type, "assistant", ans)
+
+    return context
+
+
 def write_log(context, log, message=None, verbose=False):
 
     ### update the CatMiner log
@@ -197,8 +798,8 @@ def write_log(context, log, message=None, verbose=False):
     ### output:
     # log: the log as input + the appended context and message [list of dict]
 
-    for c in range(len(context)):
-        log.append(context[c])
+    for c in context:
+        log.append(c)
     log.append(message)
 
     #print(f'log so far: {log}')
@@ -227,23 +828,52 @@ def getexcerpt(title, sentences, s, params):
     F = params['Bounds'][1]
     T = params['Title']
 
-    # initiate excerpt
-    if T == True:
-        excerpt = title + '. '
-    elif T == False:
-        excerpt = ''
+    # the sentences of the desired context that are within the paper, each followed by a space
+    parts = [title + '. '] if T == True else []
+    parts.extend(str(sentences[idx]) + ' ' for idx in range(max(s-P, 0), min(s+F+1, len(sentences))))
 
-    # run for one iteration per sentence in the desired context
-    for i in range(P+F+1):
-        idx = s-P+i
+    return ''.join(parts)
 
-        # skip the sentence if the index is out of bounds
-        if ((idx < 0) or (idx > len(sentences))):
-            continue
-        else:
-            excerpt = excerpt + str(sentences[idx]) + ' '
 
-    return excerpt
+class ExcerptIndex:
+
+    ### per-paper excerpt service: the sentences are joined once into one buffer, each followed by a space, so that
+    # the excerpt of any window (see getexcerpt) is a slice of it between two precomputed offsets. windows are cached
+    # by the sentences they cover, so the P3 and P4 excerpts of a sentence, and those of neighbouring sentences whose
+    # windows clip to the same span at the edges of the paper, are only built once.
+
+    ### inputs:
+    # title: the title of the paper [str]
+    # sentences: all the sentences of the paper [list]
+
+    def __init__(self, title, sentences):
+
+        self.title = title
+        self._buffer = ''.join(str(sentence) + ' ' for sentence in sentences)
+        self._starts = [0]
+        for sentence in sentences:
+            self._starts.append(self._starts[-1] + len(str(sentence)) + 1)
+        self._windows = {}
+
+    def __len__(self):
+
+        return len(self._starts) - 1
+
+    def get(self, s, params):
+
+        ### the same excerpt as getexcerpt(title, sentences, s, params)
+
+        lo = max(s - params['Bounds'][0], 0)
+        hi = max(min(s + params['Bounds'][1] + 1, len(self)), lo)
+        key = (lo, hi, params['Title'] == True)
+        excerpt = self._windows.get(key)
+        if excerpt is None:
+            excerpt = self._buffer[self._starts[lo]:self._starts[hi]]
+            if key[2]:
+                excerpt = self.title + '. ' + excerpt
+            excerpt = self._windows.setdefault(key, excerpt)
+
+        return excerpt
 
 
 def obtain_abbreviation_defs(sentences, phrase, delimiters=['/', ' ', '-', '–', '@']):
@@ -254,76 +884,84 @@ def obtain_abbreviation_defs(sentences, phrase, delimiters=['/', ' ', '-', '–'
     # sentences: a list of sentences in the source text to choose from [list]
     # phrase: a string that has been classified as either being or containing an acronym [str]
     # delimiters: characters used to tokenize the provided phrase and check for subphrase acronyms [list]
-    # min_phrase_length: the minimum length required to retrieve a source sentence for a subphrase [int]
 
     ### outputs:
     # defs: a collection of sentences that may contain the definition of the provided acronym(s) [str]
-    
-    # initialize subphrase dictionary and delimiter permutation count
-    perm_dict = {}
-    perm_count = 0
 
-    # obtain all possible orderings of our delimiters
-    delimiter_orders = itertools.permutations(delimiters,len(delimiters))
+    return AbbreviationIndex(sentences).defs(phrase, delimiters)
 
-    for perm in delimiter_orders:
-        
-        delimiter_permutation = list(perm)
 
-        # reset initial subphrase level
-        subphrases = [[phrase]]
+class AbbreviationIndex:
 
-        for i in range(len(delimiter_permutation)): 
+    ### per-paper index for finding the sentences that may define an abbreviation
+    # every sentence is filed under the character trigrams it contains, so the first sentence containing a
+    # (sub)phrase is found by checking only the sentences that share its rarest trigram.
+    # resolved keeps the AR2 exchange of each material name, so a repeated abbreviation is resolved only once per paper.
 
-            subphrases.append([]) # define next level of subphrases
+    ### inputs:
+    # sentences: a list of sentences in the source text to choose from [list]
 
-            for subphrase in subphrases[i]: # for each phrase in the current level...
-                for j in range(len(subphrase.split(delimiter_permutation[i]))): 
-                    subphrases[i+1].append(subphrase.split(delimiter_permutation[i])[j]) # add its subphrases to the next level
+    def __init__(self, sentences):
 
-        # append these subphrases to a dictionary and then try the next permutation of delimiters
-        perm_dict[perm_count] = subphrases
-        perm_count += 1
+        self.sentences = sentences
+        self.resolved = {}
 
-    # combine all subphrases into a single list and remove duplicates
-    all_subphrases = []
-    for key in range(perm_count):
-        for level in range(len(delimiters)+1):
-            for i in range(len(perm_dict[key][level])):
-                all_subphrases.append(perm_dict[key][level][i])
+        # the trigrams are only filed once an abbreviation has to be resolved in this paper
+        self._grams = None
+        self._lock = threading.Lock()
 
-    # remove duplicates
-    unique_subphrases = list(set(all_subphrases))
-    
-    # get the first sentence in the source text that includes each (sub)phrase
-    # initialize list of definition sentences
-    defs_list = []
-
-    for subphrase in unique_subphrases:
-
-        if len(subphrase) > 2:
-            try:
-                index = [idx for idx, s in enumerate(sentences) if subphrase in s][0]
-                defs_list.append(sentences[index])
-            except:
-                continue       
-        else:
-            continue
+    def _index(self):
+
+        with self._lock:
+            if self._grams is None:
+                grams = {}
+                for k, sentence in enumerate(self.sentences):
+                    for gram in {sentence[j:j+3] for j in range(len(sentence) - 2)}:
+                        grams.setdefault(gram, []).append(k)
+                self._grams = grams
+
+        return self._grams
+
+    def first(self, subphrase):
+
+        ### the index of the first sentence containing a subphrase of at least three characters, or None
+
+        grams = self._index()
+        postings = [grams.get(subphrase[j:j+3], []) for j in range(len(subphrase) - 2)]
+        for k in min(postings, key=len):
+            if subphrase in self.sentences[k]:
+                return k
+
+        return None
 
-    # remove duplicate definition sentences
-    defs_list = list(set(defs_list))
+    def defs(self, phrase, delimiters=['/', ' ', '-', '–', '@']):
 
-    # initialize single string of definition sentences
-    defs = ''
-    # collate into a single string with new lines in between each sentence
-    for sentence in defs_list:
-        defs += sentence
-        defs += '\n\n'
+        ### see obtain_abbreviation_defs
 
-    return defs
+        # splitting on the delimiters one after another, in every order, yields the pieces of the phrase split on
+        # every subset of the delimiters
+        subphrases = set()
+        for n in range(len(delimiters) + 1):
+            for subset in itertools.combinations(delimiters, n):
+                pieces = [phrase]
+                for delimiter in subset:
+                    pieces = [piece for p in pieces for piece in p.split(delimiter)]
+                subphrases.update(pieces)
 
+        # get the first sentence in the source text that includes each (sub)phrase longer than two characters
+        indices = {self.first(subphrase) for subphrase in subphrases if len(subphrase) > 2}
+        indices.discard(None)
 
-def filter_sentences(sentences, s, required_phrases=None):
+        # collate the definition sentences in the order of the paper, with new lines in between each sentence
+        defs = ''
+        for k in sorted(indices):
+            defs += self.sentences[k]
+            defs += '\n\n'
+
+        return defs
+
+
+def filter_sentences(sentences, s, required_phrases=None, hits=None):
     
     ### append all the candidate sentences for far-field NERRE in a position-aware manner
 
@@ -331,30 +969,74 @@ def filter_sentences(sentences, s, required_phrases=None):
     # sentences: ordered list of all sentences contained in the source document [list]
     # s: the index of the current target sentence in the source document [int]
     # required_phrases: strings that must be present in a retrieved excerpt to consider scoring it [list] (default None)
+    # hits: the phrases found in each sentence by a PhraseMatcher that includes required_phrases, 
+    #       so the sentences need not be searched again [list of frozenset] (default None)
 
     ### outputs
     # context: the new context to be supplied to the LLM for inter-paragraph search [str]
 
-    filtered_sentences = []
-
-    for sentence in sentences: 
-        if any(x in sentence for x in required_phrases):
-            filtered_sentences.append(sentence)
-        else:
-            filtered_sentences.append('...')
+    return IPSIndex(sentences, required_phrases, hits).render(s)
 
-    # indicate where our current target sentence is
-    filtered_sentences[s] = sentences[s] + ' <-- We are here'
 
-    filtered_sentences_cleaned = [filtered_sentences[0]]
+class IPSIndex:
 
-    for sentence in filtered_sentences[1:]:
-        if sentence != filtered_sentences_cleaned[-1]:
-            filtered_sentences_cleaned.append(sentence)
-        
-    context = ''
+    ### the filtered view of a paper used for inter-paragraph search (IPS), built once per paper and condition
+    # sentences without a required phrase are shown as '...', and runs of identical lines are collapsed into one.
+    # render() marks the target sentence by rebuilding only the lines next to it, so the cost of a sentence does not
+    # grow with the number of candidate sentences in the paper.
 
-    for sentence in filtered_sentences_cleaned:
-        context += sentence + '\n'
-
-    return context
+    ### inputs
+    # see filter_sentences
+
+    def __init__(self, sentences, required_phrases=None, hits=None):
+
+        self.sentences = sentences
+
+        # collapse the unmarked view into lines, remembering the sentences and characters each line covers
+        self._lines = []
+        self._first = []
+        self._starts = [0]
+        for k, sentence in enumerate(sentences):
+            if (passes(hits[k], required_phrases) if hits is not None else any(x in sentence for x in required_phrases)):
+                line = sentence
+            else:
+                line = '...'
+            if not self._lines or line != self._lines[-1]:
+                self._lines.append(line)
+                self._first.append(k)
+                self._starts.append(self._starts[-1] + len(line) + 1)
+
+        self._view = ''.join(line + '\n' for line in self._lines)
+
+    def render(self, s):
+
+        ### the IPS context with the target sentence marked
+
+        ### inputs
+        # s: the index of the current target sentence in the source document [int]
+
+        ### outputs
+        # context: the new context to be supplied to the LLM for inter-paragraph search [str]
+
+        # the line holding sentence s, and the sentences it stands for
+        e = bisect.bisect_right(self._first, s) - 1
+        end = self._first[e + 1] if e + 1 < len(self._first) else len(self.sentences)
+
+        # split that line around the marked sentence
+        lines = []
+        if self._first[e] < s:
+            lines.append(self._lines[e])
+        lines.append(self.sentences[s] + ' <-- We are here')
+        if s + 1 < end:
+            lines.append(self._lines[e])
+
+        # collapse again where the split lines meet their neighbours
+        lo = max(e - 1, 0)
+        hi = min(e + 2, len(self._lines))
+        window = self._lines[lo:e] + lines + self._lines[e+1:hi]
+        collapsed = [window[0]]
+        for line in window[1:]:
+            if line != collapsed[-1]:
+                collapsed.append(line)
+
+        return self._view[:self._starts[lo]] + ''.join(line + '\n' for line in collapsed) + self._view[self._starts[hi]:]
@@ -0,0 +1,39 @@
+class PhraseMatcher:
+
+    ### the required phrases of every property and condition of a run, matched once per sentence
+    # the property and condition phrase lists are merged, so each distinct phrase is looked up once per sentence
+    # and the hits are shared between every property and condition that is extracted. the lookup is Python's
+    # substring search, which runs in C and is faster than a regular expression or automaton over these few phrases.
+
+    ### inputs:
+    # phrase_lists: the required phrase lists to match, e.g. one per property and one per condition [list of list]
+
+    def __init__(self, phrase_lists):
+
+        # every phrase is matched literally and case-sensitively, like `phrase in sentence`
+        self.phrases = list(dict.fromkeys(phrase for phrases in phrase_lists for phrase in phrases if isinstance(phrase, str)))
+
+    def match(self, sentence):
+
+        ### every phrase contained in a sentence
+
+        ### inputs:
+        # sentence: the text to scan [str]
+
+        ### outputs:
+        # hits: the phrases that occur in the sentence [frozenset]
+
+        return frozenset(phrase for phrase in self.phrases if phrase in sentence)
+
+    def scan(self, sentences):
+
+        ### the phrase hits of each sentence of a paper
+
+        return [self.match(sentence) for sentence in sentences]
+
+
+def passes(hits, required_phrases):
+
+    ### check a sentence's phrase hits against a required phrase list, like `any(phrase in sentence for phrase in required_phrases)`
+
+    return any(phrase in hits for phrase in required_phrases)
@@ -0,0 +1,288 @@
+from catmining.multiturn_helpers import _message_text
+from catmining.prompts import prompt1
+import random
+import math
+import gzip
+import json
+import csv
+import ast
+import re
+import os
+
+
+### Offline pre-ranker that skips Prompt 1 on sentences that are unlikely to hold a value of the property.
+# The required-phrase filter only checks that, e.g., '%' is in a sentence; the pre-ranker scores the sentences that
+# pass it with a TF-IDF + logistic regression model per property, trained on the Prompt 1 answers of earlier runs
+# (logs or transcripts). It runs on the CPU in pure Python. Each property's cut-off is set from out-of-fold scores
+# so that the chosen share (recall) of the sentences Prompt 1 said "Yes" to is still sent.
+
+
+# Prompt 1 as it appears in a conversation: the property in the prompt, then the sentence
+_PROMPT1 = re.compile(re.escape(prompt1).replace(re.escape('{property}'), '(?P<property>.+?)') + '(?P<sentence>.*)', re.S)
+
+# words, numbers, and the symbols that mark reported values
+_TOKEN = re.compile(r'[A-Za-z]+|\d+(?:[.,]\d+)?|[%°~≈<>±]')
+
+
+def _features(sentence):
+
+    ### the lexical features of a sentence: lowercased words and symbols, numbers by magnitude, and word bigrams
+
+    tokens = []
+    for token in _TOKEN.findall(sentence):
+        if token[0].isdigit():
+            number = float(token.replace(',', '.'))
+            token = f'<num:{len(str(int(number)))}>' if number >= 1 else '<num:frac>'
+        tokens.append(token.lower())
+
+    features = set(tokens)
+    features.update(f'{a} {b}' for a, b in zip(tokens, tokens[1:]))
+
+    return features
+
+
+def _sigmoid(z):
+
+    if z >= 0:
+        return 1/(1 + math.exp(-z))
+    e = math.exp(z)
+
+    return e/(1 + e)
+
+
+def load_examples(paths):
+
+    ### read the Prompt 1 answers of earlier runs as training examples
+
+    ### inputs:
+    # paths: CatMiner logs ('.csv', '.jsonl', or '.jsonl.gz') and/or transcripts (see catmining.cache.Transcript) [list of str]
+
+    ### outputs:
+    # examples: (property, sentence, whether Prompt 1 said yes) for every distinct sentence and property [list of tuple]
+
+    examples = {}
+    for path in paths:
+        for prompt, ans in _read_exchanges(path):
+            match = _PROMPT1.fullmatch(prompt)
+            if match is not None:
+                # the cascade moves on to Prompt 2 unless the answer contains "no"
+                examples[(match['property'], match['sentence'])] = 'no' not in ans.strip().lower()
+
+    return [(property, sentence, label) for (property, sentence), label in examples.items()]
+
+
+def _read_exchanges(path):
+
+    # (prompt, answer) pairs of a log or transcript; logs repeat the conversation every time it is logged.
+    # as for catmining.writers.LogWriter, anything that is not JSONL is a '.csv' log
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, mode='rt', encoding='utf8', newline='') as f:
+
+        if not path.endswith(('.jsonl', '.jsonl.gz')):
+            entries = (row[0] for row in csv.reader(f) if row and row[0] != 'Chats')
+        else:
+            entries = []
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'Key' in entry:
+                    # a transcript line
+                    yield entry['Prompt'], entry['Answer']
+                else:
+                    entries.append(entry['Entry'])
+
+        previous = None
+        for entry in entries:
+            message = _as_message(entry)
+            if message is not None and previous is not None and previous['role'] == 'user' and message['role'] == 'assistant':
+                yield _message_text(previous), _message_text(message)
+            previous = message
+
+
+def _as_message(entry):
+
+    # '.csv' logs hold the repr of each message, '.jsonl' logs the message itself; anything else is a note
+    if isinstance(entry, str) and entry.startswith('{'):
+        try:
+            entry = ast.literal_eval(entry)
+        except (ValueError, SyntaxError):
+            return None
+    if isinstance(entry, dict) and 'role' in entry and 'content' in entry:
+        return entry
+
+    return None
+
+
+class PreRanker:
+
+    ### per-property relevance model between the required-phrase filter and Prompt 1
+
+    ### inputs:
+    # recall: the share of the sentences Prompt 1 would say "Yes" to that are still sent [float] (default 0.98)
+
+    def __init__(self, recall=0.98):
+
+        self.recall = recall
+        self.idf = {}
+        self.models = {}
+
+    def fit(self, examples, folds=5, epochs=20, learning_rate=0.5, l2=1e-4, seed=0):
+
+        ### train one model per property on past Prompt 1 answers
+
+        ### inputs:
+        # examples: (property, sentence, label) as returned by load_examples [list of tuple]
+        # folds: the cross-validation folds used to set the cut-off of each property [int] (default 5)
+        # epochs, learning_rate, l2: settings of the AdaGrad logistic regression [int, float, float]
+        # seed: seed of the example order [int] (default 0)
+
+        ### outputs:
+        # self [PreRanker]
+
+        # inverse document frequencies over every sentence seen
+        sentences = list(dict.fromkeys(sentence for property, sentence, label in examples))
+        counts = {}
+        for sentence in sentences:
+            for feature in _features(sentence):
+                counts[feature] = counts.get(feature, 0) + 1
+        self.idf = {feature: math.log((1 + len(sentences))/(1 + n)) + 1 for feature, n in counts.items()}
+
+        by_property = {}
+        for property, sentence, label in examples:
+            by_property.setdefault(property, []).append((self._vector(sentence), 1 if label else 0))
+
+        rng = random.Random(seed)
+        for property, data in by_property.items():
+            positives = sum(y for x, y in data)
+            # a property needs both answers to learn from; otherwise all of its sentences are sent
+            k = min(folds, positives, len(data) - positives)
+            if k < 2:
+                continue
+            rng.shuffle(data)
+
+            # score every positive with a model that did not see it, so the cut-off reflects unseen sentences
+            held_out = []
+            for fold in range(k):
+                train = [example for j, example in enumerate(data) if j % k != fold]
+                weights, bias = _train(train, epochs, learning_rate, l2, rng)
+                held_out.extend(_score(x, weights, bias) for j, (x, y) in enumerate(data) if j % k == fold and y == 1)
+
+            weights, bias = _train(data, epochs, learning_rate, l2, rng)
+            self.models[property] = {'Weights': weights, 'Bias': bias, 'Positive Scores': sorted(held_out)}
+
+        return self
+
+    def _vector(self, sentence):
+
+        # L2-normalized TF-IDF weights of the features of a sentence (each counted once)
+        vector = {feature: self.idf[feature] for feature in _features(sentence) if feature in self.idf}
+        norm = math.sqrt(sum(value*value for value in vector.values())) or 1.0
+
+        return {feature: value/norm for feature, value in vector.items()}
+
+    def score(self, property, sentence):
+
+        ### the estimated probability that Prompt 1 says "Yes", or None if there is no model for the property
+
+        model = self.models.get(property)
+        if model is None:
+            return None
+
+        return _score(self._vector(sentence), model['Weights'], model['Bias'])
+
+    def threshold(self, property, recall=None):
+
+        ### the lowest score still sent to Prompt 1 for a property at the given recall (default self.recall)
+
+        model = self.models.get(property)
+        if model is None:
+            return 0.0
+
+        recall = self.recall if recall is None else recall
+        scores = model['Positive Scores']
+
+        return scores[min(len(scores) - 1, max(0, math.floor((1 - recall)*len(scores))))]
+
+    def keep(self, property, sentences, candidates):
+
+        ### the candidate sentence indices that are worth sending to Prompt 1
+
+        if property not in self.models:
+            return candidates
+
+        threshold = self.threshold(property)
+
+        return [s for s in candidates if self.score(property, sentences[s]) >= threshold]
+
+    def save(self, path):
+
+        with open(path, mode='w', encoding='utf8') as f:
+            json.dump({'Recall': self.recall, 'IDF': self.idf, 'Models': self.models}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+
+        with open(path, encoding='utf8') as f:
+            saved = json.load(f)
+        ranker = cls(saved['Recall'])
+        ranker.idf = saved['IDF']
+        ranker.models = saved['Models']
+
+        return ranker
+
+    def summary(self):
+
+        lines = [f'Pre-ranker at {100*self.recall:g}% recall:']
+        for property, model in self.models.items():
+            lines.append(f"  {property}: cut-off {self.threshold(property):.3f} ({len(model['Positive Scores'])} positive examples)")
+
+        return '\n'.join(lines)
+
+
+def _score(x, weights, bias):
+
+    return _sigmoid(bias + sum(weights.get(feature, 0.0)*value for feature, value in x.items()))
+
+
+def _train(data, epochs, learning_rate, l2, rng):
+
+    # logistic regression by AdaGrad over sparse feature dictionaries
+    weights = {}
+    squares = {}
+    bias = 0.0
+    bias_square = 0.0
+    order = list(range(len(data)))
+    for _ in range(epochs):
+        rng.shuffle(order)
+        for j in order:
+            x, y = data[j]
+            error = _score(x, weights, bias) - y
+            for feature, value in x.items():
+                w = weights.get(feature, 0.0)
+                grad = error*value + l2*w
+                squares[feature] = squares.get(feature, 0.0) + grad*grad
+                weights[feature] = w - learning_rate*grad/math.sqrt(squares[feature] + 1e-8)
+            bias_square += error*error
+            bias -= learning_rate*error/math.sqrt(bias_square + 1e-8)
+
+    return weights, bias
+
+
+if __name__ == '__main__':
+
+    # python -m catmining.prerank ranker.json logs/*.csv --recall 0.98
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train the Prompt 1 pre-ranker on the logs or transcripts of earlier runs.')
+    parser.add_argument('output', help='where to save the trained pre-ranker (JSON)')
+    parser.add_argument('paths', nargs='+', help="CatMiner logs ('.csv', '.jsonl', '.jsonl.gz') or transcripts")
+    parser.add_argument('--recall', type=float, default=0.98)
+    args = parser.parse_args()
+
+    examples = load_examples([path for path in args.paths if os.path.exists(path)])
+    print(f'Training on {len(examples)} Prompt 1 answers ({sum(label for p, s, label in examples)} "Yes").')
+    ranker = PreRanker(args.recall).fit(examples)
+    ranker.save(args.output)
+    print(ranker.summary())
@@ -1,5 +1,9 @@
 prompt1 = ('Answer "Yes" or "No" only. Does the following text contain a value of {property}?\n\n')
 
+prompt1_multi = ('For each property in the list below, does the following text contain a value of that property? '
+                 'Reply only with a JSON object that maps each property name, exactly as written, to "Yes" or '
+                 '"No".\n\nProperties: {properties}\n\nText:\n\n')
+
 prompt2 = ('Use only data present in the sentence. If data is not present in the sentence, type '
            '"None". Please list each {property} value reported in the following sentence in a '
            'single semicolon-separated line with no additional text. Modifiers such as >, <, ≈, '
@@ -57,3 +61,13 @@ prompt_ar2 = ('You said that the name "{material}" is or contains an abbreviatio
               'what is the full name of "{material}"? Please do not leave in any letters that a reader might '
               'incorrectly confuse with an atomic symbol. Please respond *only* with the fully resolved '
               'name. If none can be inferred, please reply "None".\n\n')
+
+prompt_json = ('List every {property} value reported in the sentence below, each with the catalyst that gives it '
+               'and the operating conditions ({operating_conditions}) under which it was measured. Reply only with '
+               'a JSON object of the form {{"records": [{{"value": "...", "material": "...", "conditions": '
+               '{{"<operating condition>": "..."}}, "confidence": 0.0}}]}}, with one record per value and catalyst, '
+               'or {{"records": []}} if no {property} value is reported. Modifiers such as >, <, ≈, —, and ~ are '
+               'allowed in values. If dopants, supports, or promoters are mentioned, include them in the material '
+               'name. If an operating condition is not given, use "None". confidence is how sure you are, from 0 '
+               'to 1, that the record is correct and complete. Base your answer only on the sentence and the '
+               'passage around it:\n\n')
@@ -0,0 +1,150 @@
+from email.utils import parsedate_to_datetime
+import threading
+import datetime
+import random
+import time
+
+
+class EmptyResponse(TypeError):
+
+    ### the model answered without any text (e.g., a NoneType content), which a resent call usually fixes
+
+    pass
+
+
+# Bedrock error codes (boto3 ClientError) by how a call that raised them should be handled
+_THROTTLING_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+_RETRYABLE_CODES = {'InternalServerException', 'ServiceUnavailableException', 'ModelNotReadyException',
+                    'ModelTimeoutException', 'ModelStreamErrorException', 'RequestTimeout', 'RequestTimeoutException'}
+
+
+def is_throttling_error(e):
+
+    ### check whether an exception raised by an LLM client means we exceeded the provider rate limit
+
+    # OpenAI-style clients (Azure, Fireworks, local servers) raise errors carrying the HTTP status code
+    if getattr(e, 'status_code', None) == 429:
+        return True
+
+    # boto3 raises a ClientError whose response names the error
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code', '') in _THROTTLING_CODES:
+            return True
+
+    return False
+
+
+def classify_error(e):
+
+    ### sort an exception raised by an LLM call into 'throttled', 'retryable' (worth resending), or 'fatal'
+
+    if is_throttling_error(e):
+        return 'throttled'
+
+    if isinstance(e, (EmptyResponse, ConnectionError, TimeoutError)):
+        return 'retryable'
+
+    status = getattr(e, 'status_code', None)
+    if isinstance(status, int):
+        # timeouts, conflicts, and server errors pass; bad requests, auth, and missing models do not
+        return 'retryable' if status >= 500 or status in (408, 409) else 'fatal'
+
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        error = response.get('Error', {})
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if error.get('Code', '') in _RETRYABLE_CODES or (isinstance(status, int) and status >= 500):
+            return 'retryable'
+        return 'fatal'
+
+    # connection and read timeouts of the HTTP libraries (httpx, openai, botocore) do not share a base class
+    if any('Timeout' in cls.__name__ or 'Connection' in cls.__name__ for cls in type(e).__mro__):
+        return 'retryable'
+
+    return 'fatal'
+
+
+def retry_after(e):
+
+    ### the wait in seconds that the provider asked for with a Retry-After header, or None
+
+    # errors of the mock LLM carry it directly
+    if getattr(e, 'retry_after', None) is not None:
+        return float(e.retry_after)
+
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if headers is None:
+        return None
+
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers['retry-after-ms'])/1000
+        except ValueError:
+            pass
+
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # an HTTP date
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+
+    ### when to resend a failed LLM call: throttled and retryable errors are resent after a jittered exponential
+    # backoff (or the wait the provider asked for), fatal errors and calls past their deadline are not
+
+    ### inputs:
+    # max_retries: how many times a call is resent before its error is raised [int] (default 5)
+    # base_delay: the backoff before the first resend, doubled for every later one [float] (default 1.0)
+    # max_delay: the longest backoff between two attempts [float] (default 60.0)
+    # deadline: seconds after the first attempt beyond which a call is not resent [float] (default 300.0)
+    # seed: seed of the backoff jitter, or None for a random one [int] (default None)
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0, deadline=300.0, seed=None):
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retries = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, e, attempt, started):
+
+        ### how long to wait before resending a call that failed
+
+        ### inputs:
+        # e: the exception raised by the call [Exception]
+        # attempt: how many attempts failed before this one [int]
+        # started: the time.monotonic() of the first attempt [float]
+
+        ### outputs:
+        # delay: seconds to wait before the next attempt, or None if the error should be raised [float]
+
+        if attempt >= self.max_retries or classify_error(e) == 'fatal':
+            return None
+
+        # "full jitter": a random wait up to the exponential backoff, so that failed calls do not all retry at once
+        with self._lock:
+            delay = self._random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))
+        asked = retry_after(e)
+        if asked is not None:
+            delay = max(delay, asked)
+
+        if time.monotonic() + delay - started > self.deadline:
+            return None
+
+        with self._lock:
+            self.retries += 1
+
+        return delay
@@ -0,0 +1,120 @@
+import pandas as pd
+import threading
+import gzip
+import json
+import os
+
+
+def _open_append(path):
+
+    # '.gz' files are appended to as a new gzip member each time they are opened, which gzip readers accept
+    if path.endswith('.gz'):
+        return gzip.open(path, mode='at', encoding='utf8', newline='')
+
+    return open(path, mode='a', encoding='utf8', newline='')
+
+
+class LogWriter:
+
+    ### append-only writer for the CatMiner conversation log, flushed every time entries are written
+    # '.csv' paths keep the original format: a 'Chats' column with a header at the start of each unit. since those
+    # entries carry no tags, they have to be written in order. '.jsonl' and '.jsonl.gz' paths get one JSON object per
+    # entry, tagged with its source, property, and sentence, so entries from concurrent sentences can be interleaved.
+
+    ### inputs:
+    # path: the log file, appended to if it exists [str]
+
+    def __init__(self, path):
+
+        self.path = path
+        self.ordered = not path.endswith(('.jsonl', '.jsonl.gz'))
+        self._lock = threading.Lock()
+        self._file = _open_append(path)
+
+    def begin(self):
+
+        ### start the log of a (paper, property) unit
+
+        if self.ordered:
+            with self._lock:
+                pd.DataFrame(data={'Chats': []}).to_csv(self._file, index=False)
+                self._file.flush()
+
+    def write(self, source, property, s, entries):
+
+        ### append log entries, e.g. those of one cascade stage
+
+        ### inputs:
+        # source: the name of the paper [str]
+        # property: the property being extracted [str]
+        # s: the index of the sentence the entries belong to, or None for entries about the whole paper [int]
+        # entries: the contexts and messages to log, as built by write_log [list]
+
+        if not entries:
+            return
+
+        with self._lock:
+            if self.ordered:
+                pd.DataFrame(data={'Chats': entries}).to_csv(self._file, header=False, index=False)
+            else:
+                for entry in entries:
+                    self._file.write(json.dumps({'Source': source, 'Property': property, 'Sentence': s, 'Entry': entry},
+                                                ensure_ascii=False, default=str) + '\n')
+            self._file.flush()
+
+    def close(self):
+
+        self._file.close()
+
+
+class RecordWriter:
+
+    ### append-only writer for the extracted records
+    # '.csv' paths get a header only at the top of the file; '.jsonl' paths get one JSON object per record.
+    # records are not compressed, so that a resumed run can cut the file back to the last completed unit.
+
+    ### inputs:
+    # path: the records file, appended to if it exists [str]
+
+    def __init__(self, path):
+
+        self.path = path
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._file = open(path, mode='a', encoding='utf8', newline='')
+
+    def write(self, records):
+
+        ### append records given as a dictionary of equally long lists, as built by the record stage
+
+        records_df = pd.DataFrame(data=records)
+
+        with self._lock:
+            if self.path.endswith('.jsonl'):
+                for record in records_df.to_dict(orient='records'):
+                    self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+            else:
+                header = self._file.tell() == 0
+                records_df.to_csv(self._file, header=header, index=False)
+            self._file.flush()
+            self.rows += len(records_df)
+
+    def sync(self):
+
+        ### force the records written so far onto disk
+
+        ### outputs:
+        # rows: the # of records written since the last sync [int]
+        # size: the size of the records file [int]
+
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            rows = self.rows
+            self.rows = 0
+
+        return rows, os.path.getsize(self.path)
+
+    def close(self):
+
+        self._file.close()
@@ -0,0 +1,71 @@
+from catmining.mock import FakeBackend
+from catmining.multiturn import extract
+import shutil
+import csv
+import os
+
+import pytest
+
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'examples', 'extract_one_paper')
+
+# two short papers next to the example abstract, so that runs cover several papers, values, and materials
+PAPERS = {
+    'b.txt': ['Oxidative coupling of methane over LSC and Mn/Na2WO4/SiO2 catalysts',
+              'The La-Sr-Ca oxide (LSC) catalyst was prepared by sol-gel synthesis.',
+              'Mn/Na2WO4/SiO2 was prepared by impregnation.',
+              'Reactions were carried out at 800 °C unless otherwise stated.',
+              'LSC gave a C2 yield of 18% and a C2 selectivity of 65%.',
+              'Mn/Na2WO4/SiO2 showed a C2 yield of 22% and C2 selectivity of 70% at 850 °C.',
+              'Metal oxide catalysts gave a C2 yield below 5%.',
+              'Li/MgO gave 12% yield.',
+              'The CH4 conversion was 30% over LSC.'],
+    'c.txt': ['Methane coupling on Li/MgO at moderate temperatures',
+              'All catalytic tests were performed at 1023 K in a fixed bed.',
+              'The Li/MgO catalyst was calcined in air.',
+              'Samples were characterised by XRD.',
+              'Li/MgO gave a C2 selectivity of 55% and a C2 yield of 12%.',
+              'The Metal oxide catalyst gave a C2 yield of 3%.'],
+}
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+
+    # the papers, system prompts, and model names of a small two-property run
+    monkeypatch.setenv('MODEL_ID', 'mock')
+    monkeypatch.setenv('model', 'mock')
+
+    source_dir = tmp_path / 'papers'
+    source_dir.mkdir()
+    shutil.copy(os.path.join(EXAMPLE, 'downloaded_paper', 'sample_abstract.txt'), source_dir / 'a.txt')
+    for name, lines in PAPERS.items():
+        (source_dir / name).write_text('\n'.join(lines), encoding='utf8')
+
+    return {'source_dir': str(source_dir) + os.sep, 'tmp_path': tmp_path,
+            'sp_paths': [os.path.join(EXAMPLE, 'yield-sp.txt'), os.path.join(EXAMPLE, 'selectivity-sp.txt')]}
+
+
+@pytest.fixture
+def run(corpus):
+
+    # extract the corpus with a client (a FakeBackend unless given) and return the records, or the estimate
+    def run(name='records', client=None, model_type='Meta', **kwargs):
+        record_path = str(corpus['tmp_path'] / f'{name}.csv')
+        settings = dict(required_prop_phrases=[['%'], ['%']], required_cond_phrases=[' K', '°C'], record_path=record_path,
+                        log_path=record_path + '.log', log_bool=True, followup=[1, 2, 3, 4])
+        output = extract(corpus['source_dir'], client if client is not None else FakeBackend(), ['C2 yield', 'C2 selectivity'],
+                         ['temperature'], model_type, corpus['sp_paths'], **{**settings, **kwargs})
+        if kwargs.get('estimate_only'):
+            return output
+        return read_records(record_path)
+
+    return run
+
+
+def read_records(path):
+
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf8', newline='') as f:
+        return [tuple(row.values()) for row in csv.DictReader(f)]
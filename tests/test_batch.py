@@ -0,0 +1,19 @@
+from catmining.mock import FakeBackend
+from catmining.batch import BatchClient, LocalBatchService
+import threading
+
+import pytest
+
+
+@pytest.mark.parametrize('limits', [{'requests_per_minute': 100000}, {'tokens_per_minute': 10**9}, {'concurrency': 2}])
+def test_limits_do_not_stall_batch_runs(run, tmp_path, limits):
+
+    # a worker waiting on the rate limiter never reaches the batch queue, so a limiter would stall every level
+    client = BatchClient(LocalBatchService(str(tmp_path / 'batches'), backend=FakeBackend()), poll_interval=0.0)
+    outputs = []
+    worker = threading.Thread(target=lambda: outputs.append(run('limited', client, **limits)), daemon=True)
+    worker.start()
+    worker.join(timeout=60)
+
+    assert not worker.is_alive(), 'the batch run stalled'
+    assert outputs[0] == run('serial')
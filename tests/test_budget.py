@@ -0,0 +1,32 @@
+from catmining.budget import Budget
+import re
+
+
+def test_calls_in_flight_reserve_their_tokens():
+
+    budget = Budget(max_tokens=100)
+    assert budget.exceeded_by(60) == False
+    # a second call sent before the first is settled could overrun the budget together with it
+    assert budget.exceeded_by(60) == True
+
+    budget.spend(40, 5, 60)
+    assert budget.reserved == 0
+    assert budget.exceeded_by(50) == False
+    budget.release(50)
+    assert budget.reserved == 0
+    assert (budget.in_tkns, budget.out_tkns) == (40, 5)
+
+
+def test_budget_is_a_hard_limit_under_concurrency_and_the_run_resumes(run, capsys):
+
+    serial = run('serial')
+    capsys.readouterr()
+
+    stopped = run(concurrency=8, token_budget=10000)
+    output = capsys.readouterr().out
+    assert 'Stopping the run.' in output
+    used = re.search(r'Budget: (\d+) input and (\d+) output tokens used', output)
+    assert int(used[1]) + int(used[2]) <= 10000
+    assert len(stopped) < len(serial)
+
+    assert sorted(run(resume=True)) == sorted(serial)
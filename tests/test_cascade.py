@@ -0,0 +1,45 @@
+from catmining.mock import FakeBackend, ScriptedResponder
+import threading
+import json
+import time
+
+
+def test_parallel_followups_do_not_outlive_a_rejection(run):
+
+    # F1 rejects every material at once while F2 is still being answered
+    in_flight = []
+    lock = threading.Lock()
+
+    def slow_yes(text):
+        with lock:
+            in_flight.append(text)
+        time.sleep(0.02)
+        with lock:
+            in_flight.remove(text)
+        return 'Yes'
+
+    responder = ScriptedResponder(rules=[('complete catalyst name', 'No'), ('refer to a \\*specific\\* material', slow_yes)])
+    records = run('parallel', FakeBackend(responder), followup=[1, 2], parallel_followups=True)
+
+    assert records == []
+    assert in_flight == []
+
+
+def test_parallel_followups_keep_records(run):
+
+    assert run('parallel', parallel_followups=True) == run('serial')
+
+
+def test_joint_p1_matches_separate_p1_with_fewer_calls(run, corpus):
+
+    separate = FakeBackend()
+    joint = FakeBackend()
+    metrics_path = str(corpus['tmp_path'] / 'metrics.json')
+
+    assert run('joint', joint, joint_p1=True, metrics_path=metrics_path) == run('separate', separate)
+    with open(metrics_path, encoding='utf8') as f:
+        report = json.load(f)
+
+    # both properties require '%', so each candidate sentence is classified for both in one Prompt 1 call
+    assert 2*report['Stages']['P1']['Calls'] == report['Funnel']['Phrase-Filtered']
+    assert separate.calls - joint.calls == report['Stages']['P1']['Calls']
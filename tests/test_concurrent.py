@@ -0,0 +1,31 @@
+import asyncio
+
+
+def test_concurrent_log_matches_serial_with_abbreviation_resolution(run, corpus):
+
+    # AR2 answers are shared between the sentences and properties of a paper, whichever asks first
+    serial = run('serial', abbr_resolution=True)
+    concurrent = run('concurrent', abbr_resolution=True, concurrency=4)
+    log = corpus['tmp_path'] / '{}.csv.log'
+
+    assert concurrent == serial
+    assert log.with_name('concurrent.csv.log').read_bytes() == log.with_name('serial.csv.log').read_bytes()
+
+
+def test_concurrent_run_inside_running_event_loop(run):
+
+    # as in Jupyter, where the notebook's event loop is already running
+    async def notebook_cell():
+        return run('concurrent', concurrency=4)
+
+    assert asyncio.run(notebook_cell()) == run('serial')
+
+
+def test_parallel_properties_log_matches_serial_with_abbreviation_resolution(run, corpus):
+
+    serial = run('serial', abbr_resolution=True)
+    parallel = run('parallel', abbr_resolution=True, parallel_properties=True)
+    log = corpus['tmp_path'] / '{}.csv.log'
+
+    assert parallel == serial
+    assert log.with_name('parallel.csv.log').read_bytes() == log.with_name('serial.csv.log').read_bytes()
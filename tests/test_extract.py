@@ -0,0 +1,74 @@
+from catmining.mock import FakeBackend
+from catmining.batch import BatchClient, LocalBatchService
+from catmining.multiturn_helpers import getexcerpt, read_sentences, ExcerptIndex
+
+import pytest
+
+
+def offline(prompt):
+
+    # the responder of a backend that must not be called, for runs that should be answered from a cache
+    raise AssertionError(f'the model was called with {prompt!r}')
+
+
+@pytest.mark.parametrize('mode', [{}, {'abbr_resolution': True}, {'test_mode': True}])
+def test_serial_concurrent_and_batch_records_agree(run, tmp_path, mode):
+
+    serial = run('serial', **mode)
+    client = BatchClient(LocalBatchService(str(tmp_path / 'batches'), backend=FakeBackend()), poll_interval=0.0)
+
+    assert serial
+    assert run('concurrent', concurrency=4, **mode) == serial
+    assert run('batched', client, **mode) == serial
+
+
+def test_cache_replays_a_run(run, tmp_path):
+
+    cache_path = str(tmp_path / 'cache.sqlite')
+    first = run('first', cache_path=cache_path)
+
+    assert first
+    assert run('replayed', FakeBackend(offline), cache_path=cache_path) == first
+
+
+@pytest.mark.parametrize('suffix', ['.jsonl', '.jsonl.gz'])
+def test_transcript_replays_a_run(run, tmp_path, suffix):
+
+    transcript_path = str(tmp_path / f'transcript{suffix}')
+    recorded = run('recorded', transcript_path=transcript_path)
+
+    assert recorded
+    assert run('replayed', FakeBackend(offline), transcript_path=transcript_path) == recorded
+    assert run('serial') == recorded
+
+
+def test_verdict_store_reuses_material_verdicts(run, tmp_path, capsys):
+
+    serial = run('serial')
+    verdict_path = str(tmp_path / 'verdicts.jsonl')
+    capsys.readouterr()
+
+    assert run('first', verdict_policy='corpus', verdict_path=verdict_path) == serial
+    assert 'reused from the verdict store' in (tmp_path / 'first.csv.log').read_text(encoding='utf8')
+
+    # a second run finds every verdict it asks for in the file
+    assert run('second', verdict_policy='corpus', verdict_path=verdict_path) == serial
+    summary = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Verdict store')][-1]
+    assert 'F1 ' in summary
+    for part in summary.split('hits: ')[1].rstrip('.').split(', '):
+        hits, asked = part.split()[1].split('/')
+        assert hits == asked
+
+
+def test_excerpts_reaching_past_the_paper(run, corpus):
+
+    sentences, title = read_sentences(corpus['source_dir'] + 'b.txt')
+    index = ExcerptIndex(title, sentences)
+    for bounds in [[6, 40], [40, 6], [0, 0], [2, 0]]:
+        for s in range(len(sentences)):
+            params = {'Bounds': bounds, 'Title': bounds[0] > 1}
+            excerpt = getexcerpt(title, sentences, s, params)
+            assert excerpt == index.get(s, params)
+            assert str(sentences[s]) in excerpt
+
+    assert run('wide', cond_bounds=[6, 40])
@@ -0,0 +1,94 @@
+from catmining.mock import FakeBackend, ScriptedResponder, MockError
+from catmining.multiturn_helpers import read_sentences
+import threading
+import json
+import os
+import re
+
+
+# the opening words of each cascade prompt, in the order they are tried
+PROMPTS = [('P1', 'Answer "Yes" or "No" only. Does the following text'), ('P2', 'Use only data present in the sentence'),
+           ('P3', 'Please list the catalyst'), ('P4-IPS', r'What is the .* filtered version of the source article'),
+           ('P4', 'What is the '), ('F1', 'Is "'), ('F2', 'Does the name "'),
+           ('F3', r'You said that .* value of '), ('F4', 'You said that ')]
+
+
+class RecordingResponder(ScriptedResponder):
+
+    # the built-in answers, counting the prompts and failures of each cascade stage as the backend receives them
+    def __init__(self, rules=None):
+
+        super().__init__(rules)
+        self.calls = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, text):
+
+        stage = next(stage for stage, opening in PROMPTS if re.match(opening, text, re.S))
+        with self._lock:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+        try:
+            return super().__call__(text)
+        except MockError:
+            with self._lock:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+
+
+def test_funnel_counts_each_paper_once(run, corpus):
+
+    responder = RecordingResponder()
+    metrics_path = str(corpus['tmp_path'] / 'metrics.json')
+    run(client=FakeBackend(responder), metrics_path=metrics_path)
+    with open(metrics_path, encoding='utf8') as f:
+        funnel = json.load(f)['Funnel']
+
+    papers = [read_sentences(os.path.join(corpus['source_dir'], name))[0] for name in sorted(os.listdir(corpus['source_dir']))]
+    assert funnel['Sentences Scanned'] == sum(len(sentences) for sentences in papers)
+    # both properties require '%'
+    assert funnel['Phrase-Filtered'] == 2*sum('%' in str(sentence) for sentences in papers for sentence in sentences)
+    assert funnel['Pre-Ranked'] == funnel['Phrase-Filtered'] == responder.calls['P1']
+    assert funnel['P1 Yes'] == responder.calls['P2']
+
+
+def test_stage_calls_match_the_backend(run, corpus):
+
+    # Prompt 4 finds no temperature for LSC in its excerpt, so IPS is asked, and F3 fails for XRD with an error
+    # that is not resent
+    def refuse(text):
+        raise MockError(400, f'Mock bad request: {text[:40]}')
+
+    responder = RecordingResponder(rules=[(r'^What is the temperature when\s*LSC .* following passage', 'None'),
+                                          (r'^You said that\s*XRD .* value of ', refuse)])
+    metrics_path = str(corpus['tmp_path'] / 'metrics.json')
+    prometheus_path = str(corpus['tmp_path'] / 'metrics.prom')
+    run(client=FakeBackend(responder), metrics_path=metrics_path, prometheus_path=prometheus_path)
+    with open(metrics_path, encoding='utf8') as f:
+        stages = json.load(f)['Stages']
+
+    assert set(responder.calls) == {'P1', 'P2', 'P3', 'P4', 'P4-IPS', 'F1', 'F2', 'F3', 'F4'}
+    assert {stage: counts['Calls'] for stage, counts in stages.items()} == responder.calls
+    assert set(responder.errors) == {'F3'}
+    assert {stage: counts['Errors'] for stage, counts in stages.items() if counts['Errors']} == responder.errors
+    for counts in stages.values():
+        assert counts['Replayed'] == 0
+        assert 0 <= counts['Latency p50'] <= counts['Latency p95'] <= counts['Latency p99']
+        if counts['Errors'] < counts['Calls']:
+            assert counts['Input Tokens'] > 0 and counts['Output Tokens'] > 0
+
+    # the Prometheus text carries the same counts
+    samples = {}
+    with open(prometheus_path, encoding='utf8') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    for stage, counts in stages.items():
+        assert samples[f'catmining_calls_total{{stage="{stage}"}}'] == counts['Calls']
+        assert samples[f'catmining_errors_total{{stage="{stage}"}}'] == counts['Errors']
+        assert samples[f'catmining_tokens_total{{stage="{stage}",direction="input"}}'] == counts['Input Tokens']
+        assert samples[f'catmining_latency_seconds{{stage="{stage}",quantile="0.5"}}'] == counts['Latency p50']
+    assert samples['catmining_funnel_total{step="Sentences Scanned"}'] > 0
@@ -0,0 +1,31 @@
+from catmining.mock import FakeBackend, MockServer, ScriptedResponder
+from catmining.batch import BatchClient, LocalBatchService
+from catmining.multiturn_helpers import define_client
+
+
+def test_fake_backend_answers_local_batch_jobs(run, tmp_path):
+
+    serial = run('serial')
+    backend = FakeBackend()
+    client = BatchClient(LocalBatchService(str(tmp_path / 'batches'), backend=backend), poll_interval=0.0)
+    batched = run('batched', client)
+
+    assert serial
+    assert batched == serial
+    assert backend.calls == client.requests
+
+
+def test_fake_backend_stops_at_max_tokens():
+
+    backend = FakeBackend(ScriptedResponder(rules=[('.', 'x'*1000)]))
+    completion = backend.complete([{'role': 'user', 'content': 'hi'}], params={'max_tokens': 5})
+
+    assert completion['Text'] == 'x'*20
+
+
+def test_mock_server_matches_in_process_backend(run):
+
+    with MockServer() as server:
+        served = run('served', define_client('Local', base_url=server.url), model_type='OpenAI')
+
+    assert served == run('in_process', model_type='OpenAI')
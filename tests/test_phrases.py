@@ -0,0 +1,13 @@
+from catmining.phrases import PhraseMatcher, passes
+
+
+def test_hits_match_substring_search():
+
+    lists = [['%', 'C2 yield'], ['yield', 'C2'], [' K', '°C', ' Ka'], ['']]
+    matcher = PhraseMatcher(lists)
+    sentences = ['LSC gave a C2 yield of 18% at 1023 K.', 'Tested at 800 °C.', 'No phrases here', '']
+
+    for sentence, hits in zip(sentences, matcher.scan(sentences)):
+        for phrases in lists:
+            assert passes(hits, phrases) == any(phrase in sentence for phrase in phrases)
+    assert matcher.match('C2 yield') == frozenset(['C2 yield', 'yield', 'C2', ''])
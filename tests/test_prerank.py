@@ -0,0 +1,73 @@
+from catmining.prerank import PreRanker, load_examples
+from catmining.mock import FakeBackend, ScriptedResponder
+import random
+import re
+
+
+def examples(n=80, seed=0):
+
+    # sentences that report a C2 yield, and sentences with a '%' that report something else
+    rng = random.Random(seed)
+    catalysts = ['LSC', 'Li/MgO', 'Mn/Na2WO4/SiO2', 'Co3O4', 'CeO2', 'La2O3']
+    positives = ['{c} gave a C2 yield of {v}%.', 'The C2 yield over {c} reached {v}%.', 'A C2 yield of {v}% was obtained on {c}.']
+    negatives = ['The CH4 conversion over {c} was {v}%.', '{c} lost {v}% of its surface area.', 'The O2 conversion on {c} was {v}%.']
+    data = []
+    for j in range(n):
+        label = j % 2 == 0
+        template = rng.choice(positives if label else negatives)
+        data.append(('C2 yield', template.format(c=rng.choice(catalysts), v=rng.randint(1, 60)), label))
+
+    return data
+
+
+def test_preranker_fits_and_ranks_reported_values_first():
+
+    ranker = PreRanker().fit(examples())
+    assert ranker.summary().startswith('Pre-ranker at 98% recall:')
+
+    held_out = examples(40, seed=1)
+    yes = [ranker.score('C2 yield', sentence) for _, sentence, label in held_out if label]
+    no = [ranker.score('C2 yield', sentence) for _, sentence, label in held_out if not label]
+    assert min(yes) > max(no)
+
+    # a property it has no model for is not filtered
+    assert ranker.score('C2 selectivity', held_out[0][1]) is None
+    assert ranker.keep('C2 selectivity', ['a', 'b'], [0, 1]) == [0, 1]
+
+
+def test_keep_honours_the_recall():
+
+    ranker = PreRanker().fit(examples())
+    scores = ranker.models['C2 yield']['Positive Scores']
+    sentences = [sentence for _, sentence, _ in examples(40, seed=2)]
+    candidates = list(range(len(sentences)))
+
+    kept = []
+    for recall in [0.2, 0.5, 0.8, 1.0]:
+        ranker.recall = recall
+        threshold = ranker.threshold('C2 yield')
+        # at least that share of the held-out positives scores at or above the cut-off
+        assert sum(score >= threshold for score in scores) >= recall*len(scores)
+        kept.append(ranker.keep('C2 yield', sentences, candidates))
+        assert kept[-1] == [s for s in candidates if ranker.score('C2 yield', sentences[s]) >= threshold]
+    assert all(set(lower) <= set(higher) for lower, higher in zip(kept, kept[1:]))
+    assert len(kept[0]) < len(kept[-1])
+
+
+def test_preranker_from_a_run_log_skips_prompt_1(run, corpus, tmp_path, capsys):
+
+    # Prompt 1 says "No" to the sentences without a yield
+    def p1(text):
+        return 'Yes' if 'yield' in text.split('\n\n', 1)[1] else 'No'
+
+    responder = ScriptedResponder(rules=[(r'^Answer "Yes" or "No" only', p1)])
+    run('history', FakeBackend(responder))
+    found = load_examples([str(corpus['tmp_path'] / 'history.csv.log')])
+    assert {property for property, _, _ in found} == {'C2 yield', 'C2 selectivity'}
+
+    path = str(tmp_path / 'preranker.json')
+    PreRanker().fit(found).save(path)
+    capsys.readouterr()
+    run('preranked', FakeBackend(responder), preranker=path, prerank_recall=0.5)
+    skipped = re.search(r'Pre-ranker skipped Prompt 1 for (\d+) of (\d+)', capsys.readouterr().out)
+    assert 0 < int(skipped[1]) < int(skipped[2])
@@ -0,0 +1,46 @@
+from catmining.multiturn_helpers import RateLimiter
+from catmining.mock import FakeBackend, ScriptedResponder
+import threading
+import time
+
+
+def test_only_successful_calls_raise_concurrency():
+
+    limiter = RateLimiter(max_concurrency=8)
+    limiter.concurrency = 2.0
+
+    limiter.acquire()
+    limiter.release(outcome='failed')
+    assert limiter.concurrency == 2.0
+
+    limiter.acquire()
+    limiter.release(used_tokens=10)
+    assert limiter.concurrency == 2.5
+
+    limiter.acquire()
+    limiter.release(outcome='throttled')
+    assert limiter.concurrency == 1.25
+    assert limiter.throttled == 1
+    assert limiter.in_flight == 0
+
+
+def test_quota_without_concurrency_keeps_parallel_followups_parallel(run):
+
+    # the most calls in flight at once while the quota is set
+    answer = ScriptedResponder()
+    counts = {'In Flight': 0, 'Most': 0}
+    lock = threading.Lock()
+
+    def tracked(text):
+        with lock:
+            counts['In Flight'] += 1
+            counts['Most'] = max(counts['Most'], counts['In Flight'])
+        time.sleep(0.01)
+        with lock:
+            counts['In Flight'] -= 1
+        return answer(text)
+
+    records = run('parallel', FakeBackend(tracked), requests_per_minute=60000, parallel_followups=True)
+
+    assert records == run('serial')
+    assert counts['Most'] > 1
@@ -0,0 +1,115 @@
+from catmining.retry import RetryPolicy, EmptyResponse, classify_error, retry_after
+from catmining.mock import FakeBackend, MockError, ScriptedResponder
+from email.utils import format_datetime
+import datetime
+import time
+
+import pytest
+
+
+class ClientError(Exception):
+
+    # the shape of a boto3 ClientError
+    def __init__(self, code, status=400):
+
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+
+class ReadTimeout(Exception):
+
+    pass
+
+
+class Response:
+
+    def __init__(self, headers):
+
+        self.headers = headers
+
+
+class APIStatusError(Exception):
+
+    # the shape of an OpenAI client error, with the HTTP response it came with
+    def __init__(self, status_code, headers):
+
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.response = Response(headers)
+
+
+@pytest.mark.parametrize('error, kind', [
+    (MockError(429, 'throttled'), 'throttled'),
+    (ClientError('ThrottlingException'), 'throttled'),
+    (MockError(500, 'server error'), 'retryable'),
+    (MockError(408, 'timeout'), 'retryable'),
+    (ClientError('ModelNotReadyException'), 'retryable'),
+    (ClientError('SomethingElse', status=503), 'retryable'),
+    (EmptyResponse('no text'), 'retryable'),
+    (ConnectionError('reset'), 'retryable'),
+    (ReadTimeout('read timed out'), 'retryable'),
+    (MockError(400, 'bad request'), 'fatal'),
+    (MockError(401, 'unauthorized'), 'fatal'),
+    (ClientError('ValidationException'), 'fatal'),
+    (ValueError('a bug'), 'fatal'),
+])
+def test_errors_are_classified(error, kind):
+
+    assert classify_error(error) == kind
+
+
+def test_retry_after_is_honoured():
+
+    assert retry_after(APIStatusError(429, {'retry-after': '3'})) == 3.0
+    assert retry_after(APIStatusError(429, {'retry-after-ms': '1500', 'retry-after': '3'})) == 1.5
+    date = format_datetime(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30), usegmt=True)
+    assert 20 < retry_after(APIStatusError(429, {'retry-after': date})) <= 30
+    assert retry_after(APIStatusError(429, {})) is None
+
+    # the wait asked for replaces a shorter backoff
+    policy = RetryPolicy(base_delay=0.01, seed=0)
+    assert policy.delay(MockError(429, 'throttled', retry_after=5.0), 0, time.monotonic()) == 5.0
+    assert policy.delay(APIStatusError(503, {'retry-after': '2'}), 0, time.monotonic()) == 2.0
+    assert policy.retries == 2
+
+
+def test_backoff_stops_at_max_retries_fatal_errors_and_the_deadline():
+
+    policy = RetryPolicy(max_retries=3, base_delay=1.0, max_delay=4.0, deadline=10.0, seed=0)
+    error = MockError(500, 'server error')
+    now = time.monotonic()
+
+    for attempt in range(3):
+        assert 0 <= policy.delay(error, attempt, now) <= min(4.0, 2**attempt)
+    assert policy.delay(error, 3, now) is None
+    assert policy.delay(MockError(400, 'bad request'), 0, now) is None
+
+    assert policy.retries == 3
+
+    # a call first sent 9.5 seconds ago may not wait past its 10 second deadline
+    policy = RetryPolicy(base_delay=0.01, deadline=10.0, seed=0)
+    assert policy.delay(MockError(429, 'throttled', retry_after=1.0), 0, now - 9.5) is None
+    assert policy.delay(MockError(429, 'throttled', retry_after=0.1), 0, now - 9.5) is not None
+
+
+def test_failed_calls_are_resent_until_the_deadline(run, capsys):
+
+    # the first two calls fail with a server error that asks for no wait
+    failures = {'Left': 2}
+    answer = ScriptedResponder()
+
+    def flaky(text):
+        if failures['Left'] > 0:
+            failures['Left'] -= 1
+            raise MockError(500, 'Mock server error.', retry_after=0.0)
+        return answer(text)
+
+    serial = run('serial')
+    capsys.readouterr()
+    assert run('flaky', FakeBackend(flaky)) == serial
+    assert 'Resent 2 failed calls.' in capsys.readouterr().out
+
+    # with no time left to resend them, the failed calls are given up on
+    failures['Left'] = 2
+    assert run('deadline', FakeBackend(flaky), retry_deadline=0.0) != serial
+    assert 'Resent' not in capsys.readouterr().out
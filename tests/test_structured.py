@@ -0,0 +1,35 @@
+import json
+
+
+def test_structured_engine_writes_records(run, corpus):
+
+    metrics_path = str(corpus['tmp_path'] / 'metrics.json')
+    records = run('structured', structured=True, confidence_threshold=0.0, metrics_path=metrics_path)
+    with open(metrics_path, encoding='utf8') as f:
+        report = json.load(f)
+
+    # one JSON call per candidate sentence, and no follow-ups for records the model is sure of
+    assert records
+    assert set(report['Stages']) == {'JSON'}
+    assert report['Stages']['JSON']['Calls'] == report['Funnel']['Pre-Ranked']
+    assert report['Funnel']['Records Kept'] == len(records)
+
+    # the records have the cascade's columns
+    header = (corpus['tmp_path'] / 'structured.csv').read_text(encoding='utf8').splitlines()[0]
+    run('cascade')
+    assert header == (corpus['tmp_path'] / 'cascade.csv').read_text(encoding='utf8').splitlines()[0]
+
+    assert run('openai', model_type='OpenAI', structured=True, confidence_threshold=0.0) == records
+
+
+def test_structured_engine_follows_up_on_low_confidence(run, corpus):
+
+    metrics_path = str(corpus['tmp_path'] / 'metrics.json')
+    records = run('unsure', structured=True, confidence_threshold=1.01, metrics_path=metrics_path)
+    with open(metrics_path, encoding='utf8') as f:
+        report = json.load(f)
+
+    # every record the JSON call returned is asked about
+    assert records
+    assert {'F1', 'F2', 'F3', 'F4'} <= set(report['Stages'])
+    assert report['Stages']['F1']['Calls'] == report['Funnel']['Materials'] == len(run('sure', structured=True, confidence_threshold=0.0))
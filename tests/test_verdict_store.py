@@ -0,0 +1,39 @@
+from catmining.cache import VerdictStore
+
+
+def key(store, property, source='a.txt', chat=True):
+
+    return store.key('F1', 'Co₃O₄', 'mock', 'system', source, property, chat)
+
+
+def test_verdicts_are_kept_per_property():
+
+    for policy in ['paper', 'property']:
+        store = VerdictStore(policy=policy)
+        assert key(store, 'C2 yield') == key(store, 'C2 yield')
+        assert key(store, 'C2 yield') != key(store, 'C2 selectivity')
+
+    store = VerdictStore(policy='property')
+    assert key(store, 'C2 yield', 'a.txt') == key(store, 'C2 yield', 'b.txt')
+
+    store = VerdictStore(policy='corpus')
+    assert key(store, 'C2 yield', 'a.txt') == key(store, 'C2 selectivity', 'b.txt')
+
+    store = VerdictStore(policy='context-free')
+    assert key(store, 'C2 yield') is None
+    assert key(store, 'C2 yield', chat=False) is not None
+
+
+def test_verdicts_persist_across_runs(tmp_path):
+
+    path = str(tmp_path / 'verdicts.jsonl')
+    store = VerdictStore(path, policy='property')
+    store.put('F1', key(store, 'C2 yield'), 'Co₃O₄', 'Yes')
+    store.close()
+
+    store = VerdictStore(path, policy='property')
+    assert len(store) == 1
+    assert store.get('F1', key(store, 'C2 yield')) == 'Yes'
+    assert store.get('F1', key(store, 'C2 selectivity')) is None
+    assert store.counts['F1'] == {'Hits': 1, 'Misses': 1}
+    store.close()